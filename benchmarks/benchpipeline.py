@@ -0,0 +1,355 @@
+# This file is part of Pals3D
+#
+# benchpipeline is meant to measure the throughput and the memory use
+# of the decode, coincidence, histogram and save steps of Pals3D on
+# synthetic data.
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Usage (from the repository root):
+#
+#   python benchmarks/benchpipeline.py --output results.json
+#   python benchmarks/benchpipeline.py --compare old.json new.json
+#
+# Each benchmark is timed on buffers of TTREADMAX records produced by
+# toolbox.generator.PALSGenerator at several event rates, and its peak
+# memory is measured with tracemalloc in a separate run. The results
+# are written as a JSON list of records, one per benchmark and setting.
+#
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'pals3D'))
+
+from th260 import sortingcore  # noqa: E402
+from toolbox.generator import PALSGenerator  # noqa: E402
+
+TTREADMAX = 131072  #: int : Records read from the FIFO at once
+RATES = (1e4, 1e5, 1e6)  #: tuple : Positron event rates (in events/s)
+GATES = (5000, 10000, 50000)  #: tuple : Long time gates (in ps)
+TIMERES = 1000  #: int : Short time gate of the 3C mode (in ps)
+MODES = ('2C', '2CW', '3C')
+CFDSET = dict((key + str(i), 0) for key in ('lev', 'zero', 'off')
+              for i in range(3))
+
+
+def syntheticBuffers(rate, nbuffers, seed=0):
+    """
+    Generate TTREADMAX-record buffers of a synthetic measurement
+
+    Parameters
+    ----------
+    rate : float
+        Positron event rate (in events/s)
+    nbuffers : int
+        Number of buffers
+    seed : int
+        Seed of the generator
+
+    Returns
+    -------
+    buffers : list of np.ndarray of np.uint32
+        Buffers of TTREADMAX records
+    recordRate : float
+        Mean number of records per second of the measurement
+    """
+    generator = PALSGenerator(rate=rate, efficiency=(0.9, 0.7, 0.7),
+                              background=(0.05*rate,)*3, seed=seed)
+    nrecords = nbuffers * TTREADMAX
+    duration = 1.1 * nrecords / generator.recordRate()
+    records = np.concatenate(list(generator.chunks(duration,
+                                                   duration/20)))
+    while records.size < nrecords:
+        records = np.concatenate((records, generator.generate(duration)))
+    records = records[:nrecords]
+    return np.split(records, nbuffers), generator.recordRate()
+
+
+def newWorker(mode, timeGate, filename):
+    """Return a SortingCore ready for a new measurement"""
+    worker = sortingcore.SortingCore(sortingType=mode, timeGate=timeGate,
+                                     timeRes=TIMERES, filename=filename,
+                                     CFDset=CFDSET, acqTime=1, nftot=1)
+    worker.newMeasurement(0)
+    return worker
+
+
+def measure(function, setup, repeat):
+    """
+    Time a function and measure its peak memory
+
+    Parameters
+    ----------
+    function : callable
+        Called with the value returned by setup
+    setup : callable
+        Called before each run, not timed
+    repeat : int
+        Number of timed runs, the fastest is kept
+
+    Returns
+    -------
+    seconds : float
+        Duration of the fastest run
+    peakMemory : int
+        Peak memory allocated during a run (in bytes)
+    """
+    seconds = float('inf')
+    for _ in range(repeat):
+        arg = setup()
+        start = time.perf_counter()
+        function(arg)
+        seconds = min(seconds, time.perf_counter() - start)
+    arg = setup()
+    tracemalloc.start()
+    function(arg)
+    peakMemory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peakMemory
+
+
+def benchSorting(buffers, recordRate, mode, timeGate, tmpdir, repeat):
+    """Benchmark sortBuffer, the filtering methods and saveData"""
+    filename = os.path.join(tmpdir, 'bench.hst')
+    nrecords = sum(buffer.size for buffer in buffers)
+    results = []
+
+    def sortAll(worker):
+        for buffer in buffers:
+            worker.sortBuffer(buffer, buffer.size)
+        return worker
+
+    seconds, peak = measure(sortAll, lambda: newWorker(mode, timeGate,
+                                                       filename), repeat)
+    results.append({'benchmark': 'sortBuffer',
+                    'records': nrecords,
+                    'seconds': seconds,
+                    'recordsPerSecond': nrecords / seconds,
+                    'peakMemory': peak,
+                    # time to sort one FIFO read vs time to fill it
+                    'bufferSeconds': seconds / len(buffers),
+                    'bufferFillSeconds': TTREADMAX / recordRate,
+                    'realTimeFactor': nrecords / seconds / recordRate})
+
+    if mode in ('2C', '3C'):
+        decoded = []
+        oflcorrection = 0
+        for buffer in buffers:
+            channels, timeTags, oflcorrection = sortingcore.decodeT2Records(
+                    buffer, oflcorrection)
+            decoded.append((channels, timeTags))
+        nevents = sum(channels.size for channels, _ in decoded)
+        method = '_2Cfiltering' if mode == '2C' else '_3Cfiltering'
+
+        def filterAll(worker):
+            for channels, timeTags in decoded:
+                getattr(worker, method)(channels, timeTags)
+
+        seconds, peak = measure(filterAll, lambda: newWorker(mode, timeGate,
+                                                             filename),
+                                repeat)
+        results.append({'benchmark': method,
+                        'records': nrecords,
+                        'events': nevents,
+                        'seconds': seconds,
+                        'recordsPerSecond': nrecords / seconds,
+                        'eventsPerSecond': nevents / seconds,
+                        'peakMemory': peak})
+
+    worker = sortAll(newWorker(mode, timeGate, filename))
+    ncoinc = sum(int(histogram.counts.sum())
+                 for histogram in worker.histograms.values())
+    def saveAll(worker):
+        worker.saveData(0)
+        worker.waitSaved()
+
+    seconds, peak = measure(saveAll, lambda: worker, repeat)
+    results.append({'benchmark': 'saveData',
+                    'records': nrecords,
+                    'coincidences': ncoinc,
+                    'seconds': seconds,
+                    'peakMemory': peak})
+    return results, worker
+
+
+def benchDecode(buffers, repeat):
+    """Benchmark decodeT2Records on all the buffers"""
+    nrecords = sum(buffer.size for buffer in buffers)
+
+    def decodeAll(_):
+        oflcorrection = 0
+        for buffer in buffers:
+            oflcorrection = sortingcore.decodeT2Records(buffer,
+                                                        oflcorrection)[2]
+
+    seconds, peak = measure(decodeAll, lambda: None, repeat)
+    return {'benchmark': 'decodeT2Records',
+            'records': nrecords,
+            'seconds': seconds,
+            'recordsPerSecond': nrecords / seconds,
+            'peakMemory': peak}
+
+
+def benchFits(worker, repeat):
+    """Benchmark the toolbox fit on the sync-chn1 time differences"""
+    try:
+        from toolbox import plotting
+    except ImportError as error:
+        return {'benchmark': 'fitHist', 'skipped': str(error)}
+    data = np.load(worker.events.filename, mmap_mode='r')['01']
+    seconds, peak = measure(
+            lambda d: plotting.fitHist(d, bins=161, rmin=0, rmax=4000),
+            lambda: data, repeat)
+    return {'benchmark': 'fitHist',
+            'events': int(data.size),
+            'seconds': seconds,
+            'eventsPerSecond': data.size / seconds,
+            'peakMemory': peak}
+
+
+def runBenchmarks(rates=RATES, gates=GATES, modes=MODES, nbuffers=8,
+                  repeat=3, output=print):
+    """
+    Run all the benchmarks
+
+    Returns
+    -------
+    results : list of dict
+        One record per benchmark and setting
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for rate in rates:
+            buffers, recordRate = syntheticBuffers(rate, nbuffers)
+            common = {'rate': rate, 'recordRate': recordRate}
+            result = benchDecode(buffers, repeat)
+            result.update(common)
+            results.append(result)
+            output("rate {:.0e}: decode {:.1f} Mrec/s"
+                   .format(rate, result['recordsPerSecond']/1e6))
+            for timeGate in gates:
+                for mode in modes:
+                    modeResults, worker = benchSorting(
+                            buffers, recordRate, mode, timeGate, tmpdir,
+                            repeat)
+                    if mode == '3C' and timeGate == gates[0]:
+                        modeResults.append(benchFits(worker, repeat))
+                    for result in modeResults:
+                        result.update(common, mode=mode, timeGate=timeGate)
+                    results.extend(modeResults)
+                    output("rate {:.0e} gate {} {}: sortBuffer {:.1f} "
+                           "Mrec/s, x{:.0f} real time"
+                           .format(rate, timeGate, mode,
+                                   modeResults[0]['recordsPerSecond']/1e6,
+                                   modeResults[0]['realTimeFactor']))
+    return results
+
+
+def metadata():
+    """Return the description of the machine and software versions"""
+    return {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'ttreadmax': TTREADMAX}
+
+
+def resultKey(result):
+    """Key identifying a benchmark and its setting in a result file"""
+    return (result['benchmark'], result.get('mode'), result.get('rate'),
+            result.get('timeGate'))
+
+
+def compareResults(oldFile, newFile, output=print):
+    """
+    Print the speedup of each benchmark between two result files
+
+    Parameters
+    ----------
+    oldFile : str
+        JSON result file of the reference run
+    newFile : str
+        JSON result file of the new run
+    """
+    with open(oldFile) as file:
+        old = dict((resultKey(r), r) for r in json.load(file)['results'])
+    with open(newFile) as file:
+        new = json.load(file)['results']
+    output("{:<16}{:>6}{:>9}{:>8}{:>12}{:>12}{:>9}"
+           .format('benchmark', 'mode', 'rate', 'gate', 'old (s)',
+                   'new (s)', 'speedup'))
+    for result in new:
+        reference = old.get(resultKey(result))
+        if reference is None or 'seconds' not in reference \
+                or 'seconds' not in result:
+            continue
+        output("{:<16}{:>6}{:>9.0e}{:>8}{:>12.4f}{:>12.4f}{:>8.2f}x"
+               .format(result['benchmark'], result.get('mode') or '-',
+                       result['rate'], result.get('timeGate') or '-',
+                       reference['seconds'], result['seconds'],
+                       reference['seconds'] / result['seconds']))
+
+
+def main(argv=None):
+    """Command line entry point of the benchmarks"""
+    parser = argparse.ArgumentParser(
+            description="Benchmark the Pals3D sorting pipeline on "
+                        "synthetic data.")
+    parser.add_argument('-o', '--output', default='bench_results.json',
+                        help="JSON result file (default: "
+                             "bench_results.json)")
+    parser.add_argument('--rates', type=float, nargs='+', default=RATES,
+                        help="positron event rates (in events/s)")
+    parser.add_argument('--gates', type=int, nargs='+', default=GATES,
+                        help="long time gates (in ps)")
+    parser.add_argument('--modes', nargs='+', default=MODES,
+                        choices=MODES, help="sorting types")
+    parser.add_argument('--buffers', type=int, default=8,
+                        help="number of TTREADMAX buffers per run")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="number of timed runs, the fastest is kept")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help="compare two result files instead of "
+                             "running the benchmarks")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compareResults(*args.compare)
+        return
+    results = runBenchmarks(args.rates, args.gates, args.modes,
+                            args.buffers, args.repeat)
+    with open(args.output, 'w') as file:
+        json.dump({'metadata': metadata(), 'results': results}, file,
+                  indent=1)
+    print("Results written to %s" % args.output)
+
+
+if __name__ == '__main__':
+    main()
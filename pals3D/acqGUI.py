@@ -152,6 +152,9 @@ class Ui_MainWindow(object):
         self.T2stopBtn.setObjectName("T2stopBtn")
         self.horizontalLayout_9.addWidget(self.T2stopBtn)
         self.gridLayout_10.addLayout(self.horizontalLayout_9, 6, 1, 1, 2)
+        self.T2saveRawChk = QtWidgets.QCheckBox(self.T2acqGrp)
+        self.T2saveRawChk.setObjectName("T2saveRawChk")
+        self.gridLayout_10.addWidget(self.T2saveRawChk, 6, 0, 1, 1)
         self.formLayout_10 = QtWidgets.QFormLayout()
         self.formLayout_10.setObjectName("formLayout_10")
         self.T2timeGateLongLabel = QtWidgets.QLabel(self.T2acqGrp)
@@ -180,6 +183,10 @@ class Ui_MainWindow(object):
         self.T2modeDouble.setChecked(False)
         self.T2modeDouble.setObjectName("T2modeDouble")
         self.horizontalLayout_7.addWidget(self.T2modeDouble)
+        self.T2modeAllPairs = QtWidgets.QRadioButton(self.T2acqGrp)
+        self.T2modeAllPairs.setChecked(False)
+        self.T2modeAllPairs.setObjectName("T2modeAllPairs")
+        self.horizontalLayout_7.addWidget(self.T2modeAllPairs)
         self.gridLayout_10.addLayout(self.horizontalLayout_7, 0, 0, 1, 2)
         self.line = QtWidgets.QFrame(self.T2acqGrp)
         self.line.setFrameShape(QtWidgets.QFrame.HLine)
@@ -372,6 +379,8 @@ class Ui_MainWindow(object):
         self.label_12.setText(_translate("MainWindow", "Acquisition parameters"))
         self.T2modeTriple.setText(_translate("MainWindow", "Triple coincidence"))
         self.T2modeDouble.setText(_translate("MainWindow", "Double coincidence"))
+        self.T2modeAllPairs.setText(_translate("MainWindow", "Double (all pairs)"))
+        self.T2saveRawChk.setText(_translate("MainWindow", "Save raw records"))
         self.T2acqTimePerFileLabel.setText(_translate("MainWindow", "Acq time per file (min)"))
         self.T2acqNoFilesLabel.setText(_translate("MainWindow", "Total number of files"))
         self.label_17.setText(_translate("MainWindow", "Gating parameters"))
@@ -28,19 +28,28 @@
 import sys
 import traceback
 import os.path
-import time
 import webbrowser
 
 from PyQt5 import QtWidgets, QtCore, QtGui
 
 import toolbox.utils as ut
 import acqGUI
-from th260 import th260controller, th260sorter
+from th260 import th260controller, th260sorter, t2rawfile, sortingprocess
+from th260.pipelinestats import formatStats
 
 # put here visual ressources
 ICON_OK = ":/icons/ok.png"
 ICON_WARNING = ":/icons/warning.png"
 VERSION = '1.0'
+# sort the data in a separate process rather than in a thread
+SORTING_IN_PROCESS = False
+# what to do with the data when HANDOFF_CAPACITY buffers are waiting to
+# be sorted: 'block' the FIFO reads, 'spill' to disk or 'drop' and count
+HANDOFF_POLICY = 'block'
+HANDOFF_CAPACITY = 64
+# measure a series of files in a single run of the card, the files being
+# cut from the event timetags by the sorter (no dead time between files)
+CONTINUOUS_ACQUISITION = False
 
 
 class MainWindow(QtWidgets.QMainWindow, acqGUI.Ui_MainWindow):
@@ -55,8 +64,17 @@ class MainWindow(QtWidgets.QMainWindow, acqGUI.Ui_MainWindow):
         self.warnings = 'No warnings'
 
         self.th260 = th260controller.TH260Controller()
-        self.sortingWorker = th260sorter.SortingWorker()
+        self.th260.setHandOff(HANDOFF_POLICY, HANDOFF_CAPACITY)
+        if SORTING_IN_PROCESS:
+            self.sortingWorker = sortingprocess.SortingProcess(
+                    self.th260.TTREADMAX)
+        else:
+            self.sortingWorker = th260sorter.SortingWorker()
         self.sortingWorker.COINCRATE.connect(self.updateCoincRates)
+        self.sortingWorker.FILE_DONE.connect(self.fileSaved)
+        self.sortingWorker.SAVE_ERROR.connect(self.showError)
+        # the controller and the sorter fill the same statistics
+        self.sortingWorker.stats = self.th260.stats
         self.sortingThread = QtCore.QThread()
         self.sortingWorker.moveToThread(self.sortingThread)
 
@@ -84,10 +102,13 @@ class MainWindow(QtWidgets.QMainWindow, acqGUI.Ui_MainWindow):
         self.th260.PROGRESS.connect(self.updateProgress)
         self.th260.DATA.connect(self.sortingWorker.sortBuffer,
                                 type=QtCore.Qt.QueuedConnection)
+        self.sortingWorker.BUFFER_DONE.connect(self.th260.bufferPool.release,
+                                               type=QtCore.Qt.DirectConnection)
         self.th260.ACQ_ENDED.connect(self.sortingWorker.processLastEvents,
                                      type=QtCore.Qt.QueuedConnection)
         self.th260.DEVINIT.connect(self.devInit)
         self.th260.UPDATECountRate.connect(self.updateCountRates)
+        self.th260.STATS.connect(self.updateStats)
 #        self.th260.ERROR.connect()
 
         self.sortingWorker.NEW_OUTPUT.connect(self.printOutput)
@@ -115,6 +136,9 @@ class MainWindow(QtWidgets.QMainWindow, acqGUI.Ui_MainWindow):
 
         self.statusbar.addPermanentWidget(self.warningBtn)
 
+        self.statsLabel = QtWidgets.QLabel()
+        self.statusbar.addPermanentWidget(self.statsLabel)
+
     # ------ Slots and GUI logic ------#
     @QtCore.pyqtSlot()
     def devInit(self):
@@ -143,11 +167,32 @@ class MainWindow(QtWidgets.QMainWindow, acqGUI.Ui_MainWindow):
     @QtCore.pyqtSlot(int)
     def updateCoincRates(self, count):
         """Update the display of the coincidence count widgets"""
-        if self.sortingWorker.sortingType == "2C":
+        if self.sortingWorker.sortingType in ("2C", "2CW"):
             self.rateDoubleValue.display(self.rateDoubleValue.value() + count)
         else:
             self.rateTripleValue.display(self.rateTripleValue.value() + count)
 
+    @QtCore.pyqtSlot(int)
+    def fileSaved(self, noFile):
+        """Update the acquisition progress in continuous mode"""
+        self.updateProgress("acq", noFile+1)
+
+    @QtCore.pyqtSlot(object)
+    def updateStats(self, stats):
+        """Update the pipeline statistics of the status bar"""
+        text = ("{:.2f} Mrec/s | queue {}/{} | {:.0f} ns/rec"
+                .format(stats['recordsPerSecond']/1e6,
+                        stats['queueHighWater'],
+                        self.th260.bufferPool.capacity,
+                        stats['decodeNsPerRecord']
+                        + stats['sortNsPerRecord']))
+        if stats['spillPending'] > 0:
+            text += " | {} rec spilled".format(stats['spillPending'])
+        if stats['droppedRecords'] > 0:
+            text += " | {} rec dropped".format(stats['droppedRecords'])
+        self.statsLabel.setText(text)
+        self.statsLabel.setToolTip(formatStats(stats))
+
     @QtCore.pyqtSlot(str, int)
     def updateProgress(self, mode, prog):
         """
@@ -216,12 +261,12 @@ class MainWindow(QtWidgets.QMainWindow, acqGUI.Ui_MainWindow):
 #            ut.enableChildOf(self.T2chn2Frame)
 
     @QtCore.pyqtSlot(bool)
-    def on_T2modeDouble_toggled(self, checked):
+    def on_T2modeTriple_toggled(self, checked):
         """Enable/disable the time resolution gate"""
         if checked:
-            self.T2timeGateShortValue.setEnabled(False)
-        else:
             self.T2timeGateShortValue.setEnabled(True)
+        else:
+            self.T2timeGateShortValue.setEnabled(False)
 
     @QtCore.pyqtSlot()
     def on_T2saveDefaultPrmBtn_clicked(self):
@@ -335,20 +380,36 @@ class MainWindow(QtWidgets.QMainWindow, acqGUI.Ui_MainWindow):
             self.sortingWorker.kwargs["CFDset"] = self.T2settingDict
             self.sortingWorker.kwargs["acqTime"] = self.th260.tacq/60000
             self.sortingWorker.kwargs["filename"] = self.T2filename
-            self.sortingWorker.kwargs["sortingType"] = "3C"\
-                if self.T2modeTriple.isChecked()\
-                else "2C"
+            if self.T2modeTriple.isChecked():
+                self.sortingWorker.kwargs["sortingType"] = "3C"
+            elif self.T2modeAllPairs.isChecked():
+                self.sortingWorker.kwargs["sortingType"] = "2CW"
+            else:
+                self.sortingWorker.kwargs["sortingType"] = "2C"
             self.sortingWorker.kwargs["timeGate"] = self.timeGate
             if self.T2modeTriple.isChecked():
                 self.sortingWorker.kwargs["timeRes"] = self.timeGate511
             else:
                 self.sortingWorker.kwargs["timeRes"] = None
+            continuous = (CONTINUOUS_ACQUISITION and self.acqNoFiles > 1
+                          and self.th260.tacq * self.acqNoFiles
+                          <= self.th260.ACQTMAX)
+            if continuous:
+                self.sortingWorker.kwargs["fileTime"] = self.th260.tacq
+            else:
+                self.sortingWorker.kwargs["fileTime"] = None
 
             # threads:
-            self.acqThread = T2AcquisitionThread(self.th260, self.acqNoFiles)
+            if self.T2saveRawChk.isChecked():
+                rawFilebase = self.T2filename.rsplit(sep=".", maxsplit=1)[0]
+            else:
+                rawFilebase = None
+            self.acqThread = T2AcquisitionThread(self.th260, self.acqNoFiles,
+                                                 rawFilebase, continuous)
             self.acqThread.globProgress.connect(self.updateProgress)
             self.acqThread.newMeas.connect(self.sortingWorker.newMeasurement)
             self.acqThread.fileDone.connect(self.sortingWorker.saveData)
+            self.acqThread.filesDone.connect(self.sortingWorker.closeFiles)
             self.acqThread.measDone.connect(self.measEnded)
 
             self.sortingThread.start()
@@ -381,8 +442,8 @@ class MainWindow(QtWidgets.QMainWindow, acqGUI.Ui_MainWindow):
         except AttributeError:
             self.showError("No thread to stop")
         else:
-            self.th260.stoptttr()
-            time.sleep(0.1)
+            # the acquisition thread stops the card itself
+            self.th260.requestStop()
             self.statusbar.removeWidget(self.progStatus)
             self.statusbar.showMessage('Last measurement stopped at {}'
                                        ' min of the file no {}'
@@ -395,6 +456,8 @@ class MainWindow(QtWidgets.QMainWindow, acqGUI.Ui_MainWindow):
     @QtCore.pyqtSlot()
     def on_actionExit_triggered(self):
         self.th260.closeDevices()
+        if SORTING_IN_PROCESS:
+            self.sortingWorker.close()
         self.close()
 
     @QtCore.pyqtSlot()
@@ -497,6 +560,8 @@ class MainWindow(QtWidgets.QMainWindow, acqGUI.Ui_MainWindow):
         """Store the currents acquisition settings as default values"""
         self.settings.setValue('T2modeDouble',
                                self.T2modeDouble.isChecked())
+        self.settings.setValue('T2modeAllPairs',
+                               self.T2modeAllPairs.isChecked())
         self.settings.setValue('T2acqTimePerFileValue',
                                self.T2acqTimePerFileValue.value())
         self.settings.setValue('T2acqNoFilesValue',
@@ -505,6 +570,8 @@ class MainWindow(QtWidgets.QMainWindow, acqGUI.Ui_MainWindow):
                                self.T2timeGateLongValue.value())
         self.settings.setValue('T2timeGateShortValue',
                                self.T2timeGateShortValue.value())
+        self.settings.setValue('T2saveRawChk',
+                               self.T2saveRawChk.isChecked())
         self.settings.setValue('T2filePath',
                                os.path.dirname(self.T2filename))
         self.settings.setValue('T2filename', self.T2filename)
@@ -534,7 +601,11 @@ class MainWindow(QtWidgets.QMainWindow, acqGUI.Ui_MainWindow):
 
         self.T2modeDouble.setChecked(
                 self.settings.value('T2modeDouble', type=bool))
+        self.T2modeAllPairs.setChecked(
+                self.settings.value('T2modeAllPairs', type=bool))
 
+        self.T2saveRawChk.setChecked(
+                self.settings.value('T2saveRawChk', type=bool))
         self.T2acqTimePerFileValue.setValue(
                 self.settings.value('T2acqTimePerFileValue', type=int))
         self.T2acqNoFilesValue.setValue(
@@ -720,30 +791,77 @@ class T2AcquisitionThread(QtCore.QThread):
         numero of the starting acquisition
     measDone : None
         Not in use
+    filesDone : int
+        Emitted at the end of a continuous acquisition with the number
+        of the last file, -1 if the acquisition was stopped
+
+    If rawFilebase is given, the raw records of the nth acquisition are
+    also saved to the file rawFilebase_n.t2r
+
+    If continuous is True, all the files are measured in a single run
+    of the card (see TH260Controller.startAcquisition) and the sorter
+    saves each file itself (see SortingWorker.closeFiles). The raw
+    records are then saved to the single file rawFilebase.t2r.
     """
     globProgress = QtCore.pyqtSignal(str, int)
     fileDone = QtCore.pyqtSignal(int)
     newMeas = QtCore.pyqtSignal(int)
     measDone = QtCore.pyqtSignal()
+    filesDone = QtCore.pyqtSignal(int)
 
-    def __init__(self,  dev, noFiles):
+    def __init__(self,  dev, noFiles, rawFilebase=None, continuous=False):
         super(T2AcquisitionThread, self).__init__()
         self.th260device = dev
         self.noFiles = noFiles
+        self.rawFilebase = rawFilebase
+        self.continuous = continuous
         self.abort = False
 
     def run(self):
+        if self.continuous:
+            self.runContinuous()
+            return
         for nof in range(self.noFiles):
             if self.isInterruptionRequested():
                 return
             self.newMeas.emit(nof)
+            if self.rawFilebase is not None:
+                self.th260device.rawFilename = "".join(
+                        (self.rawFilebase, "_", str(nof).zfill(3),
+                         t2rawfile.RAW_EXTENSION))
+                self.th260device.rawHeaderInfo = {'noFile': nof,
+                                                  'nftot': self.noFiles}
+            else:
+                self.th260device.rawFilename = None
             self.th260device.startAcquisition()
             self.fileDone.emit(nof)
             self.globProgress.emit("acq", nof+1)
         self.measDone.emit()
 
         self.exec_()
-        self.__init__(self.th260device, self.noFiles)
+        self.__init__(self.th260device, self.noFiles, self.rawFilebase)
+
+    def runContinuous(self):
+        """Measure all the files in a single run of the card"""
+        self.newMeas.emit(0)
+        if self.rawFilebase is not None:
+            self.th260device.rawFilename = "".join(
+                    (self.rawFilebase, t2rawfile.RAW_EXTENSION))
+            self.th260device.rawHeaderInfo = {
+                    'nftot': self.noFiles,
+                    'fileTime': self.th260device.tacq}
+        else:
+            self.th260device.rawFilename = None
+        self.th260device.startAcquisition(self.noFiles)
+        if self.isInterruptionRequested():
+            self.filesDone.emit(-1)
+        else:
+            self.filesDone.emit(self.noFiles - 1)
+        self.measDone.emit()
+
+        self.exec_()
+        self.__init__(self.th260device, self.noFiles, self.rawFilebase,
+                      self.continuous)
 
 
 if __name__ == '__main__':
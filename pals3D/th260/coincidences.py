@@ -0,0 +1,447 @@
+# This file is part of Pals3D
+#
+# coincidences is meant to declare the coincidence events sorted from
+# the data of PicoQuant TimeHarp 260 Pico cards (channel pairs and
+# triples, gates and sign conventions) and to compile them into the
+# lookup tables of the sorter, for applications to positron
+# annihilation lifetime spectroscopy.
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Coincidences are declared as a string of whitespace separated items:
+#
+#   A>B[@gate]             pair of the channels A and B, histogram of
+#                          tB - tA from 0 to the gate
+#   A-B[@gate]             pair of the channels A and B, histogram of
+#                          tB - tA from -gate/2 to gate/2
+#   S:A-B[@gate[/res]]     triple of a start event in channel S followed
+#                          by events in A and B within the gate, at most
+#                          res apart: histograms S>A, S>B and A-B
+#
+# The gates are in ps, the long and short time gates of the sorter
+# being used when they are not given. The sorting types '2C', '2CW'
+# and '3C' use the PRESETS.
+#
+
+import math
+import re
+
+import numpy as np
+
+BINWIDTH = 25  #: int : Width of the histogram bins (in ps)
+#: dict : Coincidences sorted by default by each sorting type
+PRESETS = {'2C': '0>1 0>2 1-2',
+           '2CW': '0>1 0>2 1-2',
+           '3C': '0:1-2'}
+PAIR_TYPES = ('2C', '2CW')  #: tuple : Sorting types of the pairs
+TRIPLE_TYPES = ('3C',)  #: tuple : Sorting types of the triples
+
+_PAIR_RE = re.compile(r'^(\d+)([>-])(\d+)(?:@(\d+))?$')
+_TRIPLE_RE = re.compile(r'^(\d+):(\d+)-(\d+)(?:@(\d+)(?:/(\d+))?)?$')
+
+
+def channelPairName(chA, chB):
+    """
+    Return the name of the histogram of a channel pair, e.g. '01'
+
+    The channel numbers are separated by a dash when one of them has
+    more than one digit, e.g. '3-12'.
+    """
+    if chA < 10 and chB < 10:
+        return "%d%d" % (chA, chB)
+    return "%d-%d" % (chA, chB)
+
+
+def channelPairLabel(chA, chB):
+    """Return the column label of a channel pair in the .hst files"""
+    if chA == 0:
+        return "sync-%d" % chB
+    return "chn%d-chn%d" % (chA, chB)
+
+
+class PairDefinition(object):
+    """
+    Double coincidence between two channels
+
+    The events of the two channels (in any order) less than the gate
+    apart are double coincidence events. The time difference
+    t(second) - t(first) is filled into the histogram of the pair.
+
+    Parameters
+    ----------
+    first : int
+        Channel number of the start event
+    second : int
+        Channel number of the stop event
+    gate : int, optional
+        Time gate (in ps), the long time gate of the sorter if None
+    oneSided : bool
+        Histogram from 0 to the gate if True, from -gate/2 to gate/2
+        otherwise
+    """
+
+    def __init__(self, first, second, gate=None, oneSided=False):
+        """Constructor of the PairDefinition class"""
+        if first == second:
+            raise ValueError("The channels of a pair must differ")
+        self.first = first
+        self.second = second
+        self.gate = gate
+        self.oneSided = oneSided
+
+    def __str__(self):
+        text = "%d%s%d" % (self.first, '>' if self.oneSided else '-',
+                           self.second)
+        if self.gate is not None:
+            text += "@%d" % self.gate
+        return text
+
+
+class TripleDefinition(object):
+    """
+    Triple coincidence of a start event and two stop events
+
+    Three successive events from the start channel and from the two
+    stop channels (in any order) are a triple coincidence event when
+    the stop events are within the gate after the start event and at
+    most resolution apart. The time differences are filled into the
+    start-first (one-sided), start-second (one-sided) and first-second
+    (from -gate/2 to gate/2) histograms.
+
+    Parameters
+    ----------
+    start : int
+        Channel number of the start event (e.g. the sync)
+    first, second : int
+        Channel numbers of the stop events
+    gate : int, optional
+        Long time gate (in ps), the one of the sorter if None
+    resolution : int, optional
+        Short time gate (in ps), the one of the sorter if None
+    """
+
+    def __init__(self, start, first, second, gate=None, resolution=None):
+        """Constructor of the TripleDefinition class"""
+        if len(set((start, first, second))) < 3:
+            raise ValueError("The channels of a triple must differ")
+        self.start = start
+        self.first = first
+        self.second = second
+        self.gate = gate
+        self.resolution = resolution
+
+    def __str__(self):
+        text = "%d:%d-%d" % (self.start, self.first, self.second)
+        if self.gate is not None:
+            text += "@%d" % self.gate
+            if self.resolution is not None:
+                text += "/%d" % self.resolution
+        return text
+
+
+def parseCoincidences(spec):
+    """
+    Parse a string of coincidence definitions
+
+    Parameters
+    ----------
+    spec : str
+        Whitespace separated definitions, see the module header
+
+    Returns
+    -------
+    definitions : list
+        PairDefinition and TripleDefinition objects
+
+    Raises
+    ------
+    ValueError
+        If a definition can not be parsed
+    """
+    definitions = []
+    for item in spec.split():
+        match = _PAIR_RE.match(item)
+        if match is not None:
+            first, kind, second, gate = match.groups()
+            definitions.append(PairDefinition(
+                    int(first), int(second),
+                    None if gate is None else int(gate), kind == '>'))
+            continue
+        match = _TRIPLE_RE.match(item)
+        if match is not None:
+            start, first, second, gate, res = match.groups()
+            definitions.append(TripleDefinition(
+                    int(start), int(first), int(second),
+                    None if gate is None else int(gate),
+                    None if res is None else int(res)))
+            continue
+        raise ValueError("Invalid coincidence definition %r" % item)
+    return definitions
+
+
+class CoincidenceSet(object):
+    """
+    Coincidence definitions compiled into the lookup tables of the
+    sorter
+
+    The channels of an event pair (or triplet) give at once the index
+    of its definition in a lookup table, so that routing the events
+    costs the same whatever the number of definitions. Only the
+    histograms of the declared channel pairs are allocated, as
+    consecutive slices of a single array of counts, so that all the
+    histograms are filled by a single bincount (see flatBins).
+
+    Parameters
+    ----------
+    definitions : str or list
+        Coincidence definitions (see parseCoincidences), the preset of
+        the sorting type if None or empty
+    sortingType : str
+        '2C', '2CW' (pairs) or '3C' (triples)
+    timeGate : int
+        Long time gate (in ps), default gate of the definitions
+    timeRes : int, optional
+        Short time gate (in ps), default resolution of the triples
+    tick : int
+        Duration of a tick (in ps)
+    nchannels : int
+        Number of channel numbers that can be met in the data
+
+    Attributes
+    ----------
+    spec : str
+        Text of the definitions
+    histogramNames : list of str
+        Channel pair name of each histogram (see channelPairName)
+    firstCenters, nbins, offsets : np.ndarray of int
+        Center of the first bin (in ps), number of bins and position in
+        the array of counts of each histogram
+    maxGateTicks : int
+        Longest gate of the definitions (in ticks)
+    pairTable : np.ndarray of int
+        Code of the pair of events of channels chA then chB at
+        chA*nchannels + chB (see pairCodes): 2*k for the pair k in
+        order, 2*k + 1 in reverse order, -1 if not a pair
+    pairSign : np.ndarray of int
+        Sign of the time difference tB - tA in the histogram of each
+        pair code: 1 if chA is the first channel of the pair, -1
+        otherwise
+    pairGateTicks, pairHistogram : np.ndarray of int
+        Gate (in ticks) and histogram index of each pair code
+    tripleTable : np.ndarray of int
+        Code of the triplet of events of channels chS, chA then chB at
+        (chS*nchannels + chA)*nchannels + chB (see tripleCodes): 2*k
+        for the triple k of start channel chS, first channel chA and
+        second channel chB, 2*k + 1 when chA is its second channel, -1
+        if not a triple
+    tripleGateTicks, tripleResTicks : np.ndarray of int
+        Long and short gates of each triple (in ticks)
+    tripleHistograms : np.ndarray of int
+        Index of the start-first, start-second and first-second
+        histograms of each triple
+    eventDtype : np.dtype
+        Record of a triple coincidence event in the event store: the
+        time differences (in ps) of each histogram of the triples, and
+        the index of the triple when there are several of them
+    """
+
+    def __init__(self, definitions, sortingType, timeGate, timeRes=None,
+                 tick=25, nchannels=65):
+        """Constructor of the CoincidenceSet class"""
+        if not definitions:
+            definitions = PRESETS[sortingType]
+        if isinstance(definitions, str):
+            definitions = parseCoincidences(definitions)
+        self.spec = " ".join(str(d) for d in definitions)
+        self.tick = tick
+        self.pairs = [d for d in definitions
+                      if isinstance(d, PairDefinition)]
+        self.triples = [d for d in definitions
+                        if isinstance(d, TripleDefinition)]
+        if sortingType in PAIR_TYPES:
+            if self.triples or not self.pairs:
+                raise ValueError("The %s sorting needs pair definitions "
+                                 "only" % sortingType)
+        elif sortingType in TRIPLE_TYPES:
+            if self.pairs or not self.triples:
+                raise ValueError("The %s sorting needs triple definitions "
+                                 "only" % sortingType)
+        else:
+            raise ValueError("Unknown sorting type %s" % sortingType)
+        channels = [c for d in self.pairs for c in (d.first, d.second)]
+        channels += [c for d in self.triples
+                     for c in (d.start, d.first, d.second)]
+        if max(channels) >= nchannels:
+            raise ValueError("Channel numbers must be below %d" % nchannels)
+
+        self.histogramNames = []
+        self._ranges = []
+        gates = []
+
+        self.nchannels = nchannels
+        self.pairTable = np.full(nchannels**2, -1, dtype=np.intp)
+        self.pairSign = np.tile([1, -1], len(self.pairs))
+        self.pairGateTicks = np.zeros(2*len(self.pairs), dtype=np.int64)
+        self.pairHistogram = np.zeros(2*len(self.pairs), dtype=np.intp)
+        for k, pair in enumerate(self.pairs):
+            chA, chB = pair.first, pair.second
+            if self.pairTable[chA*nchannels + chB] >= 0:
+                raise ValueError("Pair %s declared twice" % pair)
+            self.pairTable[chA*nchannels + chB] = 2*k
+            self.pairTable[chB*nchannels + chA] = 2*k + 1
+            gate = timeGate if pair.gate is None else pair.gate
+            gates.append(gate)
+            self.pairGateTicks[2*k:2*k+2] = self.ticks(gate)
+            self.pairHistogram[2*k:2*k+2] = self._histogram(
+                    chA, chB, gate, pair.oneSided)
+
+        # the table of the triples is only needed in '3C' mode
+        size = nchannels**3 if self.triples else 0
+        self.tripleTable = np.full(size, -1, dtype=np.intp)
+        self.tripleGateTicks = np.zeros(len(self.triples), dtype=np.int64)
+        self.tripleResTicks = np.zeros(len(self.triples), dtype=np.int64)
+        self.tripleHistograms = np.zeros((len(self.triples), 3),
+                                         dtype=np.intp)
+        for k, triple in enumerate(self.triples):
+            chS, chA, chB = triple.start, triple.first, triple.second
+            key = (chS*nchannels + chA)*nchannels + chB
+            if self.tripleTable[key] >= 0:
+                raise ValueError("Triple %s declared twice" % triple)
+            self.tripleTable[key] = 2*k
+            self.tripleTable[(chS*nchannels + chB)*nchannels + chA] = 2*k + 1
+            gate = timeGate if triple.gate is None else triple.gate
+            res = timeRes if triple.resolution is None else triple.resolution
+            if res is None:
+                raise ValueError("The short time gate of triple %s is "
+                                 "missing" % triple)
+            gates.append(gate)
+            self.tripleGateTicks[k] = self.ticks(gate)
+            self.tripleResTicks[k] = self.ticks(res)
+            self.tripleHistograms[k] = (self._histogram(chS, chA, gate, True),
+                                        self._histogram(chS, chB, gate, True),
+                                        self._histogram(chA, chB, gate,
+                                                        False))
+        self.maxGateTicks = max(self.ticks(gate) for gate in gates)
+
+        self.firstCenters = np.array([r[0] for r in self._ranges],
+                                     dtype=np.int64)
+        self.nbins = np.array([r[1] for r in self._ranges], dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.nbins)[:-1]))
+
+        fields = []
+        for k in np.unique(self.tripleHistograms):
+            fields.append((self.histogramNames[k], '<i4'))
+        if len(self.triples) > 1:
+            fields.append(('triple', '<u2'))
+        self.eventDtype = np.dtype(fields) if fields else None
+
+    def ticks(self, gate):
+        """Gate in ticks: dtime*tick < gate <=> dtime < ceil(gate/tick)"""
+        return int(math.ceil(gate / self.tick))
+
+    def _histogram(self, chA, chB, gate, oneSided):
+        """Index of the histogram of a channel pair, added if needed"""
+        rmax = int(gate)
+        # bins centered on multiples of BINWIDTH
+        if oneSided:
+            histRange = (0, rmax//BINWIDTH + 1)
+        else:
+            histRange = (-(rmax//2), 2*(rmax//2)//BINWIDTH + 1)
+        name = channelPairName(chA, chB)
+        if name in self.histogramNames:
+            k = self.histogramNames.index(name)
+            if self._ranges[k] != histRange:
+                raise ValueError("Histogram %s declared with two ranges"
+                                 % name)
+            return k
+        self.histogramNames.append(name)
+        self._ranges.append(histRange)
+        return len(self.histogramNames) - 1
+
+    def pairCodes(self, chnFirst, chnSecond):
+        """
+        Return the code of pairs of events (see pairTable)
+
+        Parameters
+        ----------
+        chnFirst, chnSecond : np.ndarray of int
+            Channel number of the first and second events of the pairs
+        """
+        return self.pairTable[chnFirst*self.nchannels + chnSecond]
+
+    def tripleCodes(self, channels):
+        """
+        Return the code of each triplet of successive events (see
+        tripleTable)
+
+        Parameters
+        ----------
+        channels : np.ndarray of int
+            Channel number of the events
+
+        Returns
+        -------
+        codes : np.ndarray of int
+            Code of the triplets starting with each event but the last
+            two
+        """
+        key = channels[:-2] * self.nchannels
+        key += channels[1:-1]
+        key *= self.nchannels
+        key += channels[2:]
+        return self.tripleTable[key]
+
+    def histogramLabels(self):
+        """Column label of each histogram in the .hst files"""
+        labels = []
+        for name in self.histogramNames:
+            chA, chB = name.split('-') if '-' in name else name
+            labels.append(channelPairLabel(int(chA), int(chB)))
+        return labels
+
+    def flatBins(self, histograms, ticks, shifts=None):
+        """
+        Return the bins of values in the array of all the counts
+
+        The bin of each value is computed exactly with integer
+        arithmetic, as in sortingcore.HistogramAccumulator.fill.
+
+        Parameters
+        ----------
+        histograms : int or np.ndarray of int
+            Histogram index of the values, or of each value
+        ticks : np.ndarray of int
+            Values to be histogrammed (in ticks)
+        shifts : np.ndarray of int, optional
+            Offset added to the bin of each value, e.g. to fill one of
+            several sets of histograms
+
+        Returns
+        -------
+        bins : np.ndarray of int
+            Position in the array of counts of the values in the range
+            of their histogram
+        """
+        idx = ((2*(ticks*self.tick - self.firstCenters[histograms])
+                + BINWIDTH) // (2*BINWIDTH))
+        valid = (idx >= 0) & (idx < self.nbins[histograms])
+        idx += self.offsets[histograms]
+        if shifts is not None:
+            idx += shifts
+        return idx[valid]
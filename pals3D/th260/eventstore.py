@@ -0,0 +1,214 @@
+# This file is part of Pals3D
+#
+# eventstore is meant to store the triple coincidence events sorted
+# from the data of a PicoQuant TimeHarp 260 Pico for applications to
+# positron annihilation lifetime spectroscopy.
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+# The events are written as a standard .npy file holding a 1D
+# structured array with one int32 field per channel pair (see
+# th260.coincidences.CoincidenceSet.eventDtype), which can be read back
+# with numpy.load (e.g. with mmap_mode='r'):
+#
+#   events = np.load('file_000.npy', mmap_mode='r')
+#   dtimes01 = events['01']
+#
+# Files saved by former versions of Pals3D hold a (N, 3) float64 array
+# of the same time differences instead, one column per channel pair.
+# loadEvents reads both formats, as a structured array or as the former
+# (N, 3) array of columns, so that existing analysis scripts only need
+# to replace np.load by loadEvents(filename, columns=True).
+#
+
+import numpy as np
+from numpy.lib import recfunctions
+
+#: np.dtype : Time differences (in ps) of a triple coincidence event of
+#: the default triple (sync, channel 1, channel 2)
+EVENT_DTYPE = np.dtype([('01', '<i4'), ('02', '<i4'), ('12', '<i4')])
+BLOCKSIZE = 65536  #: int : Number of events of a block
+HEADER_SIZE = 128  #: int : Size of the .npy header, shape included
+
+
+def headerSize(dtype):
+    """
+    Return the size of the .npy header of the events of a given dtype
+
+    HEADER_SIZE, or the smallest multiple of 64 bytes holding the
+    header of the largest number of events for long dtypes.
+    """
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype),
+                   'fortran_order': False,
+                   'shape': (2**63,)})
+    size = len(np.lib.format.magic(1, 0)) + 2 + len(header) + 1
+    return max(HEADER_SIZE, -(-size // 64) * 64)
+
+
+def npyHeader(nevents, dtype=EVENT_DTYPE):
+    """
+    Return the .npy (version 1.0) header of an array of nevents events
+
+    The header is padded to headerSize(dtype) bytes whatever the number
+    of events, so that it can be rewritten in place once the file is
+    complete.
+    """
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype),
+                   'fortran_order': False,
+                   'shape': (nevents,)})
+    header = header.encode('latin1')
+    size = headerSize(dtype) - len(np.lib.format.magic(1, 0)) - 2
+    header = header.ljust(size - 1) + b'\n'
+    return (np.lib.format.magic(1, 0)
+            + np.array(size, dtype='<u2').tobytes() + header)
+
+
+class EventStore(object):
+    """
+    Growable store of the triple coincidence events
+
+    The events are appended to fixed-size blocks of dtype records.
+    When a filename is given, each full block is written at once to
+    the end of the file, which is a valid .npy file once the store is
+    closed (the header holding the final number of events is rewritten
+    then). Otherwise the blocks are kept in memory (see toArray).
+
+    Parameters
+    ----------
+    filename : str, optional
+        Name of the .npy file the events are written to, None to keep
+        them in memory
+    blockSize : int
+        Number of events of a block
+    dtype : np.dtype
+        Record of an event, one field per channel pair
+
+    Attributes
+    ----------
+    nevents : int
+        Number of events stored
+    closed : bool
+        True once the file is complete (see close)
+    """
+
+    def __init__(self, filename=None, blockSize=BLOCKSIZE,
+                 dtype=EVENT_DTYPE):
+        """Constructor of the EventStore class"""
+        self.filename = filename
+        self.blockSize = blockSize
+        self.dtype = np.dtype(dtype)
+        self.nevents = 0
+        self.closed = False
+        self._blocks = []
+        self._block = np.empty(blockSize, dtype=self.dtype)
+        self._nblock = 0
+        self._file = None
+        if filename is not None:
+            self._file = open(filename, 'wb', buffering=0)
+            self._file.write(npyHeader(0, self.dtype))
+
+    def __len__(self):
+        return self.nevents
+
+    def append(self, dtimes):
+        """
+        Append events to the store
+
+        Parameters
+        ----------
+        dtimes : dict
+            Values of the events for each field of the dtype (e.g. the
+            time differences in ps of the channel pairs '01', '02' and
+            '12'), arrays of the same length
+        """
+        nevents = len(dtimes[self.dtype.names[0]])
+        start = 0
+        while start < nevents:
+            n = min(nevents - start, self.blockSize - self._nblock)
+            block = self._block[self._nblock:self._nblock+n]
+            for chnPair in self.dtype.names:
+                block[chnPair] = dtimes[chnPair][start:start+n]
+            self._nblock += n
+            start += n
+            if self._nblock == self.blockSize:
+                self._flushBlock()
+        self.nevents += nevents
+
+    def _flushBlock(self):
+        """Write the current block to the file or keep it in memory"""
+        block = self._block[:self._nblock]
+        if self._file is not None:
+            self._file.write(block.tobytes())
+        else:
+            self._blocks.append(block)
+            self._block = np.empty(self.blockSize, dtype=self.dtype)
+        self._nblock = 0
+
+    def toArray(self):
+        """Return all the events stored in memory as a single array"""
+        return np.concatenate(self._blocks + [self._block[:self._nblock]])
+
+    def close(self):
+        """
+        Write the last block and the final header of the file
+
+        The file can then be read with numpy.load. Closing a store
+        twice or a store kept in memory does nothing.
+        """
+        if self.closed or self._file is None:
+            return
+        self._flushBlock()
+        self._file.seek(0)
+        self._file.write(npyHeader(self.nevents, self.dtype))
+        self._file.close()
+        self.closed = True
+
+
+def loadEvents(filename, mmap_mode=None, columns=False):
+    """
+    Load the triple coincidence events of a .npy file
+
+    Parameters
+    ----------
+    filename : str
+        Name of the .npy file, of the current structured format or of
+        the former (N, 3) format
+    mmap_mode : str, optional
+        Memory map the file, see numpy.load
+    columns : bool
+        Return the events as a 2D array with one column per field, in
+        the order of the fields (the layout of the former files)
+        rather than as a structured array
+
+    Returns
+    -------
+    events : np.ndarray
+        Structured array with one field per channel pair ('01', '02'
+        and '12' for the former files), or 2D array of columns
+    """
+    events = np.load(filename, mmap_mode=mmap_mode)
+    if events.dtype.names is None:
+        # former (N, 3) float64 array, time differences in ps
+        if columns:
+            return events
+        return recfunctions.unstructured_to_structured(
+                np.rint(events), EVENT_DTYPE)
+    if columns:
+        return recfunctions.structured_to_unstructured(events)
+    return events
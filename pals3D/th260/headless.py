@@ -0,0 +1,611 @@
+# This file is part of Pals3D
+#
+# headless is meant to run a series of acquisitions with a PicoQuant
+# TimeHarp 260 Pico without GUI and without Qt, the settings being read
+# from a configuration file, for applications to positron annihilation
+# lifetime spectroscopy.
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Usage (from the pals3D directory):
+#
+#   python -m th260.headless acquisition.ini
+#
+# The configuration file has an [acquisition] section and a [CFD]
+# section (see DEFAULTS for all the options and their default values):
+#
+#   [acquisition]
+#   filename = /data/run.hst
+#   acqTime = 10            ; min per file
+#   noFiles = 6
+#   sortingType = 3C        ; 2C, 2CW or 3C
+#   timeGate = 10000        ; ps
+#   timeRes = 1000          ; ps, 3C only
+#   coincidences = 0:1-2    ; optional, see th260.coincidences
+#   markers = 1 2           ; optional, marker channels splitting spectra
+#   continuous = yes        ; optional, one card run for all the files
+#
+#   [CFD]
+#   lev0 = -30              ; mV, sync
+#   zero0 = -10             ; mV
+#   off0 = 0                ; ps
+#   lev1 = -30              ; then the same for channels 1 and 2
+#   ...
+#
+# The acquisition is stopped cleanly with Ctrl+C: the data already read
+# are sorted and the current file is saved.
+#
+# Several devices are run in parallel with the devices option of the
+# [device] section ('all' or a list of device indices), each device
+# being driven by its own process. The settings of device N can be
+# changed in the [acquisition devN] and [CFD devN] sections, and its
+# output files are named after the filename with a _devN suffix:
+#
+#   [device]
+#   devices = all
+#
+#   [CFD dev1]
+#   off1 = 310
+#
+
+import argparse
+import configparser
+import multiprocessing as mp
+import queue
+import signal
+import threading
+import time
+import traceback
+
+from th260 import th260backend
+from th260.coincidences import CoincidenceSet, PRESETS
+from th260.pipelinestats import formatStats, formatCombinedStats
+from th260.sortingcore import SortingCore
+from th260.t2rawfile import RAW_EXTENSION
+from th260.th260core import TH260Core, listDevices
+
+#: dict : Options of each section of the configuration file and their
+#: default values (None for the mandatory ones)
+DEFAULTS = {
+    'acquisition': {'filename': None,
+                    'acqTime': '1',
+                    'noFiles': '1',
+                    'sortingType': '2C',
+                    'timeGate': '10000',
+                    'timeRes': '1000',
+                    'coincidences': '',
+                    'markers': '',
+                    'continuous': 'no',
+                    'saveRaw': 'no',
+                    'handOffPolicy': 'block',
+                    'handOffCapacity': '64'},
+    'device': {'backend': '',
+               'devices': '',
+               'syncDivider': '1'},
+    'CFD': {'lev0': '-30', 'zero0': '-10', 'off0': '0',
+            'lev1': '-30', 'zero1': '-10', 'off1': '0',
+            'lev2': '-30', 'zero2': '-10', 'off2': '0'}}
+
+
+def readConfig(filename):
+    """
+    Read the settings of an acquisition series from a configuration file
+
+    Parameters
+    ----------
+    filename : str
+        INI file with the sections and options of DEFAULTS
+
+    Returns
+    -------
+    config : configparser.ConfigParser
+        Settings, the missing options being set to their default value
+
+    Raises
+    ------
+    ValueError
+        If a mandatory option is missing, the sorting type is unknown or
+        an option is not valid
+    """
+    config = configparser.ConfigParser(inline_comment_prefixes=(';', '#'))
+    # the option names are case sensitive, as the sorter keywords
+    config.optionxform = str
+    config.read_dict(dict((section, dict((key, value)
+                                         for key, value in options.items()
+                                         if value is not None))
+                          for section, options in DEFAULTS.items()))
+    with open(filename) as file:
+        config.read_file(file)
+    for section, options in DEFAULTS.items():
+        for key, value in options.items():
+            if value is None and not config.has_option(section, key):
+                raise ValueError("Missing option %s in section [%s] of %s"
+                                 % (key, section, filename))
+    acquisition = config['acquisition']
+    if acquisition['sortingType'] not in PRESETS:
+        raise ValueError("Unknown sorting type %s"
+                         % acquisition['sortingType'])
+    # checks the coincidence definitions
+    CoincidenceSet(acquisition['coincidences'], acquisition['sortingType'],
+                   acquisition.getint('timeGate'),
+                   acquisition.getint('timeRes'))
+    markers = acquisition['markers'].split()
+    if not all(marker.isdigit() and 1 <= int(marker) <= 15
+               for marker in markers):
+        raise ValueError("Marker channels must be between 1 and 15, not %s"
+                         % acquisition['markers'])
+    return config
+
+
+def cardConfig(config, devidx):
+    """
+    Return the settings of one of several devices run in parallel
+
+    The options of the [acquisition devN] and [CFD devN] sections
+    replace those of the [acquisition] and [CFD] sections for device
+    N, and a _devN suffix is added to the filename unless it is given
+    in the [acquisition devN] section.
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+        Settings of the series (see readConfig)
+    devidx : int
+        Index of the device
+
+    Returns
+    -------
+    config : configparser.ConfigParser
+        Settings of the series of the device
+    """
+    card = configparser.ConfigParser(inline_comment_prefixes=(';', '#'))
+    card.optionxform = str
+    card.read_dict(dict((section, dict(config[section]))
+                        for section in DEFAULTS))
+    suffix = 'dev%d' % devidx
+    for section in DEFAULTS:
+        if config.has_section('%s %s' % (section, suffix)):
+            card.read_dict({section: dict(config['%s %s'
+                                                 % (section, suffix)])})
+    if not config.has_option('acquisition %s' % suffix, 'filename'):
+        filename = config['acquisition']['filename']
+        try:
+            filebase, extension = filename.rsplit(sep=".", maxsplit=1)
+            card['acquisition']['filename'] = "%s_%s.%s" % (
+                    filebase, suffix, extension)
+        except ValueError:
+            card['acquisition']['filename'] = "%s_%s" % (filename, suffix)
+    return card
+
+
+def selectDevices(config, lib):
+    """
+    Return the indices of the devices to be run
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+        Settings of the series: the devices option of the [device]
+        section is 'all', a list of device indices, or empty for the
+        first device found
+    lib : ctypes.CDLL or SimulatedTH260Lib
+        Device library
+
+    Returns
+    -------
+    devices : list of int
+        Device indices, [None] for the first device found
+    """
+    devices = config['device']['devices'].strip()
+    if not devices:
+        return [None]
+    if devices == 'all':
+        return [devidx for devidx, serial in listDevices(lib)]
+    return [int(devidx) for devidx in devices.replace(',', ' ').split()]
+
+
+class HeadlessAcquisition(object):
+    """
+    Series of acquisitions driven without GUI
+
+    The device is driven by a TH260Core in the calling thread and the
+    data are sorted by a SortingCore in a plain sorting thread. The
+    buffers and the commands of the sorter (new measurement, end of
+    the measurement, saving) are handed over in order through a queue,
+    the buffers being given back to the buffer pool of the controller
+    once decoded: the hand-off stays bounded by the capacity of the
+    pool (see TH260Core.setHandOff).
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+        Settings of the series (see readConfig)
+    lib : ctypes.CDLL or SimulatedTH260Lib, optional
+        Device library, loaded according to the backend option of the
+        [device] section (or the PALS3D_BACKEND environment variable)
+        if None
+    output : callable
+        Called with the messages of the controller and of the sorter
+    devidx : int, optional
+        Index of the device, the first device found if None
+
+    Attributes
+    ----------
+    controller : TH260Core
+    sorter : SortingCore
+    """
+
+    def __init__(self, config, lib=None, output=print, devidx=None):
+        """Constructor of the HeadlessAcquisition class"""
+        self.config = config
+        self.output = output
+        acquisition = config['acquisition']
+        if lib is None:
+            lib = th260backend.loadLibrary(config['device']['backend']
+                                           or None)
+        self.controller = TH260Core(lib, devidx)
+        self.controller.NEW_OUTPUT.disconnect()
+        self.controller.WARNING.disconnect()
+        self.controller.NEW_OUTPUT.connect(output)
+        self.controller.WARNING.connect(
+                lambda text: output("Warning: %s" % text))
+        self.controller.setHandOff(acquisition['handOffPolicy'],
+                                   acquisition.getint('handOffCapacity'))
+
+        self.sorter = SortingCore()
+        # the controller and the sorter fill the same statistics
+        self.sorter.stats = self.controller.stats
+        self.sorter.NEW_OUTPUT.connect(output)
+        self.sorter.BUFFER_DONE.connect(self.controller.bufferPool.release)
+        self.sorter.SAVE_ERROR.connect(
+                lambda text: output("Error: %s" % text))
+
+        self.commands = queue.Queue()
+        self.controller.DATA.connect(
+                lambda buffer, nrecords: self._post(self.sorter.sortBuffer,
+                                                    buffer, nrecords))
+        self.controller.ACQ_ENDED.connect(
+                lambda: self._post(self.sorter.processLastEvents))
+        self.stopped = False
+        self._sorterErrors = []
+
+    def _post(self, function, *args):
+        """Queue a call for the sorting thread"""
+        self.commands.put((function, args))
+
+    def _runSorter(self):
+        """Main function of the sorting thread"""
+        while True:
+            command = self.commands.get()
+            if command is None:
+                break
+            function, args = command
+            try:
+                function(*args)
+            except Exception as error:
+                traceback.print_exc()
+                self._sorterErrors.append(error)
+                self.stop()
+
+    def initDevice(self):
+        """Open and initialise the device, then apply the CFD settings"""
+        cfd = self.config['CFD']
+        self.controller.searchDevices()
+        self.controller.initialization()
+        self.controller.syncDivider = self.config['device'].getint(
+                'syncDivider')
+        self.controller.syncCFDLevel = cfd.getint('lev0')
+        self.controller.syncCFDZeroCross = cfd.getint('zero0')
+        self.controller.syncOffset = cfd.getint('off0')
+        for i in range(len(self.controller.inputOffset)):
+            self.controller.inputCFDLevel[i] = cfd.getint('lev%d' % (i+1))
+            self.controller.inputCFDZeroCross[i] = cfd.getint(
+                    'zero%d' % (i+1))
+            self.controller.inputOffset[i] = cfd.getint('off%d' % (i+1))
+        self.controller.configureSetting()
+
+    def sorterSettings(self):
+        """Return the keyword arguments of the sorter"""
+        acquisition = self.config['acquisition']
+        noFiles = acquisition.getint('noFiles')
+        sortingType = acquisition['sortingType']
+        kwargs = {'sortingType': sortingType,
+                  'timeGate': acquisition.getint('timeGate'),
+                  'timeRes': (acquisition.getint('timeRes')
+                              if sortingType == '3C' else None),
+                  'coincidences': acquisition['coincidences'] or None,
+                  'markers': ([int(marker) for marker
+                               in acquisition['markers'].split()]
+                              or None),
+                  'filename': acquisition['filename'],
+                  'CFDset': self.controller.getSettingDict(),
+                  'acqTime': acquisition.getfloat('acqTime'),
+                  'nftot': noFiles,
+                  'fileTime': None}
+        if self.continuous():
+            kwargs['fileTime'] = self.controller.tacq
+        return kwargs
+
+    def continuous(self):
+        """Return True if the files are measured in a single run"""
+        noFiles = self.config['acquisition'].getint('noFiles')
+        return (self.config['acquisition'].getboolean('continuous')
+                and noFiles > 1
+                and self.controller.tacq * noFiles
+                <= self.controller.ACQTMAX)
+
+    def run(self):
+        """
+        Measure and sort all the files of the series
+
+        Returns
+        -------
+        nfiles : int
+            Number of files measured and saved
+
+        Raises
+        ------
+        Exception
+            The first error met by the sorting thread, if any
+        """
+        acquisition = self.config['acquisition']
+        noFiles = acquisition.getint('noFiles')
+        self.controller.tacq = int(acquisition.getfloat('acqTime') * 60000)
+        self.sorter.kwargs = self.sorterSettings()
+        rawFilebase = None
+        if acquisition.getboolean('saveRaw'):
+            rawFilebase = acquisition['filename'].rsplit(sep=".",
+                                                         maxsplit=1)[0]
+
+        sortingThread = threading.Thread(target=self._runSorter,
+                                         name='Pals3D sorter')
+        sortingThread.start()
+        nfiles = 0
+        try:
+            if self.continuous():
+                nfiles = self._runContinuous(noFiles, rawFilebase)
+            else:
+                for nof in range(noFiles):
+                    if self.stopped:
+                        break
+                    self._post(self.sorter.newMeasurement, nof)
+                    self.controller.rawFilename = None
+                    if rawFilebase is not None:
+                        self.controller.rawFilename = "".join(
+                                (rawFilebase, "_", str(nof).zfill(3),
+                                 RAW_EXTENSION))
+                        self.controller.rawHeaderInfo = {'noFile': nof,
+                                                         'nftot': noFiles}
+                    self.controller.startAcquisition()
+                    self._post(self.sorter.saveData, nof)
+                    nfiles += 1
+        finally:
+            self.commands.put(None)
+            sortingThread.join()
+            self.sorter.waitSaved()
+        if self._sorterErrors:
+            raise self._sorterErrors[0]
+        return nfiles
+
+    def _runContinuous(self, noFiles, rawFilebase):
+        """Measure all the files in a single run of the card"""
+        self._post(self.sorter.newMeasurement, 0)
+        self.controller.rawFilename = None
+        if rawFilebase is not None:
+            self.controller.rawFilename = rawFilebase + RAW_EXTENSION
+            self.controller.rawHeaderInfo = {'nftot': noFiles,
+                                             'fileTime':
+                                             self.controller.tacq}
+        self.controller.startAcquisition(noFiles)
+        if self.stopped:
+            self._post(self.sorter.closeFiles, -1)
+            return int(self.controller.elapsedTime.value
+                       // self.controller.tacq) + 1
+        self._post(self.sorter.closeFiles, noFiles - 1)
+        return noFiles
+
+    def stop(self):
+        """Stop the series after the current measurement"""
+        self.stopped = True
+        self.controller.requestStop()
+
+
+def runDevice(settings, devidx, stopEvent, status):
+    """
+    Main function of the process running the series of one device
+
+    Parameters
+    ----------
+    settings : dict
+        Options of each section of the settings of the device (see
+        cardConfig)
+    devidx : int
+        Index of the device
+    stopEvent : multiprocessing.Event
+        Set to stop the series
+    status : multiprocessing.Queue
+        Receives the pipeline statistics of the device as (devidx,
+        'stats', stats) and the end of the series as (devidx, 'done',
+        number of files) or (devidx, 'error', message)
+    """
+    # Ctrl+C is handled by the main process through stopEvent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read_dict(settings)
+    prefix = "[dev%d] " % devidx
+    runner = HeadlessAcquisition(
+            config, output=lambda text: print(
+                "\n".join(prefix + line
+                          for line in text.strip().splitlines()),
+                flush=True),
+            devidx=devidx)
+    runner.controller.STATS.connect(
+            lambda stats: status.put((devidx, 'stats', stats)))
+
+    def watchStop():
+        stopEvent.wait()
+        runner.stop()
+
+    threading.Thread(target=watchStop, daemon=True).start()
+    try:
+        runner.initDevice()
+        status.put((devidx, 'done', runner.run()))
+    except Exception as error:
+        traceback.print_exc()
+        status.put((devidx, 'error', str(error)))
+    finally:
+        runner.controller.closeDevices()
+
+
+class MultiDeviceAcquisition(object):
+    """
+    Series of acquisitions run in parallel on several devices
+
+    Each device is driven by its own process (see runDevice), with its
+    own reading loop, sorting thread and output files, so that the
+    devices do not compete for the interpreter lock. The pipeline
+    statistics of all the devices are gathered by the main process
+    and shown together (see formatCombinedStats).
+
+    Parameters
+    ----------
+    config : configparser.ConfigParser
+        Settings of the series (see readConfig and cardConfig)
+    devices : list of int
+        Indices of the devices
+    output : callable
+        Called with the combined statistics and the end of each series
+    """
+
+    STATS_INTERVAL = 1.0  #: float : Time between two combined statistics
+
+    def __init__(self, config, devices, output=print):
+        """Constructor of the MultiDeviceAcquisition class"""
+        self.config = config
+        self.devices = devices
+        self.output = output
+        context = mp.get_context('spawn')
+        self.stopEvent = context.Event()
+        self.status = context.Queue()
+        self.processes = dict(
+                (devidx, context.Process(
+                    target=runDevice,
+                    args=(dict((section, dict(options)) for section, options
+                               in cardConfig(config, devidx).items()
+                               if section != 'DEFAULT'),
+                          devidx, self.stopEvent, self.status),
+                    name='Pals3D dev%d' % devidx))
+                for devidx in devices)
+        self.stats = {}
+
+    def run(self, showStats=True):
+        """
+        Run the series of all the devices and wait for their end
+
+        Parameters
+        ----------
+        showStats : bool
+            Output the combined statistics every STATS_INTERVAL
+
+        Returns
+        -------
+        results : dict
+            Number of files saved by each device, or the error message
+            if its series failed
+        """
+        for process in self.processes.values():
+            process.start()
+        results = {}
+        lastStats = time.perf_counter()
+        while len(results) < len(self.processes):
+            try:
+                devidx, kind, value = self.status.get(
+                        timeout=self.STATS_INTERVAL)
+            except queue.Empty:
+                devidx = kind = None
+                for index, process in self.processes.items():
+                    if index not in results and not process.is_alive():
+                        results[index] = "process ended with code %s" \
+                                         % process.exitcode
+            if kind == 'stats':
+                self.stats[devidx] = value
+            elif kind in ('done', 'error'):
+                results[devidx] = value
+                self.output("dev%d: %s" % (devidx,
+                                           "%s file(s) saved" % value
+                                           if kind == 'done' else value))
+            if (showStats and self.stats and time.perf_counter()
+                    - lastStats >= self.STATS_INTERVAL):
+                self.output(formatCombinedStats(self.stats))
+                lastStats = time.perf_counter()
+        for process in self.processes.values():
+            process.join()
+        return results
+
+    def stop(self):
+        """Stop the series of all the devices"""
+        self.stopEvent.set()
+
+
+def main(argv=None):
+    """Command line entry point of the headless acquisition"""
+    parser = argparse.ArgumentParser(
+            description="Run a series of acquisitions without GUI, with "
+                        "the settings of a configuration file.")
+    parser.add_argument('config', help="configuration file (INI)")
+    parser.add_argument('--backend',
+                        help="'simulated' or the device library to be "
+                             "loaded (overrides the configuration file)")
+    parser.add_argument('--stats', action='store_true',
+                        help="print the pipeline statistics every second")
+    args = parser.parse_args(argv)
+
+    config = readConfig(args.config)
+    if args.backend is not None:
+        config['device']['backend'] = args.backend
+    lib = None
+    devices = [None]
+    if config['device']['devices'].strip():
+        lib = th260backend.loadLibrary(config['device']['backend'] or None)
+        devices = selectDevices(config, lib)
+    if not devices:
+        print("No device available.")
+        return
+    if len(devices) > 1:
+        multi = MultiDeviceAcquisition(config, devices)
+        signal.signal(signal.SIGINT, lambda signum, frame: multi.stop())
+        multi.run(args.stats)
+        return
+
+    runner = HeadlessAcquisition(config, lib, devidx=devices[0])
+    if args.stats:
+        runner.controller.STATS.connect(
+                lambda stats: print(formatStats(stats)))
+    signal.signal(signal.SIGINT, lambda signum, frame: runner.stop())
+    try:
+        runner.initDevice()
+        nfiles = runner.run()
+    finally:
+        runner.controller.closeDevices()
+    print("%d file(s) saved" % nfiles)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,434 @@
+# This file is part of Pals3D
+#
+# offlinesorter is meant to sort again raw T2 record files from a
+# PicoQuant TimeHarp 260 Pico with new settings, for applications to
+# positron annihilation lifetime spectroscopy.
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Usage (from the pals3D directory):
+#
+#   python -m th260.offlinesorter run_000.t2r --mode 3C --gate 10000 \
+#       --res 1000 --output resorted.hst
+#
+#   python -m th260.offlinesorter card0_000.t2r card1_000.t2r --merge \
+#       --offsets 0 -1200 --mode 2C --gate 10000
+#
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+from th260 import sortingcore
+from th260.coincidences import CoincidenceSet
+from th260.streammerger import StreamMerger, mergeRecords
+from th260.t2rawfile import readRawHeader, RAW_EXTENSION
+
+CHUNKSIZE = 1048576  #: int : Number of records sorted at once
+
+
+def openRawFile(filename):
+    """
+    Memory map the records of a raw record file
+
+    Parameters
+    ----------
+    filename : str
+        Name of the raw record file
+
+    Returns
+    -------
+    header : dict
+        Settings of the measurement stored in the file header
+    records : np.memmap of np.uint32
+        Read only view of all the records of the file
+    """
+    with open(filename, 'rb') as rawFile:
+        header, offset = readRawHeader(rawFile)
+    records = np.memmap(filename, dtype='<u4', mode='r', offset=offset)
+    return header, records
+
+
+def defaultOutputName(filename):
+    """
+    Build the output filename base used when none is given
+
+    run_003.t2r gives run_resorted.hst, so that the histogram file of
+    the resorted data is run_resorted_003.hst
+
+    Parameters
+    ----------
+    filename : str
+        Name of the raw record file
+    """
+    filebase = filename
+    if filebase.endswith(RAW_EXTENSION):
+        filebase = filebase[:-len(RAW_EXTENSION)]
+    head, sep, tail = filebase.rpartition("_")
+    if sep and tail.isdigit():
+        filebase = head
+    return filebase + "_resorted.hst"
+
+
+def _newWorker(header, sortingType, timeGate, timeRes, outputFile,
+               coincidences=None, markers=None):
+    """
+    Build a SortingCore with the settings of a raw record file
+
+    The records of a continuous acquisition (with a fileTime in their
+    header) are cut into files on the same timetag boundaries as during
+    the acquisition.
+    """
+    worker = sortingcore.SortingCore(sortingType=sortingType,
+                                     timeGate=timeGate,
+                                     timeRes=timeRes,
+                                     coincidences=coincidences,
+                                     markers=markers,
+                                     filename=outputFile,
+                                     CFDset=header['CFDset'],
+                                     acqTime=header['tacq']/60000,
+                                     nftot=header.get('nftot', 1),
+                                     fileTime=header.get('fileTime'))
+    worker.VERSION = header.get('version', 2)
+    return worker
+
+
+def _saveFiles(worker, header, noFile):
+    """Save the files of a worker once all the records are sorted"""
+    worker.processLastEvents()
+    if worker.fileTicks is None:
+        worker.saveData(noFile)
+    else:
+        worker.closeFiles(header.get('nftot', 1) - 1)
+    worker.waitSaved()
+
+
+def _sortRecords(worker, records, chunkSize):
+    """Sort records chunk after chunk, return the number of coincidences"""
+    ncoinc = [0]
+
+    def countCoinc(n):
+        ncoinc[0] += n
+
+    worker.COINCRATE.connect(countCoinc)
+    for start in range(0, records.size, chunkSize):
+        chunk = records[start:start+chunkSize]
+        worker.sortBuffer(chunk, chunk.size)
+    worker.COINCRATE.disconnect(countCoinc)
+    return ncoinc[0]
+
+
+def _partOverflow(filename, start, stop, chunkSize):
+    """Overflow correction of the records start:stop of a raw file"""
+    header, records = openRawFile(filename)
+    version = header.get('version', 2)
+    return sum(sortingcore.overflowCorrection(records[i:min(i+chunkSize,
+                                                           stop)],
+                                              version)
+               for i in range(start, stop, chunkSize))
+
+
+def _sortPart(filename, start, stop, oflcorrection, sortingType, timeGate,
+              timeRes, chunkSize, coincidences=None):
+    """
+    Sort the records start:stop of a raw record file
+
+    The events preceding the part are decoded from a look-behind window
+    covering at least one long gate (and two photons), which is grown
+    backward until it is long enough, and handed to the worker as the
+    events kept from a previous buffer. The coincidences with these
+    events are thus found exactly once, by the part they end in.
+
+    Returns
+    -------
+    counts : dict
+        Histogram counts of each channel pair
+    events : np.ndarray
+        Triple coincidence events (see th260.eventstore), None if not
+        in '3C' mode
+    ncoinc : int
+        Number of coincidence events of the part
+    """
+    header, records = openRawFile(filename)
+    worker = _newWorker(header, sortingType, timeGate, timeRes, None,
+                        coincidences)
+    worker.newMeasurement(0)
+
+    lookBehind = 4096
+    while start > 0:
+        first = max(start - lookBehind, 0)
+        behind = records[first:start]
+        lastOfl = oflcorrection - sortingcore.overflowCorrection(
+                behind, worker.VERSION)
+        channels, timeTags, _ = sortingcore.decodeT2Records(
+                behind, lastOfl, worker.VERSION)
+        if first == 0 or (timeTags.size >= 2 and timeTags[0]
+                          < timeTags[-1] - worker.timeGateTicks):
+            worker.setLastEvents(channels, timeTags)
+            break
+        lookBehind *= 2
+    worker.oflcorrection = oflcorrection
+
+    ncoinc = _sortRecords(worker, records[start:stop], chunkSize)
+    counts = dict((chnPair, histogram.counts)
+                  for chnPair, histogram in worker.histograms.items())
+    events = None
+    if worker.events is not None:
+        events = worker.events.toArray()
+    return counts, events, ncoinc
+
+
+def sortRawFile(filename, sortingType, timeGate, timeRes=None,
+                outputFile=None, chunkSize=CHUNKSIZE, output=print, jobs=1,
+                coincidences=None, markers=None):
+    """
+    Sort a raw record file and save the results
+
+    The records are memory mapped and sorted chunk after chunk by a
+    SortingCore, the events at the end of a chunk being carried over
+    to the next one, so that the file never needs to fit in memory.
+    The output files are the same as those of SortingCore.saveData.
+
+    With several jobs, the file is split into parts sorted in parallel
+    by a pool of processes. The overflow correction at the start of
+    each part is first obtained from the overflow records of the
+    previous parts, then each part is sorted with the events of one
+    long gate before it (see _sortPart). The histograms of the parts
+    are summed and their triple coincidence events concatenated in
+    order, so that the results are identical to a sequential sorting.
+    A part does not know the markers of the previous ones, nor the
+    file it starts in, so that the file is always sorted sequentially
+    with marker gating or for a continuous acquisition.
+
+    The records of a continuous acquisition (a single file for the
+    whole series) are cut into the same nftot files as during the
+    acquisition, see SortingCore.closeFiles.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the raw record file
+    sortingType : str
+        '2C', '2CW' or '3C'
+    timeGate : int
+        Long time gate for positron lifetime (in ps)
+    timeRes : int
+        Short time gate for 511 keV photons (in ps), only for '3C'
+    outputFile : str
+        Filename base for output files, see defaultOutputName if None
+    chunkSize : int
+        Number of records sorted at once
+    output : callable
+        Called with the messages of the sorter
+    jobs : int
+        Number of processes sorting the file in parallel
+    coincidences : str, optional
+        Coincidence definitions (see th260.coincidences), the preset of
+        the sortingType if None
+    markers : list of int, optional
+        Marker channels starting a new set of histograms (see
+        SortingCore.addMarkers), None for no marker gating
+
+    Returns
+    -------
+    ncoinc : int
+        Total number of coincidence events
+    """
+    header, records = openRawFile(filename)
+    if outputFile is None:
+        outputFile = defaultOutputName(filename)
+    noFile = header.get('noFile', 0)
+
+    worker = _newWorker(header, sortingType, timeGate, timeRes, outputFile,
+                        coincidences, markers)
+    worker.NEW_OUTPUT.connect(output)
+    worker.newMeasurement(noFile)
+
+    nparts = min(4 * jobs, -(-records.size // chunkSize))
+    if (jobs <= 1 or nparts <= 1 or markers
+            or worker.fileTicks is not None):
+        ncoinc = _sortRecords(worker, records, chunkSize)
+    else:
+        bounds = np.linspace(0, records.size, nparts + 1).astype(int)
+        starts, stops = bounds[:-1].tolist(), bounds[1:].tolist()
+        with ProcessPoolExecutor(jobs) as executor:
+            overflows = list(executor.map(
+                    _partOverflow, repeat(filename), starts, stops,
+                    repeat(chunkSize)))
+            oflcorrections = np.cumsum([0] + overflows[:-1]).tolist()
+            parts = list(executor.map(
+                    _sortPart, repeat(filename), starts, stops,
+                    oflcorrections, repeat(sortingType), repeat(timeGate),
+                    repeat(timeRes), repeat(chunkSize),
+                    repeat(coincidences)))
+        ncoinc = 0
+        for counts, events, n in parts:
+            for chnPair, histogram in worker.histograms.items():
+                histogram.counts += counts[chnPair]
+            if events is not None:
+                worker.events.append(events)
+            ncoinc += n
+    _saveFiles(worker, header, noFile)
+    output("{} records sorted, {} coincidence events"
+           .format(records.size, ncoinc))
+    return ncoinc
+
+
+def sortMergedFiles(filenames, sortingType, timeGate, timeRes=None,
+                    outputFile=None, offsets=None, chunkSize=CHUNKSIZE,
+                    output=print, coincidences=None):
+    """
+    Sort together the raw record files of several cards and save the
+    results
+
+    The files are the records of the same measurement saved by cards
+    sharing a common sync. Their events are merged in time order by a
+    StreamMerger, with the default channel map (see
+    th260.streammerger.defaultChannelMap), and sorted as a single
+    stream, chunk after chunk. The settings of the output files are
+    those of the first file, and the records of a continuous
+    acquisition are cut into files as in sortRawFile.
+
+    Parameters
+    ----------
+    filenames : list of str
+        Names of the raw record files, one per card
+    sortingType : str
+        '2C', '2CW' or '3C'
+    timeGate : int
+        Long time gate for positron lifetime (in ps)
+    timeRes : int
+        Short time gate for 511 keV photons (in ps), only for '3C'
+    outputFile : str
+        Filename base for output files, see defaultOutputName of the
+        first file if None
+    offsets : list of int, optional
+        Clock offset of each card (in ps), added to its timetags
+    chunkSize : int
+        Number of records of a file decoded at once
+    output : callable
+        Called with the messages of the sorter
+    coincidences : str, optional
+        Coincidence definitions (see th260.coincidences), the preset of
+        the sortingType if None, e.g. '0:1-2 0:3-4' for the triples of
+        two cards
+
+    Returns
+    -------
+    ncoinc : int
+        Total number of coincidence events
+    """
+    headers, recordStreams = zip(*[openRawFile(filename)
+                                   for filename in filenames])
+    if outputFile is None:
+        outputFile = defaultOutputName(filenames[0])
+    noFile = headers[0].get('noFile', 0)
+
+    worker = _newWorker(headers[0], sortingType, timeGate, timeRes,
+                        outputFile, coincidences)
+    worker.NEW_OUTPUT.connect(output)
+    worker.newMeasurement(noFile)
+    if offsets is not None:
+        offsets = [int(round(offset / worker.tick)) for offset in offsets]
+    merger = StreamMerger(len(filenames), offsets=offsets)
+
+    ncoinc = [0]
+
+    def countCoinc(n):
+        ncoinc[0] += n
+
+    worker.COINCRATE.connect(countCoinc)
+    versions = [header.get('version', 2) for header in headers]
+    for channels, timeTags in mergeRecords(merger, recordStreams, versions,
+                                           chunkSize):
+        worker.sortEvents(channels, timeTags)
+    worker.COINCRATE.disconnect(countCoinc)
+    _saveFiles(worker, headers[0], noFile)
+    output("{} records merged, {} late events dropped, {} coincidence "
+           "events".format(sum(records.size for records in recordStreams),
+                           merger.lateEvents, ncoinc[0]))
+    return ncoinc[0]
+
+
+def main(argv=None):
+    """Command line entry point of the offline sorter"""
+    parser = argparse.ArgumentParser(
+            description="Sort again raw T2 record files (.t2r) saved by "
+                        "Pals3D with new time gates.")
+    parser.add_argument('files', nargs='+', help="raw record files")
+    parser.add_argument('-m', '--mode', default='3C',
+                        choices=['2C', '2CW', '3C'],
+                        help="sorting type (default: 3C)")
+    parser.add_argument('-g', '--gate', type=int, required=True,
+                        help="long time gate (in ps)")
+    parser.add_argument('-r', '--res', type=int, default=None,
+                        help="short time gate for 511 keV photons (in ps),"
+                             " required in 3C mode")
+    parser.add_argument('-o', '--output', default=None,
+                        help="filename base for output files (default: "
+                             "<raw file base>_resorted.hst)")
+    parser.add_argument('--chunk', type=int, default=CHUNKSIZE,
+                        help="number of records sorted at once")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of processes sorting in parallel, "
+                             "0 for all cores (default: 1)")
+    parser.add_argument('--merge', action='store_true',
+                        help="sort the files together as the records of "
+                             "several cards sharing a common sync")
+    parser.add_argument('--offsets', type=int, nargs='+', default=None,
+                        help="clock offset of each merged file (in ps)")
+    parser.add_argument('-c', '--coincidences', default=None,
+                        help="coincidence definitions, e.g. '0>1 0>2 1-2' "
+                             "or '0:1-2@10000/1000 0:3-4' (default: preset "
+                             "of the sorting type)")
+    parser.add_argument('--markers', type=int, nargs='+', default=None,
+                        help="marker channels (1-15) starting a new set of "
+                             "histograms, sorted without parallel jobs")
+    args = parser.parse_args(argv)
+    try:
+        CoincidenceSet(args.coincidences, args.mode, args.gate, args.res)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.offsets is not None and (not args.merge or
+                                     len(args.offsets) != len(args.files)):
+        parser.error("--offsets needs --merge and one offset per file")
+    if args.markers is not None and (args.merge or not all(
+            1 <= marker <= 15 for marker in args.markers)):
+        parser.error("--markers needs marker channels between 1 and 15 "
+                     "and can not be used with --merge")
+
+    if args.merge:
+        print("Merging %s" % ", ".join(args.files))
+        sortMergedFiles(args.files, args.mode, args.gate, args.res,
+                        args.output, args.offsets, args.chunk,
+                        coincidences=args.coincidences)
+        return
+
+    for filename in args.files:
+        print("Sorting %s" % filename)
+        sortRawFile(filename, args.mode, args.gate, args.res, args.output,
+                    args.chunk, jobs=args.jobs or os.cpu_count(),
+                    coincidences=args.coincidences, markers=args.markers)
+
+
+if __name__ == '__main__':
+    main()
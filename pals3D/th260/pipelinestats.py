@@ -0,0 +1,266 @@
+# This file is part of Pals3D
+#
+# pipelinestats is meant to monitor each stage of the acquisition and
+# sorting pipeline of a PicoQuant TimeHarp 260 Pico for applications
+# to positron annihilation lifetime spectroscopy.
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+
+#: tuple : Counters updated by the sorter, sent back by a sorting process
+SORTER_COUNTERS = ('buffersSorted', 'decodedRecords', 'decodeNs',
+                   'sortNs', 'ncoinc', 'nsaves', 'lastSaveSeconds')
+
+
+class PipelineStats(object):
+    """
+    Counters and timings of each stage of the acquisition pipeline
+
+    The controller counts the FIFO reads (addRead) and the buffers
+    handed over to the sorter (addBuffer), the sorter times the
+    decoding and the coincidence sorting of each buffer (addDecode,
+    addSort) and the saving of the results (addSave). Each counter is
+    only updated by one thread, with a couple of clock readings per
+    buffer, so that the statistics can be left on in production.
+
+    The counters are cumulative, snapshot returns the values of the
+    interval since the previous snapshot (rates, time per record...)
+    together with the number of buffers waiting to be sorted.
+
+    Attributes
+    ----------
+    nreads : int
+        Number of ReadFiFo calls
+    nrecords : int
+        Number of records read
+    readNs : int
+        Time spent in ReadFiFo (in ns)
+    maxRecordsPerRead : int
+        Largest number of records of a read since the last snapshot
+    buffersEmitted : int
+        Number of buffers handed over to the sorter
+    buffersSorted : int
+        Number of buffers sorted
+    decodedRecords : int
+        Number of records decoded
+    decodeNs : int
+        Time spent decoding (in ns)
+    sortNs : int
+        Time spent sorting the coincidences and filling the
+        histograms (in ns)
+    ncoinc : int
+        Number of coincidence events
+    nsaves : int
+        Number of saveData calls
+    lastSaveSeconds : float
+        Duration of the last saveData call (in s)
+    queueDepth : int
+        Number of buffers in the hand-off queue (not yet given back to
+        the buffer pool)
+    queueHighWater : int
+        Largest queueDepth since the last snapshot
+    droppedRecords : int
+        Number of records dropped because the hand-off queue was full
+    spilledRecords : int
+        Number of records spilled to disk because the hand-off queue
+        was full
+    spillPending : int
+        Number of spilled records not yet handed over to the sorter
+    """
+
+    def __init__(self):
+        """Constructor of the PipelineStats class"""
+        self.reset()
+
+    def reset(self):
+        """Reset all the counters"""
+        self.nreads = 0
+        self.nrecords = 0
+        self.readNs = 0
+        self.maxRecordsPerRead = 0
+        self.buffersEmitted = 0
+        self.buffersSorted = 0
+        self.decodedRecords = 0
+        self.decodeNs = 0
+        self.sortNs = 0
+        self.ncoinc = 0
+        self.nsaves = 0
+        self.lastSaveSeconds = 0.
+        self.queueDepth = 0
+        self.queueHighWater = 0
+        self.droppedRecords = 0
+        self.spilledRecords = 0
+        self.spillPending = 0
+        self._last = self._counters()
+        self._lastTime = time.perf_counter()
+
+    def addRead(self, nrecords, ns):
+        """Count a ReadFiFo call of nrecords records lasting ns"""
+        self.nreads += 1
+        self.nrecords += nrecords
+        self.readNs += ns
+        if nrecords > self.maxRecordsPerRead:
+            self.maxRecordsPerRead = nrecords
+
+    def addBuffer(self):
+        """Count a buffer handed over to the sorter"""
+        self.buffersEmitted += 1
+
+    def updateQueue(self, depth, spillPending=0):
+        """Set the depth of the hand-off queue and the spilled records"""
+        self.queueDepth = depth
+        if depth > self.queueHighWater:
+            self.queueHighWater = depth
+        self.spillPending = spillPending
+
+    def addDrop(self, nrecords):
+        """Count nrecords records dropped"""
+        self.droppedRecords += nrecords
+
+    def addSpill(self, nrecords):
+        """Count nrecords records spilled to disk"""
+        self.spilledRecords += nrecords
+
+    def addDecode(self, nrecords, ns):
+        """Count nrecords records decoded in ns"""
+        self.decodedRecords += nrecords
+        self.decodeNs += ns
+
+    def addSort(self, ncoinc, ns):
+        """Count a buffer sorted in ns, giving ncoinc coincidences"""
+        self.buffersSorted += 1
+        self.ncoinc += ncoinc
+        self.sortNs += ns
+
+    def addSave(self, seconds):
+        """Count a saveData call lasting seconds"""
+        self.nsaves += 1
+        self.lastSaveSeconds = seconds
+
+    def sorterCounters(self):
+        """Return the counters updated by the sorter"""
+        return dict((name, getattr(self, name)) for name in SORTER_COUNTERS)
+
+    def updateSorterCounters(self, counters):
+        """Set the counters updated by a sorter running elsewhere"""
+        for name in SORTER_COUNTERS:
+            setattr(self, name, counters[name])
+
+    def _counters(self):
+        """Return the current values of the cumulative counters"""
+        return dict(nreads=self.nreads, nrecords=self.nrecords,
+                    readNs=self.readNs, decodedRecords=self.decodedRecords,
+                    decodeNs=self.decodeNs, sortNs=self.sortNs,
+                    ncoinc=self.ncoinc)
+
+    def snapshot(self):
+        """
+        Return the statistics of the interval since the last snapshot
+
+        Returns
+        -------
+        stats : dict
+            interval (s), recordsRead (total), recordsPerSecond,
+            recordsPerRead, maxRecordsPerRead, readNsPerCall,
+            pendingBuffers, queueDepth, queueHighWater,
+            droppedRecords (total), spilledRecords (total),
+            spillPending, decodeNsPerRecord, sortNsPerRecord,
+            coincidences (total), coincidencesPerSecond and
+            lastSaveSeconds
+        """
+        now = time.perf_counter()
+        interval = max(now - self._lastTime, 1e-9)
+        current = self._counters()
+        delta = dict((name, current[name] - self._last[name])
+                     for name in current)
+        stats = {'interval': interval,
+                 'recordsRead': self.nrecords,
+                 'recordsPerSecond': delta['nrecords'] / interval,
+                 'recordsPerRead': delta['nrecords'] / max(delta['nreads'],
+                                                           1),
+                 'maxRecordsPerRead': self.maxRecordsPerRead,
+                 'readNsPerCall': delta['readNs'] / max(delta['nreads'], 1),
+                 'pendingBuffers': self.buffersEmitted - self.buffersSorted,
+                 'queueDepth': self.queueDepth,
+                 'queueHighWater': max(self.queueHighWater,
+                                       self.queueDepth),
+                 'droppedRecords': self.droppedRecords,
+                 'spilledRecords': self.spilledRecords,
+                 'spillPending': self.spillPending,
+                 'decodeNsPerRecord': (delta['decodeNs']
+                                       / max(delta['decodedRecords'], 1)),
+                 'sortNsPerRecord': (delta['sortNs']
+                                     / max(delta['decodedRecords'], 1)),
+                 'coincidences': self.ncoinc,
+                 'coincidencesPerSecond': delta['ncoinc'] / interval,
+                 'lastSaveSeconds': self.lastSaveSeconds}
+        self._last = current
+        self._lastTime = now
+        self.maxRecordsPerRead = 0
+        self.queueHighWater = self.queueDepth
+        return stats
+
+
+def formatStats(stats):
+    """
+    Format a snapshot of PipelineStats as a single line for logging
+
+    Parameters
+    ----------
+    stats : dict
+        Statistics returned by PipelineStats.snapshot
+    """
+    return ("read {recordsPerSecond:.0f} rec/s ({recordsPerRead:.0f} rec/"
+            "read, max {maxRecordsPerRead}, {readNsPerCall:.0f} ns/read) | "
+            "pending {pendingBuffers} buffers | queue {queueDepth} (high "
+            "water {queueHighWater}) | dropped {droppedRecords} rec | "
+            "spilled {spilledRecords} rec ({spillPending} pending) | decode "
+            "{decodeNsPerRecord:.1f} ns/rec | sort {sortNsPerRecord:.1f} "
+            "ns/rec | {coincidencesPerSecond:.0f} coinc/s | last save "
+            "{lastSaveSeconds:.2f} s".format(**stats))
+
+
+def formatCombinedStats(statsByDevice):
+    """
+    Format the snapshots of the PipelineStats of several devices
+
+    Parameters
+    ----------
+    statsByDevice : dict
+        Statistics returned by PipelineStats.snapshot for each device
+        index
+
+    Returns
+    -------
+    text : str
+        One line per device and a line with the totals
+    """
+    lines = ["dev{} | read {recordsPerSecond:.0f} rec/s | pending "
+             "{pendingBuffers} buffers | queue high water "
+             "{queueHighWater} | dropped {droppedRecords} rec | "
+             "{coincidencesPerSecond:.0f} coinc/s".format(devidx, **stats)
+             for devidx, stats in sorted(statsByDevice.items())]
+    lines.append("all  | read {:.0f} rec/s | {:.0f} coinc/s".format(
+            sum(stats['recordsPerSecond']
+                for stats in statsByDevice.values()),
+            sum(stats['coincidencesPerSecond']
+                for stats in statsByDevice.values())))
+    return "\n".join(lines)
@@ -0,0 +1,107 @@
+# This file is part of Pals3D
+#
+# signals is meant to provide a Qt-free replacement of the Qt signals,
+# so that the acquisition and sorting cores of Pals3D can run without
+# PyQt5 (headless acquisition, batch sorting, tests...).
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+
+_lock = threading.Lock()  # creation of the BoundSignal of an instance
+
+
+class Signal(object):
+    """
+    Class attribute declaring a signal, like QtCore.pyqtSignal
+
+    Each instance of the class gets its own BoundSignal, with the
+    connect, disconnect and emit methods of a bound pyqtSignal. A Qt
+    class deriving from a class using Signal can override the signals
+    with pyqtSignal attributes of the same names.
+
+    Parameters
+    ----------
+    types : type
+        Types of the arguments of the signal (documentation only)
+    """
+
+    def __init__(self, *types):
+        """Constructor of the Signal class"""
+        self.types = types
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        with _lock:
+            return instance.__dict__.setdefault(self.name, BoundSignal())
+
+
+class BoundSignal(object):
+    """
+    Signal of an instance
+
+    The connected callables are called at once by emit, in the
+    emitting thread (as with a Qt.DirectConnection).
+    """
+
+    def __init__(self):
+        """Constructor of the BoundSignal class"""
+        self._slots = []
+
+    def connect(self, slot, connectionType=None):
+        """
+        Connect a callable to the signal
+
+        Parameters
+        ----------
+        slot : callable
+            Called with the arguments of emit
+        connectionType : object
+            Ignored, for compatibility with pyqtSignal.connect
+        """
+        self._slots = self._slots + [slot]
+
+    def disconnect(self, slot=None):
+        """
+        Disconnect a callable, or all of them if slot is None
+
+        Raises
+        ------
+        TypeError
+            If slot is not connected
+        """
+        if slot is None:
+            self._slots = []
+        elif slot in self._slots:
+            slots = list(self._slots)
+            slots.remove(slot)
+            self._slots = slots
+        else:
+            raise TypeError("%r is not connected" % (slot,))
+
+    def emit(self, *args):
+        """Call the connected callables with args"""
+        for slot in self._slots:
+            slot(*args)
@@ -0,0 +1,1186 @@
+# This file is part of Pals3D
+#
+# sortingcore is meant to sort data from a PicoQuant TimeHarp 260 Pico
+# via TH260LIB.DLL v 3.1. for applications to positron annihilation
+# lifetime spectroscopy, without any dependency on Qt (see th260sorter
+# for the Qt worker of the GUI application).
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest 
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Based on demo code from:
+# Keno Goertz, PicoQuant GmbH, February 2018
+#
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from th260.coincidences import CoincidenceSet, BINWIDTH
+from th260.eventstore import EventStore
+from th260.pipelinestats import PipelineStats
+from th260.signals import Signal
+
+T2WRAPAROUND_V1 = 33552000  #: int : Wraparound for version 1
+T2WRAPAROUND_V2 = 33554432  #: int : Wraparound for version 2
+NCHANNELS = 65  #: int : Sync + 64 input channels of the T2 records
+#: Channel bits of the T2 records of each channel number: special bit
+#: for the sync (0), channel - 1 for the input channels
+T2_CHANNEL_CODES = np.array([0x80000000] + [c << 25 for c in range(64)],
+                            dtype=np.uint32)
+
+def decodeT2Records(records, oflcorrection=0, version=2, markers=False):
+    """
+    Decode a whole buffer of T2 records at once
+
+    Each 32 bits record is split with bit masks and shifts into the
+    special bit (bit 31), the channel (bits 25-30) and the timetag
+    (bits 0-24). The overflow correction is obtained as the cumulative
+    sum of the overflow records, so that the photon events are
+    identical to a record by record decoding.
+
+    Parameters
+    ----------
+    records : np.ndarray of np.uint32
+        Raw T2 records as read from the TH260 FIFO
+    oflcorrection : int
+        Overflow correction (in ticks) accumulated before the first
+        record of the buffer
+    version : int
+        T2 record format version (1 or 2)
+    markers : bool
+        Also return the marker records if True
+
+    Returns
+    -------
+    channels : np.ndarray of np.int64
+        Channel number of each photon: 0 (sync), 1-2 (channel)
+    timeTags : np.ndarray of np.int64
+        Timetags corrected by the overflow tags with respect to the
+        overall measurement start (tick resolution 25 ps)
+    oflcorrection : int
+        Overflow correction to be used for the next buffer
+    markerChannels : np.ndarray of np.int64
+        Marker channel of each marker record (1-15), only if markers
+    markerTimes : np.ndarray of np.int64
+        Corrected timetag of each marker record, only if markers
+    """
+    records = np.asarray(records, dtype=np.uint32)
+    special = (records >> 31).astype(bool)
+    channel = ((records >> 25) & 0x3F).astype(np.int64)
+    timetag = (records & 0x1FFFFFF).astype(np.int64)
+
+    isOverflow = special & (channel == 0x3F)
+    if version == 1:
+        wraps = isOverflow * T2WRAPAROUND_V1
+    else:
+        # timetag == 0 is an old style single overflow (shouldn't happen)
+        wraps = isOverflow * T2WRAPAROUND_V2 * np.maximum(timetag, 1)
+    truetime = np.cumsum(wraps) + oflcorrection
+    if truetime.size > 0:
+        oflcorrection = int(truetime[-1])
+    truetime += timetag
+
+    # markers (special, channel 1-15) are not photon events
+    isPhoton = ~special | (channel == 0)
+    channels = np.where(special, 0, channel + 1)[isPhoton]
+    timeTags = truetime[isPhoton]
+    if markers:
+        isMarker = special & (channel >= 1) & (channel <= 15)
+        return (channels, timeTags, oflcorrection, channel[isMarker],
+                truetime[isMarker])
+    return channels, timeTags, oflcorrection
+
+
+def encodeT2Records(channels, timeTags, oflcorrection=0):
+    """
+    Encode photon events into T2 records (version 2)
+
+    Inverse of decodeT2Records: an overflow record is inserted before
+    each event whose timetag does not fit in the current overflow
+    period, so that decoding the records gives back the events.
+
+    Parameters
+    ----------
+    channels : np.ndarray of int
+        Channel number of each photon: 0 (sync), 1-2 (channel)
+    timeTags : np.ndarray of int
+        Timetags of the photons with respect to the overall measurement
+        start (in ticks), in increasing order
+    oflcorrection : int
+        Overflow correction (in ticks) of the records already encoded
+
+    Returns
+    -------
+    records : np.ndarray of np.uint32
+        T2 records
+    oflcorrection : int
+        Overflow correction to be used for the next events
+    """
+    channels = np.asarray(channels, dtype=np.intp)
+    timeTags = np.asarray(timeTags, dtype=np.int64)
+    if timeTags.size == 0:
+        return np.empty(0, dtype=np.uint32), oflcorrection
+    # T2WRAPAROUND_V2 = 2**25: the overflow periods are the upper bits
+    wraps = timeTags >> 25
+    records = (T2_CHANNEL_CODES[channels]
+               | (timeTags & 0x1FFFFFF).astype(np.uint32))
+    jumps = np.diff(wraps, prepend=oflcorrection >> 25)
+    isJump = np.flatnonzero(jumps > 0)
+    records = np.insert(records, isJump,
+                        0xFE000000 | jumps[isJump].astype(np.uint32))
+    oflcorrection = int(wraps[-1]) << 25
+    return records, oflcorrection
+
+
+def overflowCorrection(records, version=2):
+    """
+    Total overflow correction of a buffer of T2 records
+
+    This is the oflcorrection increment decodeT2Records would return
+    for the buffer, computed without decoding the photon events.
+
+    Parameters
+    ----------
+    records : np.ndarray of np.uint32
+        Raw T2 records as read from the TH260 FIFO
+    version : int
+        T2 record format version (1 or 2)
+
+    Returns
+    -------
+    oflcorrection : int
+        Sum of the overflows of the buffer (in ticks)
+    """
+    records = np.asarray(records, dtype=np.uint32)
+    # special bit and channel 0x3F
+    isOverflow = (records >> 25) == 0x7F
+    if version == 1:
+        return int(np.count_nonzero(isOverflow)) * T2WRAPAROUND_V1
+    timetag = (records[isOverflow] & 0x1FFFFFF).astype(np.int64)
+    return int(np.maximum(timetag, 1).sum()) * T2WRAPAROUND_V2
+
+
+def overflowRecords(noverflows):
+    """
+    T2 records (version 2) standing for a number of overflows
+
+    Used to keep the timetags of a record stream right when records
+    are left out of it (e.g. dropped buffers).
+
+    Parameters
+    ----------
+    noverflows : int
+        Number of overflows, larger than 0
+
+    Returns
+    -------
+    records : np.ndarray of np.uint32
+        Overflow records of the noverflows overflows
+    """
+    maxCount = 0x1FFFFFF
+    counts = np.full(-(-noverflows // maxCount), maxCount, dtype=np.uint32)
+    counts[-1] = noverflows - maxCount*(counts.size - 1)
+    # special bit and channel 0x3F
+    return counts | np.uint32(0xFE000000)
+
+
+class HistogramAccumulator(object):
+    """
+    Fixed size integer histogram filled incrementally from tick counts
+
+    The counts are accumulated batch after batch, so that the memory
+    used does not depend on the number of events. The bins are
+    centered on firstCenter + k*binWidth (in ps) and the bin of each
+    value is computed exactly with integer arithmetic, so that the
+    histogram is the same as np.histogram with the edges
+    firstCenter + (k - 1/2)*binWidth.
+
+    Parameters
+    ----------
+    firstCenter : int
+        Center of the first bin (in ps)
+    nbins : int
+        Number of bins
+    binWidth : int
+        Width of the bins (in ps)
+    tick : int
+        Duration of a tick of the values to be histogrammed (in ps)
+    counts : np.ndarray of np.int64, optional
+        Array the counts are accumulated into (e.g. a slice of the
+        counts of all the histograms), a new one if None
+
+    Attributes
+    ----------
+    counts : np.ndarray of np.int64
+        Number of events in each bin
+    """
+
+    def __init__(self, firstCenter, nbins, binWidth=25, tick=25,
+                 counts=None):
+        """Constructor of the HistogramAccumulator class"""
+        self.firstCenter = firstCenter
+        self.binWidth = binWidth
+        self.tick = tick
+        if counts is None:
+            counts = np.zeros(nbins, dtype=np.int64)
+        self.counts = counts
+
+    def fill(self, ticks):
+        """
+        Add values to the histogram
+
+        Parameters
+        ----------
+        ticks : np.ndarray of int
+            Values to be histogrammed (in ticks), values out of the
+            histogram range are ignored
+        """
+        # twice the distance to the left edge of the first bin, in ps
+        idx = ((2*(ticks*self.tick - self.firstCenter) + self.binWidth)
+               // (2*self.binWidth))
+        idx = idx[(idx >= 0) & (idx < self.counts.size)]
+        self.counts += np.bincount(idx, minlength=self.counts.size)
+
+    def binCenters(self):
+        """Return the center of each bin (in ps)"""
+        return self.firstCenter + self.binWidth*np.arange(self.counts.size)
+
+
+class SortingCore(object):
+    """
+    Data sorting class for data received from a TH260 PicoQuant card
+
+    The signals are th260.signals.Signal attributes, whose slots are
+    called at once in the thread of the sorting: no Qt event loop is
+    needed, e.g. in batch sorting or in a headless acquisition (see
+    th260sorter.SortingWorker for the Qt worker of the GUI).
+
+    Parameters
+    ----------
+    kwargs : kwargs
+        Keyword arguments passed from the main thread
+
+    Attributes
+    ----------
+    coincidences : CoincidenceSet
+        Coincidence definitions compiled into lookup tables
+    histograms : dict
+        HistogramAccumulator of each channel pair of the definitions,
+        views of the counts array
+    counts : np.ndarray of np.int64
+        Counts of all the histograms
+    markerTimes : np.ndarray of np.int64
+        Timetags of the markers of the markers channels since the start
+        of the measurement (in ticks), None without marker gating
+    intervalCounts : np.ndarray of np.int64
+        Counts of all the histograms of each marker interval of the
+        current file, from the interval firstInterval (see addMarkers)
+    firstInterval : int
+        Number of the marker interval the current file starts in
+    events : EventStore
+        Time differences of the triple coincidence events of the
+        current file, written to its .npy file as they are sorted (only
+        in '3C' mode, None otherwise)
+    lastChannels : np.ndarray
+    lastTimes : np.ndarray
+    globRes : double
+    tick : int
+        Duration of a tick (in ps), computed from globRes
+    stats : PipelineStats
+        Decoding, sorting and saving counters, may be shared with the
+        controller
+    writer : concurrent.futures.ThreadPoolExecutor
+        Writer thread of the output files (see saveData)
+
+    Keyword Args
+    ------------
+    sortingType : str
+        '2C', '2CW' (all pairs in the time gate) or '3C'
+    timeGate : int
+        Long time gate for positron lifetime (in ps)
+    timeRes : int
+        Short time gate for 511 MeV photons (in ps)
+    coincidences : str or list, optional
+        Coincidence definitions (see th260.coincidences), the preset of
+        the sortingType if None or missing
+    filename : str
+        Filename base for output file
+    CFDset : dict
+        Dictionnary of all the CFD settings for all channels
+    acqTime : int
+        Acquisition time (in min)
+    nftot : int
+        Total number of files during current measurement
+    fileTime : int, optional
+        Duration of each file (in ms) in continuous acquisition mode:
+        the files of the series are then cut from a single measurement
+        according to the event timetags (see closeFiles). None or
+        missing for one measurement per file.
+    markers : sequence of int, optional
+        Marker channels (1-15) whose markers start a new marker
+        interval: the coincidences are then also sorted into one set
+        of histograms per interval (see addMarkers). None or missing
+        for no marker gating.
+
+    """
+
+    COINCRATE = Signal(int)  #: :obj:Signal(int)
+    NEW_OUTPUT = Signal(str)  #: :obj:Signal(str)
+    #: :obj:Signal(object) Raw data buffer given back to its owner
+    #: (e.g. the buffer pool of TH260Controller) once decoded
+    BUFFER_DONE = Signal(object)
+    #: :obj:Signal(int) Number of the file just saved, in continuous
+    #: acquisition mode
+    FILE_DONE = Signal(int)
+    #: :obj:Signal(str) Filename base of the output files written in
+    #: the background by saveData
+    SAVED = Signal(str)
+    #: :obj:Signal(str) Error met while writing the output files
+    SAVE_ERROR = Signal(str)
+
+    T2WRAPAROUND_V1 = T2WRAPAROUND_V1  #: int : Wraparound for version 1
+    T2WRAPAROUND_V2 = T2WRAPAROUND_V2  #: int : Wraparound for version 2
+    VERSION = 2  #: int: Version ==> remove?
+
+    def __init__(self, **kwargs):
+        """Constructor method of the SortingCore class"""
+        super(SortingCore, self).__init__()
+        self.kwargs = kwargs
+        self.globRes = 25.0e-12
+        self.tick = int(round(self.globRes * 1e12))
+        self.histograms = dict()
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.markers = None
+        self.markerTimes = None
+        self.intervalCounts = None
+        self.firstInterval = 0
+        self.events = None
+        self._eventsSaved = False
+
+        self.lastChannels = np.empty(0, dtype=np.int64)
+        self.lastTimes = np.empty(0, dtype=np.int64)
+        self.stats = PipelineStats()
+        # a single writer keeps the files written in order
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self._saveErrors = []
+
+    def newMeasurement(self, noFile):
+        """
+        Initialise class attributes for new measurement
+
+        Parameters
+        ----------
+        noFile : int
+            File numero in case of multiple file acquisition
+
+        """
+
+        self.sortingType = self.kwargs["sortingType"]
+        self.timeGate = self.kwargs["timeGate"]
+        self.timeRes = self.kwargs["timeRes"]
+        self.file = self.kwargs["filename"]
+        self.cfd = self.kwargs["CFDset"]
+        self.oflcorrection = 0
+        self.lastChannels = np.empty(0, dtype=np.int64)
+        self.lastTimes = np.empty(0, dtype=np.int64)
+
+        self.coincidences = CoincidenceSet(
+                self.kwargs.get("coincidences"), self.sortingType,
+                self.timeGate, self.timeRes, self.tick, NCHANNELS)
+        # longest gate in ticks, the events kept for the next buffer
+        # depend on it
+        self.timeGateTicks = self.coincidences.maxGateTicks
+
+        # Marker gating: intervals numbered from the measurement start
+        self.markers = self.kwargs.get("markers") or None
+        self.markerTimes = None
+        if self.markers is not None:
+            self.markerTimes = np.empty(0, dtype=np.int64)
+
+        # Continuous mode: file noFile ends at the fileEnd tick
+        self.noFile = noFile
+        fileTime = self.kwargs.get("fileTime")
+        if fileTime is None:
+            self.fileTicks = self.fileEnd = None
+        else:
+            self.fileTicks = int(round(fileTime * 1e9 / self.tick))
+            self.fileEnd = (noFile + 1) * self.fileTicks
+        self._resetHistograms()
+
+    def _resetHistograms(self):
+        """Empty the histograms and the triple coincidence events"""
+        self._newEventStore()
+        coinc = self.coincidences
+        self.counts = np.zeros(coinc.nbins.sum(), dtype=np.int64)
+        if self.markerTimes is not None:
+            # interval of the first tick of the file
+            self.firstInterval = int(np.searchsorted(
+                    self.markerTimes, self._fileStart(), side='right'))
+            self.intervalCounts = np.zeros((1, self.counts.size),
+                                           dtype=np.int64)
+        self.histograms = dict(
+                (name, HistogramAccumulator(
+                        int(first), int(nbins), BINWIDTH, self.tick,
+                        self.counts[offset:offset+nbins]))
+                for name, first, nbins, offset
+                in zip(coinc.histogramNames, coinc.firstCenters,
+                       coinc.nbins, coinc.offsets))
+
+    def _newEventStore(self):
+        """
+        Open the event store of the current file ('3C' mode)
+
+        A saved store is closed by the writer thread, which is waited
+        for only if the new store reuses its file. A store which was
+        never saved is closed at once.
+        """
+        previous = self.events
+        self.events = None
+        filename = None
+        if self.file is not None:
+            filename = self._outputFileName(self.noFile) + '.npy'
+        if previous is not None and not previous.closed:
+            if not self._eventsSaved:
+                previous.close()
+            elif previous.filename == filename:
+                self.writer.submit(lambda: None).result()
+        self._eventsSaved = False
+        dtype = self.coincidences.eventDtype
+        if dtype is not None:
+            if self.markers is not None:
+                dtype = np.dtype(dtype.descr + [('interval', '<u4')])
+            self.events = EventStore(filename, dtype=dtype)
+
+    def _fileStart(self):
+        """First tick of the current file"""
+        if self.fileEnd is None:
+            return 0
+        return self.fileEnd - self.fileTicks
+
+    def addMarkers(self, channels, timeTags):
+        """
+        Add the markers preceding the next events to sort
+
+        The markers of the marker channels start a new marker interval:
+        the coincidences are sorted into the histograms of the interval
+        of their last event, given by the number of markers before it.
+        Called by sortBuffer with the markers of the buffer, before its
+        events are sorted. Does nothing without marker gating.
+
+        Parameters
+        ----------
+        channels : np.ndarray
+            Marker channel of the markers (1-15)
+        timeTags : np.ndarray
+            Timetags of the markers (in ticks), in increasing order
+        """
+        if self.markerTimes is None or timeTags.size == 0:
+            return
+        timeTags = timeTags[np.isin(channels, self.markers)]
+        for interval, timeTag in enumerate(timeTags,
+                                           self.markerTimes.size + 1):
+            self.NEW_OUTPUT.emit("Marker interval %d starts at %.6f s"
+                                 % (interval, timeTag * self.tick * 1e-12))
+        self.markerTimes = np.concatenate((self.markerTimes, timeTags))
+
+    def _intervals(self, timeTags, index):
+        """
+        Return the marker interval of some events, counted from
+        firstInterval
+
+        The interval sets of histograms are added as needed.
+
+        Parameters
+        ----------
+        timeTags : np.ndarray
+            Timetags of all the events being sorted (in ticks), in
+            increasing order
+        index : slice or np.ndarray
+            Index of the events in timeTags, e.g. the last event of
+            each coincidence
+
+        Returns
+        -------
+        intervals : int or np.ndarray
+            Interval of each event, or of all of them when no marker
+            falls among the timeTags (the usual case, which is faster)
+            or without marker gating (None)
+        """
+        if self.markerTimes is None:
+            return None
+        if timeTags.size == 0:
+            return 0
+        first, last = np.searchsorted(self.markerTimes, timeTags[[0, -1]],
+                                      side='right') - self.firstInterval
+        if first == last:
+            self._growIntervals(int(last) + 1)
+            return int(last)
+        intervals = np.searchsorted(self.markerTimes, timeTags[index],
+                                    side='right')
+        intervals -= self.firstInterval
+        self._growIntervals(int(last) + 1)
+        return intervals
+
+    def _growIntervals(self, nintervals):
+        """Add empty interval sets of histograms up to nintervals"""
+        missing = nintervals - self.intervalCounts.shape[0]
+        if missing > 0:
+            self.intervalCounts = np.concatenate(
+                    (self.intervalCounts,
+                     np.zeros((missing, self.counts.size), dtype=np.int64)))
+
+    def saveData(self, noFile, **kwargs):
+        """
+        Save the histograms of the whole data set to files
+
+        A frozen snapshot of the histograms (and of the triple
+        coincidence events) is taken and written to the files in the
+        background by the writer thread, so that the sorting can go on
+        at once. SAVED is emitted once the files are written, and
+        SAVE_ERROR if writing them failed (see also waitSaved).
+
+        Parameters
+        ----------
+        noFile : int
+            Numero of the current acquisition file to be appended to
+            the filename base.
+        """
+
+        self.NEW_OUTPUT.emit("Saving data...")
+        outputFileName = self._outputFileName(noFile)
+
+        histos, labels = self._histogramTable(self.counts)
+        if self.kwargs.get("coincidences"):
+            settings = "\nCoincidences: " + self.coincidences.spec
+        else:
+            settings = ""
+        header = ("Measurement date : {0}"
+                  "\nCFD settings:"
+                  "\nChannel |\tCFD ZeroCross |\tCFD level |\tOffset"
+                  "\nSync \t {z0} mV \t {l0} mV \t{o0} ps"
+                  "\nChn1 \t {z1} mV \t {l1} mV \t{o1} ps"
+                  "\nChn2 \t {z2} mV \t {l2} mV \t{o2} ps"
+                  "\nAcquisition settings:"
+                  "\nMode: {m} |\t long gate: {lg} ps \t"
+                  "|\t short gate: {sg} ps"
+                  "\nAcquisition time: {at:.0f} min \t"
+                  "|\t file #{nf} out of {nftot}{cs}"
+                  .format(time.asctime(),
+                          z0=self.cfd['zero0'],
+                          l0=self.cfd['lev0'],
+                          o0=self.cfd['off0'],
+                          z1=self.cfd['zero1'],
+                          l1=self.cfd['lev1'],
+                          o1=self.cfd['off1'],
+                          z2=self.cfd['zero2'],
+                          l2=self.cfd['lev2'],
+                          o2=self.cfd['off2'],
+                          m=self.sortingType,
+                          lg=self.timeGate,
+                          sg=self.timeRes,
+                          at=self.kwargs['acqTime'],
+                          nf=noFile+1,
+                          nftot=self.kwargs['nftot'],
+                          cs=settings))
+        tables = [(outputFileName, histos, header + "\n\n" + labels)]
+
+        # One more file per marker interval started before the end of
+        # the file, e.g. run_000_m002.hst
+        if self.markerTimes is not None:
+            nmarkers = self.markerTimes.size
+            if self.fileEnd is not None:
+                nmarkers = int(np.searchsorted(self.markerTimes,
+                                               self.fileEnd))
+            self._growIntervals(nmarkers - self.firstInterval + 1)
+            for k, counts in enumerate(self.intervalCounts):
+                interval = self.firstInterval + k
+                limits = ["start", "end"]
+                for i, marker in enumerate((interval - 1, interval)):
+                    if 0 <= marker < self.markerTimes.size:
+                        limits[i] = "%.6f s" % (self.markerTimes[marker]
+                                                * self.tick * 1e-12)
+                histos, labels = self._histogramTable(counts)
+                tables.append(("%s_m%03d" % (outputFileName, interval),
+                               histos,
+                               "%s\nMarker interval: %d |\t from %s to %s"
+                               "\n\n%s" % (header, interval, limits[0],
+                                            limits[1], labels)))
+
+        future = self.writer.submit(self._writeFiles, outputFileName,
+                                    tables, self.events)
+        self._eventsSaved = True
+        future.add_done_callback(self._saveDone)
+
+    def _histogramTable(self, counts):
+        """
+        Return the columns of the .hst file of a set of histograms
+
+        The histograms with the same bins share a time column, e.g. in
+        the 2C mode:
+        bincenters01/02  histo01  histo02  bincenters12  histo12
+        The shorter columns are completed with empty bins.
+
+        Parameters
+        ----------
+        counts : np.ndarray
+            Counts of all the histograms (see counts)
+
+        Returns
+        -------
+        histos : np.ndarray
+            Bin centers and counts of the histograms, one row per column
+        labels : str
+            Column labels of the file header
+        """
+        coinc = self.coincidences
+        groups = {}
+        for label, firstCenter, nbins, offset in zip(
+                coinc.histogramLabels(), coinc.firstCenters, coinc.nbins,
+                coinc.offsets):
+            groups.setdefault((firstCenter, nbins), []).append(
+                    (label, counts[offset:offset+nbins]))
+        columns = []
+        labels = []
+        for (firstCenter, _), group in groups.items():
+            columns.append((firstCenter, None))
+            labels.append("time")
+            for label, histogram in group:
+                columns.append((None, histogram))
+                labels.append(label)
+        nrows = int(coinc.nbins.max())
+        histos = np.zeros((len(columns), nrows), dtype=np.int64)
+        for row, (firstCenter, histogram) in zip(histos, columns):
+            if histogram is None:
+                row[:] = firstCenter + BINWIDTH*np.arange(nrows)
+            else:
+                row[:histogram.size] = histogram
+        return histos, labels[0] + "\t" + " \t ".join(labels[1:])
+
+    def _outputFileName(self, noFile):
+        """Return the filename base of the output files of file noFile"""
+        try:
+            filebase, extension = self.file.rsplit(sep=".", maxsplit=1)
+        except ValueError:
+            filebase = self.file
+        return "".join((filebase, "_", str(noFile).zfill(3)))
+
+    def _writeFiles(self, outputFileName, tables, events):
+        """
+        Write the output files of a snapshot, in the writer thread
+
+        Parameters
+        ----------
+        outputFileName : str
+            Filename base of the output files
+        tables : list of tuple
+            Filename base, bin centers and counts of the histograms
+            (see _histogramTable) and header of each histogram file
+        events : EventStore
+            Triple coincidence events, None if not in '3C' mode
+
+        Returns
+        -------
+        outputFileName : str
+            Filename base of the output files
+        """
+        start = time.perf_counter()
+        # Saving raw dT for each channel for triple coinc mode
+        if events is not None:
+            if events.filename is None:
+                np.save(outputFileName, events.toArray())
+            else:
+                events.close()
+                if events.filename != outputFileName + '.npy':
+                    os.replace(events.filename, outputFileName + '.npy')
+        for filename, histos, header in tables:
+            np.savetxt(filename+'.hst', histos.T, fmt='%10i',
+                       header=header, comments='#', delimiter='\t')
+        self.stats.addSave(time.perf_counter() - start)
+        return outputFileName
+
+    def _saveDone(self, future):
+        """Report the end of the writing of a snapshot"""
+        error = future.exception()
+        if error is None:
+            self.NEW_OUTPUT.emit("Data saved to %s" % future.result())
+            self.SAVED.emit(future.result())
+        else:
+            self._saveErrors.append(error)
+            self.NEW_OUTPUT.emit("Saving data failed: %s" % error)
+            self.SAVE_ERROR.emit(str(error))
+
+    def waitSaved(self):
+        """
+        Wait until all the snapshots are written to their files
+
+        Raises
+        ------
+        OSError
+            The first error met while writing the files since the last
+            call, if any
+        """
+        self.writer.submit(lambda: None).result()
+        if self._saveErrors:
+            error = self._saveErrors[0]
+            self._saveErrors = []
+            raise error
+
+    def _nextFile(self):
+        """
+        Save the current file and start the next one of the series
+
+        Only the histograms are reset: the overflow correction and the
+        events kept for the next buffer go on, so that the coincidences
+        across the file boundary are not lost. Each coincidence is
+        counted in the file of its last event.
+        """
+        self.saveData(self.noFile)
+        self.FILE_DONE.emit(self.noFile)
+        self.noFile += 1
+        self.fileEnd += self.fileTicks
+        self._resetHistograms()
+
+    def closeFiles(self, lastFile=-1):
+        """
+        Save the last files of a continuous acquisition
+
+        Parameters
+        ----------
+        lastFile : int
+            Number of the last file of the series. The files with no
+            event after the current one are also saved (empty), up to
+            lastFile. Only the current file is saved if lastFile is
+            smaller (e.g. -1 when the acquisition was stopped).
+        """
+        while self.noFile < lastFile:
+            self._nextFile()
+        self.saveData(self.noFile)
+        self.FILE_DONE.emit(self.noFile)
+
+    def processLastEvents(self):
+        """
+        Discard the events kept for the next buffer at the end of an
+        acquisition
+
+        All the coincidences are already sorted buffer by buffer, the
+        last events can not form a coincidence with any later event.
+        """
+
+        self.lastChannels = np.empty(0, dtype=np.int64)
+        self.lastTimes = np.empty(0, dtype=np.int64)
+
+    def setLastEvents(self, channels, timeTags):
+        """
+        Set the events preceding the next buffer
+
+        Only the events the sorting engine would have kept after
+        sorting channels and timeTags are kept, so that the next buffer
+        is sorted exactly as if it had followed them. Used to start
+        sorting in the middle of a record stream, no coincidence is
+        searched among the given events.
+
+        Parameters
+        ----------
+        channels : np.ndarray
+            Channel number of the photon events
+        timeTags : np.ndarray
+            Timetags of the photon events (in ticks), in increasing order
+        """
+
+        if self.sortingType == '2CW':
+            keep = 0
+            if timeTags.size > 0:
+                keep = np.searchsorted(timeTags,
+                                       timeTags[-1] - self.timeGateTicks,
+                                       side='left')
+        elif self.sortingType == '3C':
+            keep = max(timeTags.size - 2, 0)
+        else:
+            keep = max(timeTags.size - 1, 0)
+        self.lastChannels = np.asarray(channels[keep:], dtype=np.int64)
+        self.lastTimes = np.asarray(timeTags[keep:], dtype=np.int64)
+
+    def _2Cfiltering(self, channels, timeTags):
+        """
+        Process the events into double coincidence events
+
+        Look at each pair of successive photons at once with array
+        operations and determine if they are recorded in the timeGate
+        time interval, and if they are issued from different channels.
+        If so, fill the time difference into the corresponding
+        histogram (see _storePairs).
+
+        The last event is kept to be paired with the first event of
+        the next buffer.
+
+        Parameters
+        ----------
+        channels : np.ndarray
+            Channel number of the photon events
+        timeTags : np.ndarray
+            Timetags of the photon events (in ticks)
+
+        Returns
+        -------
+        ncoinc : int
+            Number of double coincidence events found
+
+        Warnings
+        --------
+        Note that we are looking at paires only, so in case of true
+        triple coinc, we might miss the coinc between first and 3rd
+        event. It doesn't matter for resolution with Co measurements,
+        but can have a slight impact for true experiments
+        """
+
+        # !!! Note that we are looking at paires only, so in case of
+        # true triple coinc, we might miss the coinc between first and 3rd evt.
+        # Doesn't matter for resolution with Co, but can have a slight impact
+        # for true experiments
+
+        channels = np.concatenate((self.lastChannels, channels))
+        timeTags = np.concatenate((self.lastTimes, timeTags))
+        self.lastChannels = channels[-1:]
+        self.lastTimes = timeTags[-1:]
+
+        return self._storePairs(channels[:-1], channels[1:],
+                                timeTags[1:] - timeTags[:-1],
+                                self._intervals(timeTags, slice(1, None)))
+
+    def _2CWfiltering(self, channels, timeTags):
+        """
+        Process the events into double coincidence events, considering
+        all the pairs of events in the time gate
+
+        Contrary to _2Cfiltering, every pair of events recorded in the
+        timeGate time interval is examined, not only the successive
+        ones, so that the (event 1, event 3) pair of a true triple
+        coincidence is not lost. The pairs are found with a sliding
+        window over the sorted timestamps.
+
+        The events that can still form a pair with an event of the
+        next buffer are kept for it.
+
+        Parameters
+        ----------
+        channels : np.ndarray
+            Channel number of the photon events
+        timeTags : np.ndarray
+            Timetags of the photon events (in ticks), in increasing order
+
+        Returns
+        -------
+        ncoinc : int
+            Number of double coincidence events found
+        """
+
+        nlast = self.lastTimes.size
+        channels = np.concatenate((self.lastChannels, channels))
+        timeTags = np.concatenate((self.lastTimes, timeTags))
+        if timeTags.size == 0:
+            return 0
+        keep = np.searchsorted(timeTags, timeTags[-1] - self.timeGateTicks,
+                               side='left')
+        self.lastChannels = channels[keep:]
+        self.lastTimes = timeTags[keep:]
+        if timeTags.size < 2:
+            return 0
+
+        # Sliding window over the sorted timestamps: the pairs (i, i+lag)
+        # are examined for increasing lags, only for the events i that
+        # are still in the time gate at the previous lag.
+        idx = np.flatnonzero(timeTags[1:] - timeTags[:-1]
+                             < self.timeGateTicks)
+        firsts = [idx]
+        lag = 2
+        idx = idx[idx + lag < timeTags.size]
+        while idx.size > 0:
+            idx = idx[timeTags[idx + lag] - timeTags[idx]
+                      < self.timeGateTicks]
+            firsts.append(idx)
+            lag += 1
+            idx = idx[idx + lag < timeTags.size]
+        first = np.concatenate(firsts)
+        second = first + np.repeat(np.arange(1, lag), [f.size
+                                                       for f in firsts])
+        # Pairs between kept events were sorted with the previous buffer
+        isNew = second >= nlast
+        first = first[isNew]
+        second = second[isNew]
+
+        return self._storePairs(channels[first], channels[second],
+                                timeTags[second] - timeTags[first],
+                                self._intervals(timeTags, second))
+
+    def _storePairs(self, chnFirst, chnSecond, dtime, intervals=None):
+        """
+        Store the double coincidence events among a set of pairs
+
+        Pairs of events issued from the channels of a pair definition
+        and recorded within its gate are double coincidence events.
+        The definition of each pair is found from the pairTable lookup
+        table of the coincidences, and the time differences are filled
+        into the histograms of all the pairs at once (see
+        _fillHistograms).
+
+        Parameters
+        ----------
+        chnFirst : np.ndarray
+            Channel number of the first event of the pairs
+        chnSecond : np.ndarray
+            Channel number of the second event of the pairs
+        dtime : np.ndarray
+            Time difference between the two events of the pairs
+            (in ticks)
+        intervals : int or np.ndarray, optional
+            Marker interval of the pairs, given by their second event
+            (see _intervals), None without marker gating
+
+        Returns
+        -------
+        ncoinc : int
+            Number of double coincidence events found
+        """
+
+        coinc = self.coincidences
+        # same channel or undeclared pairs have a -1 code
+        code = coinc.pairCodes(chnFirst, chnSecond)
+        isPair = code >= 0
+        code = code[isPair]
+        dtime = dtime[isPair]
+        isCoinc = dtime < coinc.pairGateTicks[code]
+        code = code[isCoinc]
+        dtime = dtime[isCoinc]
+        if np.ndim(intervals) > 0:
+            intervals = intervals[isPair][isCoinc]
+        self._fillHistograms((coinc.pairHistogram[code],),
+                             (coinc.pairSign[code] * dtime,), intervals)
+        return int(code.size)
+
+    def _fillHistograms(self, histograms, ticks, intervals=None):
+        """
+        Fill values into several histograms at once
+
+        Parameters
+        ----------
+        histograms : sequence
+            Index of the histogram of the values of each array of
+            ticks, or of each of its values (see CoincidenceSet)
+        ticks : sequence of np.ndarray of int
+            Values to be histogrammed (in ticks)
+        intervals : int or np.ndarray of int, optional
+            Marker interval of the coincidence of the values of each
+            array of ticks (see _intervals), None without marker gating
+        """
+        coinc = self.coincidences
+        if intervals is None:
+            bins = np.concatenate([coinc.flatBins(h, values)
+                                   for h, values in zip(histograms, ticks)])
+            self.counts += np.bincount(bins, minlength=self.counts.size)
+            return
+        # the counts of each interval follow those of the previous one
+        shifts = intervals * self.counts.size
+        bins = np.concatenate([coinc.flatBins(h, values, shifts)
+                               for h, values in zip(histograms, ticks)])
+        counts = np.bincount(bins, minlength=self.intervalCounts.size)
+        counts = counts.reshape(self.intervalCounts.shape)
+        self.intervalCounts += counts
+        self.counts += counts.sum(axis=0)
+
+    def _3Cfiltering(self, channels, timeTags):
+        """
+        Process the events into triple coincidence events
+
+        Look at each triplet of successive photons at once with array
+        operations and determine if they are real triple coincidence
+        events.
+
+        A triple coincidence event is made of three successive events
+        from the start and stop channels of a triple definition (by
+        default the sync, then the channels 1 and 2 in any order). The
+        stop events must be recorded within the long time gate after
+        the start event and less than the short time gate apart. The
+        definition of each triplet is found from the tripleTable lookup
+        table of the coincidences.
+
+        If so, fill the time differences into the histograms and append
+        them (in ps) to the event store.
+
+        The last two events are kept to form triplets with the first
+        events of the next buffer.
+
+        Parameters
+        ----------
+        channels : np.ndarray
+            Channel number of the photon events
+        timeTags : np.ndarray
+            Timetags of the photon events (in ticks)
+
+        Returns
+        -------
+        ncoinc : int
+            Number of triple coincidence events found
+        """
+
+        channels = np.concatenate((self.lastChannels, channels))
+        timeTags = np.concatenate((self.lastTimes, timeTags))
+        self.lastChannels = channels[-2:]
+        self.lastTimes = timeTags[-2:]
+
+        # triplets (start, event 1, event 2) of declared channels
+        coinc = self.coincidences
+        code = coinc.tripleCodes(channels)
+        first = np.flatnonzero(code >= 0)
+        code = code[first]
+        triple = code >> 1
+
+        dtimes = timeTags[1:] - timeTags[:-1]
+        dtimeS1 = dtimes[first]
+        dtime12 = dtimes[first + 1]
+        dtimeS2 = dtimeS1 + dtime12
+        if len(coinc.triples) == 1:
+            gate = coinc.tripleGateTicks[0]
+            res = coinc.tripleResTicks[0]
+        else:
+            gate = coinc.tripleGateTicks[triple]
+            res = coinc.tripleResTicks[triple]
+        isCoinc = (dtimeS1 < gate) & (dtimeS2 < gate) & (dtime12 < res)
+
+        # event 1 in the second stop channel: swap the differences
+        swapped = (code[isCoinc] & 1).astype(bool)
+        triple = triple[isCoinc]
+        dtimeS1 = dtimeS1[isCoinc]
+        dtimeS2 = dtimeS2[isCoinc]
+        dtime12 = dtime12[isCoinc]
+        dtimes = (np.where(swapped, dtimeS2, dtimeS1),
+                  np.where(swapped, dtimeS1, dtimeS2),
+                  np.where(swapped, -dtime12, dtime12))
+        if len(coinc.triples) == 1:
+            histograms = coinc.tripleHistograms[0]
+        else:
+            histograms = coinc.tripleHistograms[triple].T
+        intervals = self._intervals(timeTags, first[isCoinc] + 2)
+        self._fillHistograms(histograms, dtimes, intervals)
+
+        names = coinc.histogramNames
+        if len(coinc.triples) == 1:
+            events = dict((names[k], values * self.tick)
+                          for k, values in zip(histograms, dtimes))
+        else:
+            events = dict((name, np.zeros(triple.size, dtype=np.int64))
+                          for name in coinc.eventDtype.names)
+            events['triple'] = triple
+            for k, values in zip(histograms, dtimes):
+                for histogram in np.unique(k):
+                    isHist = k == histogram
+                    events[names[histogram]][isHist] = (values[isHist]
+                                                        * self.tick)
+        if intervals is not None:
+            events['interval'] = np.broadcast_to(
+                    intervals + self.firstInterval, triple.shape)
+        self.events.append(events)
+        return int(triple.size)
+
+    def sortBuffer(self, buffer, nrecords):
+        """
+        Decode buffer individual events to produce a time tagged event
+
+        The whole buffer is decoded at once by decodeT2Records and the
+        resulting photon events are then sorted at once according to
+        the sortingType ('2C', '2CW' or '3C'), see sortEvents.
+        The buffer is not used anymore after decoding and is sent back
+        through the BUFFER_DONE signal, even if the decoding failed.
+
+        Parameters
+        ----------
+        buffer : object - ctype array buffer
+            Raw data buffer received over a signal from the acquisition
+            thread.
+        nrecords : int
+            Total number of records in the buffer
+        """
+        start = time.perf_counter_ns()
+        try:
+            records = np.frombuffer(buffer, dtype=np.uint32)
+            if records.size < nrecords:
+                self.NEW_OUTPUT.emit("The file ended earlier than expected, "
+                                     "at record %d/%d."
+                                     % (records.size, nrecords))
+            records = records[:nrecords]
+            if self.markerTimes is None:
+                channels, timeTags, self.oflcorrection = decodeT2Records(
+                        records, self.oflcorrection, self.VERSION)
+            else:
+                (channels, timeTags, self.oflcorrection, markerChannels,
+                 markerTimes) = decodeT2Records(records, self.oflcorrection,
+                                                self.VERSION, markers=True)
+                self.addMarkers(markerChannels, markerTimes)
+            decoded = time.perf_counter_ns()
+            self.stats.addDecode(records.size, decoded - start)
+        finally:
+            # given back even if the decoding failed, so that the
+            # acquisition never waits for a buffer that will not return
+            records = None
+            self.BUFFER_DONE.emit(buffer)
+        self.sortEvents(channels, timeTags)
+
+    def sortEvents(self, channels, timeTags):
+        """
+        Sort decoded photon events according to the sortingType
+
+        Used by sortBuffer, and to sort events which do not come from
+        a single record buffer, e.g. the events of several cards merged
+        by a th260.streammerger.StreamMerger. The events must follow
+        the ones of the previous call.
+
+        In continuous acquisition mode, the events are split at the end
+        of the current file, which is saved before the following
+        events are sorted into the next file (see _nextFile).
+
+        Parameters
+        ----------
+        channels : np.ndarray
+            Channel number of the photon events
+        timeTags : np.ndarray
+            Timetags of the photon events (in ticks), in increasing order
+        """
+        start = time.perf_counter_ns()
+        ncoinc = 0
+        while (self.fileEnd is not None and timeTags.size > 0
+               and timeTags[-1] >= self.fileEnd):
+            end = np.searchsorted(timeTags, self.fileEnd)
+            ncoinc += self._filterEvents(channels[:end], timeTags[:end])
+            self._nextFile()
+            channels = channels[end:]
+            timeTags = timeTags[end:]
+        ncoinc += self._filterEvents(channels, timeTags)
+        self.stats.addSort(ncoinc, time.perf_counter_ns() - start)
+        self.COINCRATE.emit(ncoinc)
+
+    def _filterEvents(self, channels, timeTags):
+        """Sort the events according to the sortingType"""
+        if self.sortingType == '2C':
+            return self._2Cfiltering(channels, timeTags)
+        elif self.sortingType == '2CW':
+            return self._2CWfiltering(channels, timeTags)
+        elif self.sortingType == '3C':
+            return self._3Cfiltering(channels, timeTags)
+        return 0
@@ -0,0 +1,167 @@
+# This file is part of Pals3D
+#
+# sortingprocess is meant to sort the data from a PicoQuant TimeHarp
+# 260 Pico in a separate process, for applications to positron
+# annihilation lifetime spectroscopy. It holds the Qt proxy of the GUI
+# application, the sorting process itself running the Qt-free
+# sortingring.runSorter.
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+import multiprocessing as mp
+
+from PyQt5 import QtCore
+
+from th260.pipelinestats import PipelineStats
+from th260.sortingring import SharedRingBuffer, runSorter
+
+
+class SortingProcess(QtCore.QObject):
+    """
+    Proxy of a SortingWorker running in a separate process
+
+    Exposes the same slots and signals as SortingWorker, so that it
+    can replace it in the GUI, but the decoding and the sorting run in
+    another process and do not compete with the GUI and the FIFO
+    reading for the GIL. The buffers received by sortBuffer are copied
+    into a SharedRingBuffer and given back (BUFFER_DONE) right away,
+    the sortBuffer slot only blocking when the ring is full.
+
+    The kwargs are sent to the sorting process with each
+    newMeasurement call, which also sets sortingType as SortingWorker
+    does. The decoding, sorting and saving counters of
+    the sorting process are copied into stats after each buffer.
+
+    Parameters
+    ----------
+    slotSize : int
+        Size of the ring slots, at least the size of the FIFO buffers
+    nslots : int
+        Number of slots of the ring
+
+    Supported signals:
+    ------------------
+    COINCRATE : int
+        Number of coincidences of each sorted buffer
+    NEW_OUTPUT : str
+        Messages of the sorting process
+    BUFFER_DONE : object
+        Emitted with each buffer once copied into the ring
+    HISTOGRAMS : dict
+        Bin centers and counts of each channel pair, emitted after
+        each saveData and on request (see requestSnapshot)
+    FILE_DONE : int
+        Number of each file saved in continuous acquisition mode
+    SAVED : str
+        Filename base of the output files written by the sorting
+        process
+    SAVE_ERROR : str
+        Error met while writing the output files
+    """
+
+    COINCRATE = QtCore.pyqtSignal(int)
+    NEW_OUTPUT = QtCore.pyqtSignal(str)
+    BUFFER_DONE = QtCore.pyqtSignal(object)
+    HISTOGRAMS = QtCore.pyqtSignal(object)
+    FILE_DONE = QtCore.pyqtSignal(int)
+    SAVED = QtCore.pyqtSignal(str)
+    SAVE_ERROR = QtCore.pyqtSignal(str)
+
+    def __init__(self, slotSize, nslots=32):
+        """Constructor of the SortingProcess class"""
+        super(SortingProcess, self).__init__()
+        self.kwargs = dict()
+        self.sortingType = None
+        self.stats = PipelineStats()
+        self.ring = SharedRingBuffer(nslots, slotSize)
+        context = mp.get_context('spawn')
+        self.commands = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(
+                target=runSorter, daemon=True,
+                args=(self.ring.name, nslots, slotSize, self.commands,
+                      self.results))
+        self.process.start()
+        self.resultThread = threading.Thread(target=self._readResults,
+                                             daemon=True)
+        self.resultThread.start()
+
+    def _readResults(self):
+        """Emit the results received from the sorting process"""
+        while True:
+            result = self.results.get()
+            if result is None:
+                break
+            signal, value = result
+            if signal == 'STATS':
+                self.stats.updateSorterCounters(value)
+            else:
+                getattr(self, signal).emit(value)
+
+    def newMeasurement(self, noFile):
+        """See SortingWorker.newMeasurement"""
+        self.sortingType = self.kwargs["sortingType"]
+        self.commands.put(('newMeasurement', (noFile, dict(self.kwargs))))
+
+    def saveData(self, noFile):
+        """See SortingWorker.saveData"""
+        self.commands.put(('saveData', (noFile,)))
+
+    def closeFiles(self, lastFile=-1):
+        """See SortingWorker.closeFiles"""
+        self.commands.put(('closeFiles', (lastFile,)))
+
+    @QtCore.pyqtSlot()
+    def processLastEvents(self):
+        """See SortingWorker.processLastEvents"""
+        self.commands.put(('processLastEvents', ()))
+
+    @QtCore.pyqtSlot()
+    def requestSnapshot(self):
+        """Ask for the current histograms, sent back by HISTOGRAMS"""
+        self.commands.put(('snapshot', ()))
+
+    def sortBuffer(self, buffer, nrecords):
+        """
+        Send a buffer to the sorting process
+
+        Parameters
+        ----------
+        buffer : object - ctype array buffer
+            Raw data buffer received over a signal from the acquisition
+            thread.
+        nrecords : int
+            Total number of records in the buffer
+        """
+        index = self.ring.put(buffer, nrecords)
+        self.BUFFER_DONE.emit(buffer)
+        self.commands.put(('data', (index,)))
+
+    def pending(self):
+        """Return the number of buffers waiting in the ring"""
+        return self.ring.pending()
+
+    def close(self):
+        """Stop the sorting process once all commands are processed"""
+        self.commands.put(('stop', ()))
+        self.process.join()
+        self.resultThread.join()
+        self.ring.close(unlink=True)
@@ -0,0 +1,217 @@
+# This file is part of Pals3D
+#
+# sortingring is meant to sort the data from a PicoQuant TimeHarp 260
+# Pico in a separate process fed through shared memory, for
+# applications to positron annihilation lifetime spectroscopy, without
+# any dependency on Qt (see sortingprocess for the Qt proxy of the GUI
+# application). The sorting process only imports this module and
+# sortingcore.
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+# The FIFO buffers are copied into a ring of slots in shared memory.
+# The shared memory block starts with a control block of uint64: the
+# head (number of slots written by the GUI process), the tail (number
+# of slots decoded by the sorting process) and the number of records of
+# each slot, followed by the slots themselves (uint32 records).
+# Commands (new measurement, data, save...) are sent in order through a
+# queue, so that they are processed in order with the data. Results
+# (coincidence counts, messages, histogram snapshots, sorter counters)
+# come back through another queue.
+#
+
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from th260.sortingcore import SortingCore
+
+HEAD, TAIL = 0, 1  #: int : Position of the indices in the control block
+
+
+class SharedRingBuffer(object):
+    """
+    Ring of record buffers in shared memory
+
+    A single producer writes buffers at the head of the ring and a
+    single consumer frees them at its tail, both indices being stored
+    in the shared memory block together with the number of records of
+    each slot.
+
+    Parameters
+    ----------
+    nslots : int
+        Number of slots of the ring
+    slotSize : int
+        Size of each slot (in records)
+    name : str, optional
+        Name of an existing shared memory block to attach to. A new
+        block is created if None.
+
+    Attributes
+    ----------
+    name : str
+        Name of the shared memory block
+    control : np.ndarray of np.uint64
+        Head, tail and number of records of each slot
+    slots : np.ndarray of np.uint32
+        Records of each slot, shape (nslots, slotSize)
+    """
+
+    def __init__(self, nslots, slotSize, name=None):
+        """Constructor of the SharedRingBuffer class"""
+        self.nslots = nslots
+        self.slotSize = slotSize
+        controlSize = 8 * (2 + nslots)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(
+                    create=True, size=controlSize + 4*nslots*slotSize)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.control = np.ndarray(2 + nslots, dtype=np.uint64,
+                                  buffer=self.shm.buf)
+        self.slots = np.ndarray((nslots, slotSize), dtype=np.uint32,
+                                buffer=self.shm.buf, offset=controlSize)
+        if name is None:
+            self.control[:] = 0
+
+    def pending(self):
+        """Return the number of slots written and not yet freed"""
+        return int(self.control[HEAD] - self.control[TAIL])
+
+    def put(self, buffer, nrecords, block=True):
+        """
+        Copy a buffer at the head of the ring
+
+        Parameters
+        ----------
+        buffer : ctypes array of c_uint or np.ndarray of np.uint32
+            Raw data buffer
+        nrecords : int
+            Number of records of the buffer, at most slotSize
+        block : bool
+            Wait for a free slot if the ring is full
+
+        Returns
+        -------
+        index : int
+            Index of the written slot, None if the ring is full and
+            block is False
+        """
+        while self.pending() >= self.nslots:
+            if not block:
+                return None
+            time.sleep(0.0005)
+        index = int(self.control[HEAD])
+        slot = index % self.nslots
+        self.slots[slot, :nrecords] = np.frombuffer(
+                buffer, dtype=np.uint32, count=nrecords)
+        self.control[2 + slot] = nrecords
+        self.control[HEAD] = index + 1
+        return index
+
+    def get(self, index):
+        """Return a view of the records of the slot written at index"""
+        slot = index % self.nslots
+        return self.slots[slot, :int(self.control[2 + slot])]
+
+    def free(self):
+        """Give the slot at the tail of the ring back to the producer"""
+        self.control[TAIL] += 1
+
+    def close(self, unlink=False):
+        """Detach from the shared memory block, and destroy it if unlink"""
+        del self.control, self.slots
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def histogramSnapshot(worker):
+    """Return a copy of the bin centers and counts of each histogram"""
+    return dict((chnPair, (histogram.binCenters(), histogram.counts.copy()))
+                for chnPair, histogram in worker.histograms.items())
+
+
+def runSorter(name, nslots, slotSize, commands, results):
+    """
+    Main function of the sorting process
+
+    Parameters
+    ----------
+    name : str
+        Name of the shared memory block of the ring buffer
+    nslots : int
+        Number of slots of the ring
+    slotSize : int
+        Size of each slot (in records)
+    commands : multiprocessing.Queue
+        Commands received from the GUI process, as (command, args)
+    results : multiprocessing.Queue
+        Results sent back to the GUI process, as (signal name, value)
+    """
+    ring = SharedRingBuffer(nslots, slotSize, name)
+    # no Qt here: the slots are called right away, also from the writer
+    # thread of the worker (the queue is thread safe)
+    worker = SortingCore()
+    # the slot can be reused as soon as it is decoded
+    worker.BUFFER_DONE.connect(lambda buffer: ring.free())
+    worker.COINCRATE.connect(lambda n: results.put(('COINCRATE', n)))
+    worker.NEW_OUTPUT.connect(lambda text: results.put(('NEW_OUTPUT',
+                                                       text)))
+    worker.FILE_DONE.connect(lambda noFile: results.put(('FILE_DONE',
+                                                        noFile)))
+    worker.SAVED.connect(lambda name: results.put(('SAVED', name)))
+    worker.SAVE_ERROR.connect(lambda text: results.put(('SAVE_ERROR',
+                                                       text)))
+
+    while True:
+        command, args = commands.get()
+        if command == 'data':
+            index, = args
+            worker.sortBuffer(ring.get(index), ring.get(index).size)
+            results.put(('STATS', worker.stats.sorterCounters()))
+        elif command == 'newMeasurement':
+            noFile, kwargs = args
+            worker.kwargs = kwargs
+            worker.newMeasurement(noFile)
+        elif command == 'processLastEvents':
+            worker.processLastEvents()
+        elif command == 'saveData':
+            noFile, = args
+            worker.saveData(noFile)
+            results.put(('HISTOGRAMS', histogramSnapshot(worker)))
+            results.put(('STATS', worker.stats.sorterCounters()))
+        elif command == 'closeFiles':
+            lastFile, = args
+            worker.closeFiles(lastFile)
+            results.put(('HISTOGRAMS', histogramSnapshot(worker)))
+            results.put(('STATS', worker.stats.sorterCounters()))
+        elif command == 'snapshot':
+            results.put(('HISTOGRAMS', histogramSnapshot(worker)))
+        elif command == 'stop':
+            try:
+                worker.waitSaved()
+            except OSError:
+                pass    # already reported by SAVE_ERROR
+            break
+    ring.close()
+    results.put(None)
@@ -0,0 +1,300 @@
+# This file is part of Pals3D
+#
+# streammerger is meant to interleave by time the photon events of
+# several PicoQuant TimeHarp 260 Pico cards sharing a common sync, so
+# that coincidences between the detectors of different cards can be
+# sorted, for applications to positron annihilation lifetime
+# spectroscopy.
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import numpy as np
+
+from th260.sortingcore import decodeT2Records, NCHANNELS
+
+NINPUTS = 2  #: int : Number of input channels of a TH260 Pico card
+
+
+def defaultChannelMap(stream, ninputs=NINPUTS):
+    """
+    Return the default channel map of a card
+
+    The sync and the inputs of the first card keep their numbers. The
+    sync of the other cards, which is the common sync, is dropped and
+    their inputs are numbered after those of the previous cards: with
+    two cards, the inputs 1 and 2 of the second card become the
+    channels 3 and 4.
+
+    Parameters
+    ----------
+    stream : int
+        Index of the card
+    ninputs : int
+        Number of input channels of each card
+
+    Returns
+    -------
+    channelMap : np.ndarray
+        Merged channel number of each channel number of the card, -1
+        for the dropped channels
+    """
+    channelMap = np.full(NCHANNELS, -1, dtype=np.int64)
+    inputs = np.arange(1, ninputs + 1)
+    channelMap[inputs] = stream * ninputs + inputs
+    if stream == 0:
+        channelMap[0] = 0
+    return channelMap
+
+
+class StreamMerger(object):
+    """
+    Time-ordered k-way merge of the photon events of several streams
+
+    The events of each stream (card) are pushed batch by batch, in
+    increasing time order within the stream. Their channels are
+    renumbered with the channel map of the stream, and the clock
+    offset of the stream is added to their timetags.
+
+    pop returns the events of all the streams older than the
+    watermark, i.e. the oldest of the last timetags pushed by the
+    streams which are not finished: no event can be pushed before it
+    anymore, so that the returned events are final and in time order.
+    The newer events wait for the next call. The merge is a stable
+    sort of the concatenated sorted runs, the events of equal times
+    staying in stream order.
+
+    A stream which stops sending events (e.g. a card without any
+    count) would hold back the watermark forever. With maxLookAhead,
+    the watermark never stays more than maxLookAhead ticks behind the
+    newest event pushed, which bounds the number of pending events.
+    The events later pushed before the watermark can not be merged in
+    order anymore: they are dropped and counted in lateEvents.
+
+    Parameters
+    ----------
+    nstreams : int
+        Number of merged streams
+    offsets : sequence of int, optional
+        Clock offset of each stream (in ticks), added to its timetags
+    channelMaps : sequence of np.ndarray, optional
+        Merged channel number of each channel number of each stream,
+        -1 for dropped channels (see defaultChannelMap if None)
+    maxLookAhead : int, optional
+        Largest delay (in ticks) between the watermark and the newest
+        event pushed, None for no limit
+
+    Attributes
+    ----------
+    watermark : int
+        Time (in ticks) before which all the events have been popped,
+        None until the first events are popped
+    lateEvents : int
+        Number of events dropped because pushed before the watermark
+    """
+
+    def __init__(self, nstreams, offsets=None, channelMaps=None,
+                 maxLookAhead=None):
+        """Constructor of the StreamMerger class"""
+        self.nstreams = nstreams
+        if offsets is None:
+            offsets = [0] * nstreams
+        if channelMaps is None:
+            channelMaps = [defaultChannelMap(k) for k in range(nstreams)]
+        if len(offsets) != nstreams or len(channelMaps) != nstreams:
+            raise ValueError("One offset and one channel map are needed "
+                             "for each of the %d streams" % nstreams)
+        self.offsets = [int(offset) for offset in offsets]
+        self.channelMaps = [np.asarray(channelMap, dtype=np.int64)
+                            for channelMap in channelMaps]
+        self.maxLookAhead = maxLookAhead
+        self.watermark = None
+        self.lateEvents = 0
+        self.finished = [False] * nstreams
+        self._lastTimes = [None] * nstreams
+        self._pending = [[] for k in range(nstreams)]
+
+    def push(self, stream, channels, timeTags):
+        """
+        Add a batch of events of a stream
+
+        Parameters
+        ----------
+        stream : int
+            Index of the stream
+        channels : np.ndarray
+            Channel number of the photon events
+        timeTags : np.ndarray
+            Timetags of the photon events (in ticks), in increasing order
+        """
+        if self.finished[stream]:
+            raise ValueError("Stream %d is already finished" % stream)
+        channels = self.channelMaps[stream][channels]
+        kept = channels >= 0
+        channels = channels[kept]
+        timeTags = np.asarray(timeTags, dtype=np.int64)[kept]
+        timeTags += self.offsets[stream]
+        if self.watermark is not None:
+            late = np.searchsorted(timeTags, self.watermark)
+            self.lateEvents += late
+            channels = channels[late:]
+            timeTags = timeTags[late:]
+        if timeTags.size > 0:
+            self._pending[stream].append((channels, timeTags))
+            self._lastTimes[stream] = timeTags[-1]
+
+    def finish(self, stream):
+        """Mark a stream as finished: it does not hold back pop anymore"""
+        self.finished[stream] = True
+
+    def lastTime(self, stream):
+        """Last timetag pushed by a stream (in ticks), None if none"""
+        return self._lastTimes[stream]
+
+    def pending(self):
+        """Number of events waiting to be popped"""
+        return sum(timeTags.size for stream in self._pending
+                   for _, timeTags in stream)
+
+    def _currentWatermark(self):
+        """Time before which no event can be pushed anymore"""
+        bounds = [lastTime for lastTime, finished
+                  in zip(self._lastTimes, self.finished) if not finished]
+        if not bounds:
+            return None  # all the events are final
+        if None in bounds:
+            watermark = None
+        else:
+            watermark = min(bounds)
+        if self.maxLookAhead is not None:
+            newest = [t for t in self._lastTimes if t is not None]
+            if newest:
+                limit = max(newest) - self.maxLookAhead
+                if watermark is None or watermark < limit:
+                    watermark = limit
+        if watermark is None:
+            return self.watermark
+        if self.watermark is not None:
+            watermark = max(watermark, self.watermark)
+        return watermark
+
+    def pop(self):
+        """
+        Return the merged events older than the watermark
+
+        Returns
+        -------
+        channels : np.ndarray
+            Merged channel number of the photon events
+        timeTags : np.ndarray
+            Corrected timetags of the photon events (in ticks), in
+            increasing order
+        """
+        watermark = self._currentWatermark()
+        allFinished = all(self.finished)
+        mergedChannels = []
+        mergedTimes = []
+        for stream, batches in enumerate(self._pending):
+            if not batches:
+                continue
+            channels = np.concatenate([c for c, _ in batches])
+            timeTags = np.concatenate([t for _, t in batches])
+            if allFinished:
+                end = timeTags.size
+            elif watermark is None:
+                end = 0
+            else:
+                end = np.searchsorted(timeTags, watermark)
+            mergedChannels.append(channels[:end])
+            mergedTimes.append(timeTags[:end])
+            if end < timeTags.size:
+                self._pending[stream] = [(channels[end:], timeTags[end:])]
+            else:
+                self._pending[stream] = []
+        if allFinished:
+            if mergedTimes and any(t.size for t in mergedTimes):
+                watermark = max(t[-1] for t in mergedTimes if t.size) + 1
+        if watermark is not None:
+            self.watermark = watermark
+
+        if not mergedTimes:
+            return (np.empty(0, dtype=np.int64),
+                    np.empty(0, dtype=np.int64))
+        channels = np.concatenate(mergedChannels)
+        timeTags = np.concatenate(mergedTimes)
+        if len(mergedTimes) > 1:
+            # sorted runs, merged by the stable sort (timsort)
+            order = np.argsort(timeTags, kind='stable')
+            channels = channels[order]
+            timeTags = timeTags[order]
+        return channels, timeTags
+
+    def flush(self):
+        """Finish all the streams and return all the pending events"""
+        for stream in range(self.nstreams):
+            self.finish(stream)
+        return self.pop()
+
+
+def mergeRecords(merger, recordStreams, versions=None, chunkSize=1048576):
+    """
+    Decode and merge the T2 records of several cards batch by batch
+
+    The next chunk decoded is always the one of the card which is the
+    furthest behind, so that the events waiting in the merger stay
+    within about one chunk of each card.
+
+    Parameters
+    ----------
+    merger : StreamMerger
+        Merger of as many streams as cards
+    recordStreams : sequence of np.ndarray of np.uint32
+        T2 records of each card (e.g. memory mapped raw record files)
+    versions : sequence of int, optional
+        Version of the T2 records of each card (2 by default)
+    chunkSize : int
+        Number of records of a card decoded at once
+
+    Yields
+    ------
+    channels, timeTags : np.ndarray
+        Batches of merged events in increasing time order
+    """
+    nstreams = len(recordStreams)
+    if versions is None:
+        versions = [2] * nstreams
+    positions = [0] * nstreams
+    oflcorrections = [0] * nstreams
+
+    while not all(merger.finished):
+        stream = min((k for k in range(nstreams) if not merger.finished[k]),
+                     key=lambda k: (merger.lastTime(k) is not None,
+                                    merger.lastTime(k) or 0))
+        start = positions[stream]
+        records = recordStreams[stream][start:start+chunkSize]
+        if records.size == 0:
+            merger.finish(stream)
+        else:
+            positions[stream] += records.size
+            channels, timeTags, oflcorrections[stream] = decodeT2Records(
+                    records, oflcorrections[stream], versions[stream])
+            merger.push(stream, channels, timeTags)
+        channels, timeTags = merger.pop()
+        if timeTags.size > 0:
+            yield channels, timeTags
@@ -0,0 +1,266 @@
+# This file is part of Pals3D
+#
+# t2rawfile is meant to record and read back the raw T2 records from
+# a PicoQuant TimeHarp 260 Pico for applications to positron
+# annihilation lifetime spectroscopy.
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+# A raw record file starts with a small header made of the RAW_MAGIC
+# bytes, the length of the header data as a little endian uint32 and
+# the header data itself, a JSON dictionary holding the settings of the
+# measurement (CFD settings, offsets, resolution...). The header is
+# padded so that the records start at a multiple of 8 bytes. The T2
+# records follow as little endian uint32, exactly as read from the
+# TH260 FIFO.
+#
+
+import json
+import queue
+import struct
+import tempfile
+import threading
+
+RAW_MAGIC = b'PALS3DT2'  #: bytes : Magic bytes starting a raw record file
+RAW_EXTENSION = '.t2r'  #: str : Extension of raw record files
+
+
+def writeRawHeader(rawFile, header):
+    """
+    Write the header of a raw record file
+
+    Parameters
+    ----------
+    rawFile : file object
+        File opened in binary write mode, at its beginning
+    header : dict
+        Settings of the measurement, must be JSON serializable
+    """
+    data = json.dumps(header).encode('utf-8')
+    # records start at a multiple of 8 bytes
+    data += b' ' * (-(len(RAW_MAGIC) + 4 + len(data)) % 8)
+    rawFile.write(RAW_MAGIC + struct.pack('<I', len(data)) + data)
+
+
+def readRawHeader(rawFile):
+    """
+    Read the header of a raw record file
+
+    Parameters
+    ----------
+    rawFile : file object
+        File opened in binary read mode, at its beginning
+
+    Returns
+    -------
+    header : dict
+        Settings of the measurement
+    offset : int
+        Position of the first record in the file (in bytes)
+
+    Raises
+    ------
+    ValueError
+        If the file is not a raw record file
+    """
+    magic = rawFile.read(len(RAW_MAGIC))
+    if magic != RAW_MAGIC:
+        raise ValueError("Not a Pals3D raw record file")
+    length, = struct.unpack('<I', rawFile.read(4))
+    header = json.loads(rawFile.read(length).decode('utf-8'))
+    return header, len(RAW_MAGIC) + 4 + length
+
+
+class RawRecordWriter(threading.Thread):
+    """
+    Background thread writing FIFO buffers to a raw record file
+
+    Buffers are put in a bounded queue by the acquisition loop and
+    appended to the file by the thread, so that the disk access does
+    not slow down the FIFO reading. Each buffer is given back with
+    releaseBuffer once written.
+
+    An error while writing stops the recording but not the thread,
+    which keeps giving the buffers back. The buffers written after an
+    error, or once the thread is dead, are dropped at once, so that
+    write never blocks the acquisition loop for good.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the raw record file, overwritten if it exists
+    header : dict
+        Settings of the measurement written in the file header
+    releaseBuffer : callable, optional
+        Called with each buffer once it has been written
+    maxsize : int
+        Maximum number of buffers waiting to be written
+
+    Attributes
+    ----------
+    nrecords : int
+        Number of records written so far
+    error : Exception
+        Error raised while writing, if any. No more data is written
+        after an error, but buffers are still released.
+    """
+
+    def __init__(self, filename, header, releaseBuffer=None, maxsize=64):
+        """Constructor of the RawRecordWriter class"""
+        super(RawRecordWriter, self).__init__(daemon=True)
+        self.filename = filename
+        self.releaseBuffer = releaseBuffer
+        self.queue = queue.Queue(maxsize)
+        self.nrecords = 0
+        self.error = None
+        self.rawFile = open(filename, 'wb')
+        writeRawHeader(self.rawFile, header)
+
+    def write(self, buffer, nrecords, release=True):
+        """
+        Queue the first nrecords records of buffer for writing
+
+        Blocks only if maxsize buffers are already waiting. The buffer
+        is dropped if the recording failed or the thread is dead.
+
+        Parameters
+        ----------
+        buffer : ctypes array of c_uint or np.ndarray of np.uint32
+            Raw data buffer
+        nrecords : int
+            Number of records of the buffer to be written
+        release : bool
+            Give the buffer back with releaseBuffer once written, False
+            for a buffer which does not come from the buffer pool
+        """
+        item = (buffer, nrecords, release)
+        while self.error is None and self.is_alive():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        self._release(buffer, release)
+
+    def close(self):
+        """Write the remaining buffers, close the file and end the thread"""
+        while self.is_alive():
+            try:
+                self.queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.join()
+        if not self.rawFile.closed:
+            self.rawFile.close()
+
+    def _release(self, buffer, release):
+        """Give a buffer back with releaseBuffer if needed"""
+        if release and self.releaseBuffer is not None:
+            self.releaseBuffer(buffer)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            buffer, nrecords, release = item
+            try:
+                if self.error is None:
+                    self.rawFile.write(memoryview(buffer).cast('B')
+                                       [:4*nrecords])
+                    self.nrecords += nrecords
+            except Exception as error:
+                self.error = error
+            try:
+                self._release(buffer, release)
+            except Exception as error:
+                if self.error is None:
+                    self.error = error
+        self.rawFile.close()
+
+
+class SpillFile(object):
+    """
+    Temporary file of raw records read back in order
+
+    Holds the FIFO buffers that can not be handed over to the sorter
+    when the hand-off queue is full, until there is room again. Records
+    are appended at the end of the file and read back from its
+    beginning, the file being emptied once everything has been read.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Directory of the temporary file, the default temporary
+        directory if None
+    """
+
+    def __init__(self, directory=None):
+        """Constructor of the SpillFile class"""
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.readPos = 0
+        self.writePos = 0
+
+    def pending(self):
+        """Return the number of records waiting to be read"""
+        return (self.writePos - self.readPos) // 4
+
+    def write(self, buffer, nrecords):
+        """
+        Append the first nrecords records of buffer
+
+        Parameters
+        ----------
+        buffer : ctypes array of c_uint or np.ndarray of np.uint32
+            Raw data buffer
+        nrecords : int
+            Number of records of the buffer to be written
+        """
+        self.file.seek(self.writePos)
+        self.file.write(memoryview(buffer).cast('B')[:4*nrecords])
+        self.writePos += 4*nrecords
+
+    def readInto(self, buffer):
+        """
+        Read the oldest records into buffer
+
+        Parameters
+        ----------
+        buffer : ctypes array of c_uint or np.ndarray of np.uint32
+            Buffer to be filled
+
+        Returns
+        -------
+        nrecords : int
+            Number of records read
+        """
+        data = memoryview(buffer).cast('B')
+        self.file.seek(self.readPos)
+        nbytes = self.file.readinto(data[:min(len(data), 4*self.pending())])
+        self.readPos += nbytes
+        if self.readPos == self.writePos:
+            self.file.seek(0)
+            self.file.truncate()
+            self.readPos = self.writePos = 0
+        return nbytes // 4
+
+    def close(self):
+        """Close and delete the file"""
+        self.file.close()
@@ -0,0 +1,314 @@
+# This file is part of Pals3D
+#
+# th260backend is meant to provide the device library used by the
+# TH260Controller: the PicoQuant TimeHarp 260 Pico library itself or a
+# simulated device, for applications to positron annihilation lifetime
+# spectroscopy.
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+# The backend is chosen with the PALS3D_BACKEND environment variable:
+# "simulated" for the simulated device, or the name (or path) of the
+# library to be loaded. The rate of the simulated device (in events/s)
+# can be set with the PALS3D_SIM_RATE environment variable, and the
+# number of simulated devices with PALS3D_SIM_DEVICES.
+#
+
+import os
+import sys
+import time
+import ctypes as ct
+
+import numpy as np
+
+from toolbox.generator import PALSGenerator
+
+BACKEND_ENV = 'PALS3D_BACKEND'  #: str : Environment variable of the backend
+SIM_RATE_ENV = 'PALS3D_SIM_RATE'  #: str : Environment variable of the rate
+#: str : Environment variable of the number of simulated devices
+SIM_DEVICES_ENV = 'PALS3D_SIM_DEVICES'
+SIMULATED = 'simulated'  #: str : Name of the simulated backend
+
+if sys.platform.startswith('win'):
+    DEFAULT_LIBRARY = "th260lib64.dll"
+else:
+    DEFAULT_LIBRARY = "libth260.so"
+
+
+def loadLibrary(backend=None):
+    """
+    Load the device library
+
+    Parameters
+    ----------
+    backend : str, optional
+        'simulated' or the name of the library to be loaded. Read from
+        the PALS3D_BACKEND environment variable if None, the default
+        being the PicoQuant library of the platform.
+
+    Returns
+    -------
+    lib : ctypes.CDLL or SimulatedTH260Lib
+        Object exposing the TH260_* functions of the library
+    """
+    if backend is None:
+        backend = os.environ.get(BACKEND_ENV, DEFAULT_LIBRARY)
+    if backend == SIMULATED:
+        rate = float(os.environ.get(SIM_RATE_ENV, 10000.))
+        ndevices = int(os.environ.get(SIM_DEVICES_ENV, 1))
+        if ndevices > 1:
+            return SimulatedTH260Devices(
+                    [SimulatedTH260Lib(PALSGenerator(rate=rate, seed=i),
+                                       serial=b"SIMUL%03d" % i)
+                     for i in range(ndevices)])
+        return SimulatedTH260Lib(PALSGenerator(rate=rate))
+    return ct.CDLL(backend)
+
+
+def _value(arg):
+    """Return the value of a ctypes argument or of a Python number"""
+    return getattr(arg, 'value', arg)
+
+
+def _target(arg):
+    """Return the object referenced by a byref() argument"""
+    return getattr(arg, '_obj', arg)
+
+
+class SimulatedTH260Lib(object):
+    """
+    Pure Python simulation of a TimeHarp 260 P in T2 mode
+
+    Implements the TH260_* functions used by TH260Controller with the
+    same arguments (ctypes objects, byref() references or Python
+    numbers) and return codes. A single device (index 0) with two
+    input channels is simulated.
+
+    During a measurement, the records of the time elapsed since the
+    last FIFO read are produced at once by a PALSGenerator (positron
+    events from a 22Na source by default, see toolbox.generator) and
+    stored in a simulated FIFO. The FIFO full flag is raised when the
+    records are not read fast enough.
+
+    Parameters
+    ----------
+    generator : PALSGenerator, optional
+        Generator of the simulated events, restarted at each
+        measurement. A PALSGenerator with its default settings and an
+        event rate of 10000/s is used if None.
+    fifoSize : int
+        Number of records the FIFO can hold
+    serial : bytes
+        Serial number of the simulated device
+    """
+
+    RESOLUTION = 25.0  #: float : Time resolution in T2 mode (in ps)
+    HW_MODEL = b"TimeHarp 260 P"
+    FLAG_FIFOFULL = 0x0002
+
+    def __init__(self, generator=None, fifoSize=33554432,
+                 serial=b"SIMUL000"):
+        """Constructor of the SimulatedTH260Lib class"""
+        if generator is None:
+            generator = PALSGenerator(rate=10000.)
+        self.generator = generator
+        self.fifoSize = fifoSize
+        self.serial = serial
+        self.opened = False
+        self.running = False
+        self.tacq = 0
+        self.startTime = 0.
+        self.stopTime = 0.
+        self.fifo = []
+        self.fifoCount = 0
+        self.fifoFull = False
+
+    # ------------- simulated data ------------- #
+    def _elapsed(self):
+        """Return the elapsed measurement time (in s)"""
+        end = time.monotonic() if self.running else self.stopTime
+        return min(end - self.startTime, self.tacq / 1000)
+
+    def _generateEvents(self):
+        """Fill the FIFO with the records of the elapsed time"""
+        if not self.running:
+            return
+        nowTick = int(self._elapsed() / (self.RESOLUTION * 1e-12))
+        if nowTick <= self.generator.cursor:
+            return
+        records = self.generator.generateUntil(nowTick)
+        self.fifo.append(records)
+        self.fifoCount += records.size
+        if self.fifoCount > self.fifoSize:
+            self.fifoFull = True
+
+    # ------------- library functions ------------- #
+    def TH260_GetLibraryVersion(self, version):
+        version.value = b"3.1"
+        return 0
+
+    def TH260_GetErrorString(self, errorString, errcode):
+        errorString.value = b"Simulated error %d" % _value(errcode)
+        return 0
+
+    def TH260_OpenDevice(self, devidx, serial):
+        if _value(devidx) != 0:
+            return -1  # TH260_ERROR_DEVICE_OPEN_FAIL
+        serial.value = self.serial
+        self.opened = True
+        return 0
+
+    def TH260_CloseDevice(self, devidx):
+        if _value(devidx) == 0:
+            self.running = False
+            self.opened = False
+        return 0
+
+    def TH260_Initialize(self, devidx, mode):
+        return 0
+
+    def TH260_GetHardwareInfo(self, devidx, model, partno, version):
+        model.value = self.HW_MODEL
+        partno.value = b"SIMUL"
+        version.value = b"1.0"
+        return 0
+
+    def TH260_GetNumOfInputChannels(self, devidx, nchannels):
+        _target(nchannels).value = 2
+        return 0
+
+    def TH260_SetSyncDiv(self, devidx, div):
+        return 0
+
+    def TH260_SetSyncCFD(self, devidx, level, zerocross):
+        return 0
+
+    def TH260_SetInputCFD(self, devidx, channel, level, zerocross):
+        return 0
+
+    def TH260_SetSyncChannelOffset(self, devidx, offset):
+        return 0
+
+    def TH260_SetInputChannelOffset(self, devidx, channel, offset):
+        return 0
+
+    def TH260_GetResolution(self, devidx, resolution):
+        _target(resolution).value = self.RESOLUTION
+        return 0
+
+    def TH260_GetWarnings(self, devidx, warnings):
+        _target(warnings).value = 0
+        return 0
+
+    def TH260_GetWarningsText(self, devidx, text, warnings):
+        text.value = b""
+        return 0
+
+    def TH260_GetSyncRate(self, devidx, syncrate):
+        _target(syncrate).value = int(self.generator.countRates()[0])
+        return 0
+
+    def TH260_GetCountRate(self, devidx, channel, countrate):
+        _target(countrate).value = int(
+                self.generator.countRates()[_value(channel) + 1])
+        return 0
+
+    def TH260_StartMeas(self, devidx, tacq):
+        self.tacq = _value(tacq)
+        self.startTime = time.monotonic()
+        self.generator.reset()
+        self.fifo = []
+        self.fifoCount = 0
+        self.fifoFull = False
+        self.running = True
+        return 0
+
+    def TH260_StopMeas(self, devidx):
+        if self.running:
+            self.stopTime = time.monotonic()
+            self.running = False
+        return 0
+
+    def TH260_GetFlags(self, devidx, flags):
+        self._generateEvents()
+        _target(flags).value = self.FLAG_FIFOFULL if self.fifoFull else 0
+        return 0
+
+    def TH260_ReadFiFo(self, devidx, buffer, count, nactual):
+        self._generateEvents()
+        buffer = np.frombuffer(_target(buffer), dtype=np.uint32)
+        count = min(_value(count), buffer.size)
+        n = 0
+        while self.fifo and n < count:
+            records = self.fifo[0]
+            m = min(records.size, count - n)
+            buffer[n:n+m] = records[:m]
+            n += m
+            if m < records.size:
+                self.fifo[0] = records[m:]
+            else:
+                self.fifo.pop(0)
+        self.fifoCount -= n
+        _target(nactual).value = n
+        return 0
+
+    def TH260_GetElapsedMeasTime(self, devidx, elapsed):
+        _target(elapsed).value = self._elapsed() * 1000
+        return 0
+
+    def TH260_CTCStatus(self, devidx, ctcstatus):
+        _target(ctcstatus).value = int(
+                self._elapsed() >= self.tacq / 1000)
+        return 0
+
+
+class SimulatedTH260Devices(object):
+    """
+    Simulation of several TimeHarp 260 P devices
+
+    Each device is simulated by its own SimulatedTH260Lib, the
+    TH260_* functions being dispatched according to their device index
+    (their first argument).
+
+    Parameters
+    ----------
+    devices : list of SimulatedTH260Lib
+        Simulated device of each device index
+    """
+
+    #: tuple : Library functions without device index
+    LIBRARY_FUNCTIONS = ('TH260_GetLibraryVersion', 'TH260_GetErrorString')
+
+    def __init__(self, devices):
+        """Constructor of the SimulatedTH260Devices class"""
+        self.devices = devices
+
+    def __getattr__(self, name):
+        if not name.startswith('TH260_'):
+            raise AttributeError(name)
+        if name in self.LIBRARY_FUNCTIONS:
+            return getattr(self.devices[0], name)
+
+        def function(devidx, *args):
+            index = _value(devidx)
+            if not 0 <= index < len(self.devices):
+                return -1   # TH260_ERROR_DEVICE_OPEN_FAIL
+            # each simulated device answers as device 0
+            return getattr(self.devices[index], name)(0, *args)
+        return function
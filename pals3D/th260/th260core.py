@@ -0,0 +1,1056 @@
+# This file is part of Pals3D
+#
+# TH260Core is meant to access a PicoQuant TimeHarp 260 Pico
+# via TH260LIB.DLL v 3.1. for applications to positron annihilation
+# lifetime spectroscopy, without any dependency on Qt (see
+# th260controller for the Qt controller of the GUI application).
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest 
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Based on demo code from:
+# Keno Goertz, PicoQuant GmbH, February 2018
+#
+
+import time
+import threading
+import ctypes as ct
+from ctypes import byref
+import numpy as np
+
+from th260 import th260backend
+from th260.pipelinestats import PipelineStats
+from th260.signals import Signal
+from th260.sortingcore import (overflowCorrection, overflowRecords,
+                               T2WRAPAROUND_V2)
+from th260.t2rawfile import RawRecordWriter, SpillFile
+
+
+class BufferPool(object):
+    """
+    Pool of preallocated ctypes buffers for the FIFO read loop
+
+    Buffers are handed out in rotation to the acquisition loop that
+    reads the FIFO directly into them. The ownership of a filled buffer
+    is then passed to the sorter worker, which gives it back to the
+    pool with the release method once it has been decoded. This avoids
+    any copy and allocation of the data for each read.
+
+    If all the buffers are in use when a new one is requested (i.e. the
+    sorting is lagging behind the acquisition), a new buffer is
+    allocated and will join the pool when released. At most capacity
+    buffers can be in use at once, the pool being the bounded hand-off
+    queue between the acquisition and the sorter: acquire then waits
+    for a buffer to be released, or returns None if not blocking.
+
+    A buffer can be shared by several consumers (e.g. the sorter and
+    the raw record writer), each of them calling retain before getting
+    it and release when done. It goes back to the pool when all of
+    them have released it.
+
+    Parameters
+    ----------
+    nbuffers : int
+        Number of buffers initially allocated
+    size : int
+        Size of each buffer (in records)
+    capacity : int, optional
+        Maximum number of buffers in use at once, unbounded if None
+
+    Attributes
+    ----------
+    nallocated : int
+        Total number of buffers allocated by the pool
+    """
+
+    def __init__(self, nbuffers, size, capacity=None):
+        """Constructor of the BufferPool class"""
+        self.size = size
+        self.capacity = capacity
+        self.nallocated = 0
+        self._free = [self._newBuffer() for _ in range(nbuffers)]
+        self._users = {}
+        self._lock = threading.Condition()
+
+    def _newBuffer(self):
+        """Allocate a new buffer of the pool size"""
+        self.nallocated += 1
+        return (ct.c_uint * self.size)()
+
+    def acquire(self, block=True, timeout=None):
+        """
+        Get a free buffer from the pool
+
+        Parameters
+        ----------
+        block : bool
+            Wait for a buffer to be released when capacity buffers are
+            in use
+        timeout : float, optional
+            Maximum waiting time (in s), no limit if None
+
+        Returns
+        -------
+        buffer : ctypes array of c_uint
+            Buffer of length size, owned by the caller until released,
+            None if capacity buffers are still in use
+        """
+        with self._lock:
+            if not self._hasRoom():
+                if not block or not self._lock.wait_for(self._hasRoom,
+                                                        timeout):
+                    return None
+            buffer = self._free.pop() if self._free else self._newBuffer()
+            self._users[id(buffer)] = 1
+        return buffer
+
+    def _hasRoom(self):
+        """Return True if less than capacity buffers are in use"""
+        return self.capacity is None or len(self._users) < self.capacity
+
+    def inUse(self):
+        """Return the number of buffers not yet given back to the pool"""
+        with self._lock:
+            return len(self._users)
+
+    def retain(self, buffer):
+        """
+        Register an additional user of a buffer
+
+        Parameters
+        ----------
+        buffer : ctypes array of c_uint
+            Buffer previously obtained with acquire
+        """
+        with self._lock:
+            self._users[id(buffer)] += 1
+
+    def release(self, buffer):
+        """
+        Give a buffer back to the pool
+
+        Thread safe, can be called from the sorter thread. The buffer
+        is actually back in the pool once released by all its users.
+
+        Parameters
+        ----------
+        buffer : ctypes array of c_uint
+            Buffer previously obtained with acquire
+        """
+        with self._lock:
+            self._users[id(buffer)] -= 1
+            if self._users[id(buffer)] > 0:
+                return
+            del self._users[id(buffer)]
+            self._free.append(buffer)
+            self._lock.notify()
+
+
+def listDevices(lib, maxdevnum=4):
+    """
+    List the devices available on the host computer
+
+    Each device is opened and closed at once, so that it can then be
+    opened by the controller driving it (see TH260Core, devidx).
+
+    Parameters
+    ----------
+    lib : ctypes.CDLL or SimulatedTH260Lib
+        Device library
+    maxdevnum : int
+        Number of device indices to try
+
+    Returns
+    -------
+    devices : list of tuple
+        Index and serial number of each device found
+    """
+    devices = []
+    serial = ct.create_string_buffer(b"", 8)
+    for i in range(maxdevnum):
+        if lib.TH260_OpenDevice(ct.c_int(i), serial) == 0:
+            devices.append((i, serial.value.decode("utf-8")))
+            lib.TH260_CloseDevice(ct.c_int(i))
+    return devices
+
+
+class TH260Core(object):
+    """
+    TH260 controller class to configure and monitor a TH260 P card
+
+    TH260Core is meant to access a PicoQuant TimeHarp 260 Pico
+    via TH260LIB.DLL v 3.1. for application to positron annihilation
+    lifetime spectroscopy.
+    Its signals are th260.signals.Signal attributes, whose slots are
+    called at once in the emitting thread, so that no Qt event loop
+    is needed (see th260controller.TH260Controller for the Qt
+    controller of the GUI application).
+
+    Parameters
+    ----------
+    lib : ctypes.CDLL or SimulatedTH260Lib, optional
+        Device library. If None, it is loaded by th260backend.loadLibrary
+        according to the PALS3D_BACKEND environment variable.
+    devidx : int, optional
+        Index of the device driven by the controller. If None, the
+        first device found by searchDevices is used. Several devices
+        are driven by several controllers (one per device, see
+        listDevices), each one only opening its own device.
+
+"""
+
+    # Constants from the DLL th260defin.h
+    LIB_VERSION = "3.1"
+    MAXDEVNUM = 4
+    MODE_T2 = 2
+    MODE_T3 = 3
+    MAXLENCODE = 5
+    MAXINPCHAN = 2
+    TTREADMAX = 131072
+    NBUFFERS = 16               # number of FIFO buffers in the pool
+    HANDOFF_CAPACITY = 64       # maximum number of buffers in the pool
+    HANDOFF_POLICIES = ('block', 'spill', 'drop')
+    BLOCK_TIMEOUT = 0.1         # s, waiting for a buffer before polling
+    STOP_TIMEOUT = 5.0          # s, waiting for a buffer after a stop
+    STATS_INTERVAL = 1.0        # s, between two STATS signals
+    # s, flags, count rates and elapsed time: a FIFO overrun is
+    # detected up to one interval after the card reports it
+    HOUSEKEEPING_INTERVAL = 0.1
+    WARNINGS_INTERVAL = 1.0     # s, between two warnings checks
+    POLL_FILL = 0.25            # targeted filling of a buffer per read
+    POLL_MIN = 0.0005           # s, shortest wait when the FIFO is empty
+    POLL_MAX = 0.02             # s, longest wait between two FIFO reads
+    FLAG_OVERFLOW = 0x0001
+    FLAG_FIFOFULL = 0x0002
+    CFDLVLMIN = -1200
+    CFDLVLMAX = 0
+    CFDZCMIN = -40
+    CFDZCMAX = 0
+    CHANOFFSMIN = -99999	   	# for TH260_SetSyncChannelOffset
+    CHANOFFSMAX = 99999         # and TH260_SetInputChannelOffset
+    ACQTMIN = 1		   	        # ms, for TH260_StartMeas
+    ACQTMAX = 360000000         # ms  (100*60*60*1000ms = 100h)
+
+    # signals
+    #: obj: Signal(str) message to be printed in a console or GUI output
+    NEW_OUTPUT = Signal(str)
+
+    #: obj: Signal(str) Warming messages for message box in GUI
+    WARNING = Signal(str)
+
+    #: obj: Signal(str, int) Signal to share the progress status
+    #: of the on-going acquisition.
+    #: The first argument should always be 'file' when use together
+    #: with the Pals3D GUI application. 'file' refer to the status of
+    #: a single acquisition file in opposition to 'acq' that relate
+    #: to the totale acquisition programm, and that is sent by the
+    #: acquisition worker of the GUI application.
+    #: This can be changed when used with an external application.
+    PROGRESS = Signal(str, int)  # str = "file"
+
+    #: obj: Signal(obj, int)
+    #: Signal to share data object with the sorter worker of TH260
+    #: module. The first argument is the data object itself, here a
+    #: c_type array buffer of the bufferPool. The second argument is
+    #: the number of records contained in the data buffer.
+    #: The receiver owns the buffer until it gives it back to the pool
+    #: with bufferPool.release.
+    DATA = Signal(object, int)
+
+    #: obj: Signal(tuple)
+    #: Not yet in use.
+    ERROR = Signal(tuple)
+
+    #: obj: Signal()
+    #: Signal send to the sorter worker to force the sorting of last events.
+    ACQ_ENDED = Signal()
+
+    #: obj: Signal()
+    #: Sent by the initialization method when the device is
+    #: successfuly initialised.
+    DEVINIT = Signal()
+
+    #: obj: Signal()
+    #: Sent to the GUI application to force the update of these
+    #: values in the GUI application.
+    UPDATECountRate = Signal()
+
+    #: obj: Signal(object)
+    #: Statistics of the acquisition pipeline (dict returned by
+    #: PipelineStats.snapshot), sent every STATS_INTERVAL seconds
+    #: during a measurement.
+    STATS = Signal(object)
+
+    def __init__(self, lib=None, devidx=None):
+        """ Constructor for TH260Core class """
+        super(TH260Core, self).__init__()
+        if lib is None:
+            lib = th260backend.loadLibrary()
+        self.TH260LIB = lib
+        self.devidx = devidx
+        # Setting variables
+        self.mode = self.MODE_T2
+        # Following variables are only meaningfull when used
+        # without a GUI, otherwise they are set through GUI
+        self.tacq = 60000               #: Measurement time in millisec,
+        self.syncDivider = 1            # you can change this, READ MANUAL!
+        self.syncCFDZeroCross = -10     # you can change this (in mV)
+        self.syncCFDLevel = -30         # you can change this (in mV)
+        self.syncOffset = 0             # you can change this (in mV)
+        self.inputCFDZeroCross = [-10, -10]  # you can change this (in mV)
+        self.inputCFDLevel = [-30, -30]      # you can change this (in mV)
+        self.inputOffset = [270, 1184]       # you can change this (in mV)
+        self.countRates = [0, 0, 0, 0]
+        # Raw record mode: the FIFO buffers are also written to this
+        # file when it is not None, with rawHeaderInfo in its header
+        self.rawFilename = None
+        self.rawHeaderInfo = {}
+
+        # Variables to store information red from DLLs
+        self.bufferPool = BufferPool(self.NBUFFERS, self.TTREADMAX,
+                                     self.HANDOFF_CAPACITY)
+        self.handOffPolicy = 'block'
+        self.spillDirectory = None
+        self.stats = PipelineStats()
+        self.stopRequested = threading.Event()
+        self.dev = []
+        self.libVersion = ct.create_string_buffer(b"", 8)
+        self.hwSerial = ct.create_string_buffer(b"", 8)
+        self.hwPartno = ct.create_string_buffer(b"", 8)
+        self.hwVersion = ct.create_string_buffer(b"", 16)
+        self.hwModel = ct.create_string_buffer(b"", 16)
+        self.errorString = ct.create_string_buffer(b"", 40)
+        self.numChannels = ct.c_int()
+        self.resolution = ct.c_double()
+        self.syncRate = ct.c_int()
+        self.countRate = ct.c_int()
+        self.flags = ct.c_int()
+        self.nRecords = ct.c_int()
+        self.ctcstatus = ct.c_int()
+        self.elapsedTime = ct.c_double()
+        self.warnings = ct.c_int()
+        self.warningstext = ct.create_string_buffer(b"", 16384)
+
+        # Define here signals logic connections
+        self.NEW_OUTPUT.connect(self.printOutput)
+        self.WARNING.connect(self.printOutput)
+
+    # Here define the default behaviour of slots to handle signals in
+    # case no GUI and/or no other slots are defined.
+    # REMEMBER to disconnect them before defining new slots, espcially
+    # in case console output is not desired.
+    def printOutput(self, text):
+        """
+        Print a message to console output.
+
+        Meant to be used as slot for the NEW_OUTPUT and WARNING signals
+        when no other slot (e.g. GUI application) is defined.
+
+        Parameters
+        ----------
+        text : str
+            Message to be printed to console output
+
+        """
+        print(text)
+
+    # ----------------- dealing with device ---------------------- #
+    def _deviceIndices(self):
+        """Return the indices of the devices handled by the controller"""
+        if self.devidx is None:
+            return range(0, self.MAXDEVNUM)
+        return [self.devidx]
+
+    def closeDevices(self):
+        """Close the currently opened devices"""
+        for i in self._deviceIndices():
+            self.TH260LIB.TH260_CloseDevice(ct.c_int(i))
+
+    def tryfunc(self, retcode, funcName, measRunning=False):
+        """
+        Check for errors when executing a function
+
+        If an error is raised, print the corresponding error
+        message, stop the TTTR measurement if needed and close the
+        device.
+
+        Parameters
+        ----------
+        retcode: int
+            code return by the function funcName
+            (0 = success, <0 = failed)
+        funcName: str
+            Name of the function being executed
+        measRunning: bool, default False
+            specify if TTTR measurement is running.
+            If True, the measurement will be stopped when an error
+            occured, and then the device is closed
+        """
+        if retcode < 0:
+            self.TH260LIB.TH260_GetErrorString(self.errorString,
+                                               ct.c_int(retcode))
+#            # TODO: transform that to logging
+#            self.file.write("TH260_%s error %d (%s). Aborted."
+#                            % (funcName, retcode,
+#                               self.errorString.value.decode("utf-8")))
+            self.WARNING.emit("TH260_%s error %d (%s). Aborted."
+                              % (funcName, retcode,
+                                 self.errorString.value.decode("utf-8")))
+            if measRunning:
+                self.stoptttr()
+            else:
+                self.closeDevices()
+
+    def searchDevices(self):
+        """Search and list available devices on the host computer """
+        self.TH260LIB.TH260_GetLibraryVersion(self.libVersion)
+        self.NEW_OUTPUT.emit("Library version is %s"
+                             % self.libVersion.value.decode("utf-8"))
+        if self.libVersion.value.decode("utf-8") != self.LIB_VERSION:
+            self.WARNING.emit(
+                    """Warning: The application was built for version %s
+                    \nCurrent DDL version is  %s"""
+                    % (self.LIB_VERSION,
+                       self.libVersion.value.decode("utf-8")))
+
+        self.NEW_OUTPUT.emit(
+                "\nSearching for TimeHarp devices... \n Devidx     Status")
+
+        for i in self._deviceIndices():
+            retcode = self.TH260LIB.TH260_OpenDevice(ct.c_int(i),
+                                                     self.hwSerial)
+            if retcode == 0:
+                self.NEW_OUTPUT.emit("  %1d        S/N %s"
+                                     % (i,
+                                        self.hwSerial.value.decode("utf-8")))
+                self.dev.append(i)
+            else:
+                if retcode == -1:  # TH260_ERROR_DEVICE_OPEN_FAIL
+                    self.NEW_OUTPUT.emit("  %1d        no device" % i)
+                else:
+                    self.TH260LIB.TH260_GetErrorString(self.errorString,
+                                                       ct.c_int(retcode))
+                    self.WARNING.emit("  %1d        %s"
+                                % (i, self.errorString.value.decode("utf8")))
+        if len(self.dev) < 1:
+            self.NEW_OUTPUT.emit("No device available.")
+            self.WARNING.emit("Waring: no device available !")
+            self.closeDevices()
+        self.NEW_OUTPUT.emit("\nUsing device #%1d" % self.dev[0])
+
+    def initialization(self):
+        """
+        Initialize communication with TH260 pico card
+
+        When initializationg is successfuly done, emit a DEVINIT
+        signal.
+        """
+        self.NEW_OUTPUT.emit("\nInitializing the device...")
+        # with internal clock
+        self.tryfunc(self.TH260LIB.TH260_Initialize(
+                ct.c_int(self.dev[0]), ct.c_int(self.mode)), "Initialize")
+
+        self.tryfunc(self.TH260LIB.TH260_GetHardwareInfo(self.dev[0],
+                                                         self.hwModel,
+                                                         self.hwPartno,
+                                                         self.hwVersion),
+                     "GetHardwareInfo")
+        self.NEW_OUTPUT.emit("Found Model %s Part no %s Version %s"
+                             % (self.hwModel.value.decode("utf-8"),
+                                self.hwPartno.value.decode("utf-8"),
+                                self.hwVersion.value.decode("utf-8")))
+
+        self.tryfunc(self.TH260LIB.TH260_GetNumOfInputChannels(
+                     ct.c_int(self.dev[0]),
+                     byref(self.numChannels)),
+                     "GetNumOfInputChannels")
+
+        self.NEW_OUTPUT.emit("Device has %i input channels."
+                             % self.numChannels.value)
+        self.DEVINIT.emit()
+
+    def configureSetting(self):
+        """
+        Set the card paramaters before starting a measurement
+
+        Parameters are either changed in the init function, or
+        acquired through an external script or GUI. Here, we only
+        set CFD parameters and channel offsets and the device
+        resolution should always be 25 ns as we are running in T2
+        mode only.
+        """
+
+        self.tryfunc(self.TH260LIB.TH260_SetSyncDiv(
+                     ct.c_int(self.dev[0]),
+                     ct.c_int(self.syncDivider)),
+                     "SetSyncDiv")
+
+        if self.hwModel.value.decode("utf-8") == "TimeHarp 260 P":
+            self.tryfunc(self.TH260LIB.TH260_SetSyncCFD(
+                         ct.c_int(self.dev[0]),
+                         ct.c_int(self.syncCFDLevel),
+                         ct.c_int(self.syncCFDZeroCross)),
+                         "SetSyncCFD")
+            # input settings for all channels
+            for i in range(0, self.numChannels.value):
+                self.tryfunc(self.TH260LIB.TH260_SetInputCFD(
+                             ct.c_int(self.dev[0]), ct.c_int(i),
+                             ct.c_int(self.inputCFDLevel[i]),
+                             ct.c_int(self.inputCFDZeroCross[i])),
+                             "SetInputCFD")
+
+        self.tryfunc(self.TH260LIB.TH260_SetSyncChannelOffset(
+                     ct.c_int(self.dev[0]),
+                     ct.c_int(self.syncOffset)),
+                     "SetSyncChannelOffset")
+
+        for i in range(0, self.numChannels.value):
+            self.tryfunc(self.TH260LIB.TH260_SetInputChannelOffset(
+                         ct.c_int(self.dev[0]),
+                         ct.c_int(i),
+                         ct.c_int(self.inputOffset[i])),
+                         "SetInputChannelOffset")
+#        uncomment for console output in needed
+#        print("\nMeasurement settings:")
+#        print("SyncCFDZeroCross  : %d" % self.syncCFDZeroCross)
+#        print("SyncCFDLevel      : %d" % self.syncCFDLevel)
+#        print("InputCFDZeroCross : %d" % self.inputCFDZeroCross[0])
+#        print("InputCFDLevel     : chn1: %d" % self.inputCFDLevel[0])
+
+#        self.tryfunc(self.TH260LIB.TH260_SetBinning(
+#              ct.c_int(self.dev[0]), ct.c_int(self.binning)), "SetBinning")
+#        self.tryfunc(self.TH260LIB.TH260_SetOffset(
+#              ct.c_int(self.dev[0]), ct.c_int(self.offset)), "SetOffset")
+        self.tryfunc(self.TH260LIB.TH260_GetResolution(
+              ct.c_int(self.dev[0]), byref(self.resolution)), "GetResolution")
+        self.NEW_OUTPUT.emit("Resolution is %1.1lfps" % self.resolution.value)
+
+        self.NEW_OUTPUT.emit("\nMeasuring input rates...")
+
+        # After Init or SetSyncDiv allow 150 ms for valid count rate readings
+        time.sleep(0.15)
+
+        # Initial call to TH260GetWarings to discard the initial value
+        # The warnings are accumulated in an internal variable but
+        # that variable is not initialized to zero at the beginning.
+        # It is only reset to 0 when you call TH260_GetWarnings.
+        self.tryfunc(self.TH260LIB.TH260_GetWarnings(
+                     ct.c_int(self.dev[0]),
+                     byref(self.warnings)),
+                     "GetWarnings")
+
+        self.getCountRates()
+        self.NEW_OUTPUT.emit("\nCountrate[sync]=%1d/s" % self.countRates[0])
+        self.NEW_OUTPUT.emit("Countrate[chn 1]=%1d/s" % (self.countRates[1]))
+        self.NEW_OUTPUT.emit("Countrate[chn 2]=%1d/s" % (self.countRates[2]))
+
+        # after getting the count rates you can check for warnings
+        self.checkWarnings()
+
+    def checkWarnings(self, previous=None):
+        """
+        Check the warnings of the device and send them over WARNING
+
+        The count rates must have been read before (see getCountRates).
+
+        Parameters
+        ----------
+        previous : int, optional
+            Warnings returned by a previous check, nothing is sent if
+            they did not change
+
+        Returns
+        -------
+        warnings : int
+            Warning bits of the device
+        """
+        self.tryfunc(self.TH260LIB.TH260_GetWarnings(
+                     ct.c_int(self.dev[0]),
+                     byref(self.warnings)),
+                     "GetWarnings")
+
+        if self.warnings.value == previous:
+            pass
+        elif self.warnings.value != 0:
+            self.TH260LIB.TH260_GetWarningsText(ct.c_int(self.dev[0]),
+                                                self.warningstext,
+                                                self.warnings)
+            self.WARNING.emit("%s" % self.warningstext.value.decode("utf-8"))
+        else:
+            self.WARNING.emit('No warning')
+        return self.warnings.value
+
+    # ----------- data aqcuisition ---------------- #
+    def getCountRates(self):
+        """Get the count rates for each channels and store them"""
+        self.tryfunc(self.TH260LIB.TH260_GetSyncRate(
+                     ct.c_int(self.dev[0]),
+                     byref(self.syncRate)),
+                     "GetSyncRate")
+        self.countRates[0] = self.syncRate.value
+
+        for i in range(0, self.numChannels.value):
+            self.tryfunc(self.TH260LIB.TH260_GetCountRate(
+                         ct.c_int(self.dev[0]),
+                         ct.c_int(i),
+                         byref(self.countRate)),
+                         "GetCountRate")
+            self.countRates[i+1] = self.countRate.value
+
+    def getSettingDict(self):
+        """
+        Return the current CFD and offset settings
+
+        Returns
+        -------
+        settings : dict
+            Settings with the same keys as the T2settingDict of the
+            Pals3D GUI: 'levX', 'zeroX' and 'offX' for the CFD level,
+            CFD zero cross and offset of channel X (0 for sync)
+        """
+        settings = {'lev0': self.syncCFDLevel,
+                    'zero0': self.syncCFDZeroCross,
+                    'off0': self.syncOffset}
+        for i in range(len(self.inputOffset)):
+            settings['lev%d' % (i+1)] = self.inputCFDLevel[i]
+            settings['zero%d' % (i+1)] = self.inputCFDZeroCross[i]
+            settings['off%d' % (i+1)] = self.inputOffset[i]
+        return settings
+
+    def startRawRecording(self):
+        """
+        Start the disk writer thread of the raw record mode
+
+        Returns
+        -------
+        rawWriter : RawRecordWriter
+            Writer thread for the raw record file rawFilename
+
+        Raises
+        ------
+        OSError
+            If the raw record file can not be created
+        """
+        header = {'mode': 'T2',
+                  'version': 2,
+                  'date': time.asctime(),
+                  'resolution': self.resolution.value,
+                  'syncDivider': self.syncDivider,
+                  'tacq': self.tacq,
+                  'CFDset': self.getSettingDict()}
+        header.update(self.rawHeaderInfo)
+        rawWriter = RawRecordWriter(self.rawFilename, header,
+                                    self.bufferPool.release)
+        rawWriter.start()
+        self.NEW_OUTPUT.emit("Recording raw data to %s" % self.rawFilename)
+        return rawWriter
+
+    def stopRawRecording(self, rawWriter):
+        """
+        Write the last buffers and stop the disk writer thread
+
+        Parameters
+        ----------
+        rawWriter : RawRecordWriter
+            Writer thread returned by startRawRecording
+        """
+        rawWriter.close()
+        if rawWriter.error is not None:
+            self.WARNING.emit("Raw data recording failed: \n%s"
+                              % rawWriter.error)
+        else:
+            self.NEW_OUTPUT.emit("{} raw records saved to {}"
+                                 .format(rawWriter.nrecords,
+                                         rawWriter.filename))
+
+    def setHandOff(self, policy, capacity=None):
+        """
+        Set the behaviour of the hand-off queue to the sorter
+
+        The buffers handed over to the sorter are taken from the buffer
+        pool, so that at most capacity buffers can wait to be sorted.
+        When they are all in use (i.e. the sorting is lagging behind
+        the acquisition), the policy decides what happens to the data:
+
+        - 'block': the FIFO is not read until a buffer is released,
+          the data waits in the FIFO of the card (which may overrun)
+        - 'spill': the FIFO is read and the records are written to a
+          temporary file, handed over to the sorter in order as soon as
+          buffers are released
+        - 'drop': the FIFO is read and the records are discarded and
+          counted, only their overflows are handed over to the sorter
+          so that the timetags of the next records stay right
+
+        Parameters
+        ----------
+        policy : str
+            'block', 'spill' or 'drop'
+        capacity : int, optional
+            Maximum number of buffers of the pool, unchanged if None
+        """
+        if policy not in self.HANDOFF_POLICIES:
+            raise ValueError("Unknown hand-off policy %s, expected one of "
+                             "%s" % (policy, self.HANDOFF_POLICIES))
+        self.handOffPolicy = policy
+        if capacity is not None:
+            self.bufferPool.capacity = capacity
+
+    def _readFifo(self, buffer):
+        """Read the FIFO into buffer, return the number of records"""
+        readStart = time.perf_counter_ns()
+        self.tryfunc(self.TH260LIB.TH260_ReadFiFo(
+                    ct.c_int(self.dev[0]),
+                    byref(buffer),
+                    self.TTREADMAX,
+                    byref(self.nRecords)),
+                    "ReadFiFo", measRunning=True)
+        self.stats.addRead(self.nRecords.value,
+                           time.perf_counter_ns() - readStart)
+        return self.nRecords.value
+
+    def _pollInterval(self, nread, elapsed):
+        """
+        Return the time to wait before the next FIFO read (in s)
+
+        The FIFO is read again right away when it is filling up, i.e.
+        the last read got at least POLL_FILL*TTREADMAX records.
+        Otherwise the waiting time is the one needed for about that
+        many records to arrive at the current rate, and it doubles
+        while the FIFO stays empty, between POLL_MIN and POLL_MAX.
+
+        Parameters
+        ----------
+        nread : int
+            Number of records of the last read
+        elapsed : float
+            Time between the last two reads (in s)
+        """
+        target = self.POLL_FILL * self.TTREADMAX
+        if nread >= target:
+            return 0.
+        if nread == 0:
+            interval = 2*elapsed
+        else:
+            interval = elapsed * target / nread
+        return min(max(interval, self.POLL_MIN), self.POLL_MAX)
+
+    def _writeRaw(self, rawWriter, buffer, nrecords, pooled):
+        """
+        Queue the records just read from the FIFO for the raw record file
+
+        Called for every read, before the records are handed over,
+        spilled or dropped, so that the raw record file holds all of
+        them whatever the hand-off policy. A pool buffer is shared with
+        the sorter without any copy, the writer giving it back to the
+        pool once written. The records of the scratch buffer, read into
+        again at the next read, are copied.
+        """
+        if pooled:
+            self.bufferPool.retain(buffer)
+            rawWriter.write(buffer, nrecords)
+        else:
+            rawWriter.write(np.frombuffer(buffer, dtype=np.uint32)
+                            [:nrecords].copy(), nrecords, release=False)
+
+    def _handOff(self, buffer, nrecords):
+        """
+        Hand a pool buffer over to the sorter
+
+        The buffer is passed without any copy, together with the number
+        of valid records. The sorter gives it back to the pool once
+        decoded.
+        """
+        self.DATA.emit(buffer, nrecords)
+        self.stats.addBuffer()
+
+    def _drainSpill(self, spill, buffer, block=False):
+        """
+        Hand the spilled records over to the sorter, in order
+
+        Parameters
+        ----------
+        spill : SpillFile
+            Spilled records
+        buffer : ctypes array of c_uint
+            Free pool buffer, or None
+        block : bool
+            Wait for free buffers until all the records are handed over,
+            or until a stop is requested (see requestStop)
+
+        Returns
+        -------
+        buffer : ctypes array of c_uint
+            The given buffer if it was not needed, None otherwise
+        """
+        while spill.pending() > 0:
+            if buffer is None:
+                buffer = self.bufferPool.acquire(block=block,
+                                                 timeout=self.BLOCK_TIMEOUT)
+                if buffer is None:
+                    if block and not self.stopRequested.is_set():
+                        continue
+                    break
+            self._handOff(buffer, spill.readInto(buffer))
+            buffer = None
+        return buffer
+
+    def stoptttr(self):
+        """Stop the ongoing TTTR measurement"""
+        self.tryfunc(self.TH260LIB.TH260_StopMeas(ct.c_int(self.dev[0])),
+                     "StopMeas")
+
+    def requestStop(self):
+        """
+        Stop the ongoing measurement from another thread
+
+        The card is stopped by the acquisition loop, which then reads
+        the data left in the FIFO and ends the measurement as if its
+        time was over (ACQ_ENDED is emitted).
+        """
+        self.stopRequested.set()
+
+    def startAcquisition(self, nfiles=1):
+        """
+        Start data collection with current settings
+
+        Launch measurement according to current settings. Emit signals
+        to communicate with other workers. Data buffers are emitted
+        through a signal for being sorted by the TH260sorter module.
+        Output messages and countrates are also sent over signals.
+
+        The FIFO is polled adaptively (see _pollInterval): right away
+        while it is filling up, less and less often while it is nearly
+        empty. The flags, elapsed time and count rates are sampled
+        every HOUSEKEEPING_INTERVAL and the warnings every
+        WARNINGS_INTERVAL, whatever the polling rate. A FIFO overrun
+        thus ends the measurement up to HOUSEKEEPING_INTERVAL after
+        the card flags it, and the records read in the meantime, after
+        the gap left by the overrun, are still handed over.
+
+        If the raw record file rawFilename can not be created, the
+        failure is reported through WARNING and the measurement runs
+        without raw data, as after a failure of the disk writer.
+
+        Parameters
+        ----------
+        nfiles : int
+            Number of files of tacq measured at once (continuous
+            acquisition): the card runs for nfiles*tacq without
+            interruption, the sorter cutting the files from the event
+            timetags. PROGRESS then refers to the current file.
+
+        Raises
+        ------
+        ValueError
+            If nfiles*tacq is longer than ACQTMAX
+        """
+        if self.tacq * nfiles > self.ACQTMAX:
+            raise ValueError("Measurement time %d ms longer than %d ms"
+                             % (self.tacq * nfiles, self.ACQTMAX))
+        self.NEW_OUTPUT.emit("\nStarting data collection...")
+        self.stopRequested.clear()
+
+        progress = 0
+        # Uncomment following 2 lines in case of console oupput
+        # remember to add "import sys" in header file
+#        sys.stdout.write("\nProgress:%12u" % progress)
+#        sys.stdout.flush()
+
+        # The raw file is opened before the card starts, so that a
+        # failure does not leave the card measuring
+        rawWriter = None
+        if self.rawFilename is not None:
+            try:
+                rawWriter = self.startRawRecording()
+            except OSError as error:
+                self.WARNING.emit("Raw data recording failed: \n%s\n"
+                                  "Measuring without raw data." % error)
+
+        self.tryfunc(self.TH260LIB.TH260_StartMeas(
+                     ct.c_int(self.dev[0]),
+                     ct.c_int(self.tacq * nfiles)),
+                     "StartMeas")
+
+        buffer = None
+        scratch = None
+        spill = None
+        droppedOverflows = 0
+        ndropped = 0
+        measEnded = False
+        measCrashed = False
+        measStopped = False
+        stopTime = None
+        warnings = None
+        pollInterval = 0.
+        lastRead = lastHousekeeping = time.perf_counter()
+        lastStats = lastWarnings = lastRead
+        while not (measEnded or measCrashed):
+            if self.stopRequested.is_set() and not measStopped:
+                self.stoptttr()
+                measStopped = True
+                stopTime = time.perf_counter()
+            # The flags, elapsed time, count rates and warnings are
+            # sampled on a slower schedule than the FIFO reads
+            now = time.perf_counter()
+            if now - lastHousekeeping >= self.HOUSEKEEPING_INTERVAL:
+                lastHousekeeping = now
+                self.tryfunc(self.TH260LIB.TH260_GetFlags(
+                             ct.c_int(self.dev[0]),
+                             byref(self.flags)),
+                             "GetFlags")
+
+                if self.flags.value & self.FLAG_FIFOFULL > 0:
+                    self.WARNING.emit("Measurment failed: \nFiFo Overrun!")
+                    self.stoptttr()
+                    measCrashed = True
+                    continue
+
+                self.tryfunc(self.TH260LIB.TH260_GetElapsedMeasTime(
+                                self.dev[0],
+                                ct.byref(self.elapsedTime)),
+                             "GetElapsedMeasTime")
+#                Uncomment following 2 lines in case of console oupput
+#                remember to add "import sys" in header file
+#                sys.stdout.write("\n time  %4f " % self.elapsedTime.value)
+#                sys.stdout.flush()
+                noFile = min(int(self.elapsedTime.value // self.tacq),
+                             nfiles - 1)
+                self.PROGRESS.emit("file", self.elapsedTime.value
+                                   - noFile*self.tacq)
+
+                self.getCountRates()
+                self.UPDATECountRate.emit()
+                if now - lastWarnings >= self.WARNINGS_INTERVAL:
+                    lastWarnings = now
+                    warnings = self.checkWarnings(warnings)
+
+            # The FIFO is read into a pool buffer, kept until it actually
+            # receives data. When the hand-off queue is full (no free
+            # buffer), the FIFO is read into the scratch buffer and the
+            # records are spilled or dropped (see setHandOff).
+            if buffer is None:
+                buffer = self.bufferPool.acquire(
+                        block=self.handOffPolicy == 'block',
+                        timeout=self.BLOCK_TIMEOUT)
+            if buffer is not None and droppedOverflows > 0:
+                records = overflowRecords(droppedOverflows)
+                np.frombuffer(buffer, dtype=np.uint32)[:records.size] = \
+                    records
+                self._handOff(buffer, records.size)
+                droppedOverflows = 0
+                buffer = self.bufferPool.acquire(block=False)
+            if spill is not None:
+                buffer = self._drainSpill(spill, buffer)
+
+            if buffer is not None and (spill is None
+                                       or spill.pending() == 0):
+                target = buffer
+            elif self.handOffPolicy == 'block':
+                target = None   # the data waits in the FIFO of the card
+            else:
+                if scratch is None:
+                    scratch = (ct.c_uint * self.TTREADMAX)()
+                target = scratch
+            nread = 0 if target is None else self._readFifo(target)
+            if target is not None:
+                now = time.perf_counter()
+                pollInterval = self._pollInterval(nread, now - lastRead)
+                lastRead = now
+
+            if nread > 0:
+                if rawWriter is not None:
+                    self._writeRaw(rawWriter, target, nread,
+                                   target is buffer)
+                if target is buffer:
+                    self._handOff(buffer, nread)
+                    buffer = None
+                elif self.handOffPolicy == 'spill':
+                    if spill is None:
+                        spill = SpillFile(self.spillDirectory)
+                        self.NEW_OUTPUT.emit("Sorting lagging behind, "
+                                             "spilling data to disk")
+                    spill.write(scratch, nread)
+                    self.stats.addSpill(nread)
+                else:
+                    if ndropped == 0:
+                        self.WARNING.emit("Sorting lagging behind, "
+                                          "dropping data!")
+                    droppedOverflows += overflowCorrection(
+                            np.frombuffer(scratch, dtype=np.uint32)[:nread]
+                            ) // T2WRAPAROUND_V2
+                    ndropped += nread
+                    self.stats.addDrop(nread)
+                progress += nread
+                self.countRates[3] += nread
+#                Uncomment following 2 lines in case of console oupput
+#                remember to add "import sys" in header file
+#                sys.stdout.write("\rProgress:%12u" % progress)
+#                sys.stdout.flush()
+
+            else:
+                # Checked even without a free buffer, so that the loop
+                # ends after a stop if the sorter never gives the
+                # buffers back. Otherwise the data left in the FIFO is
+                # still read once a buffer is free.
+                self.tryfunc(self.TH260LIB.TH260_CTCStatus(
+                             ct.c_int(self.dev[0]),
+                             byref(self.ctcstatus)),
+                             "CTCStatus")
+                waiting = target is None and not (
+                        measStopped and time.perf_counter() - stopTime
+                        >= self.STOP_TIMEOUT)
+                if not waiting and (self.ctcstatus.value > 0
+                                    or measStopped):
+                    if target is None:
+                        self.WARNING.emit("No buffer given back by the "
+                                          "sorter, the data left in the "
+                                          "FIFO is discarded!")
+                    if spill is not None:
+                        buffer = self._drainSpill(spill, buffer,
+                                                  block=True)
+                    self.ACQ_ENDED.emit()
+                    self.NEW_OUTPUT.emit(
+                            "Measurement ended at event # {}"
+                            .format(progress))
+                    self.tryfunc(self.TH260LIB.TH260_StopMeas(
+                                 ct.c_int(self.dev[0])),
+                                 "StopMeas")
+                    measEnded = True
+
+            self.stats.updateQueue(self.bufferPool.inUse(),
+                                   0 if spill is None else spill.pending())
+            if (measEnded
+                    or time.perf_counter() - lastStats >= self.STATS_INTERVAL):
+                self.STATS.emit(self.stats.snapshot())
+                lastStats = time.perf_counter()
+            if measCrashed:
+                self.NEW_OUTPUT.emit("Measurement crashed after {} sec"
+                                     .format(self.elapsedTime.value*1000))
+                break
+            # no wait after a blocking acquire of the hand-off queue
+            if target is not None and pollInterval > 0 and not measEnded:
+                time.sleep(pollInterval)
+
+        if ndropped > 0:
+            self.NEW_OUTPUT.emit("{} records dropped".format(ndropped))
+        if spill is not None:
+            spill.close()
+        if buffer is not None:
+            self.bufferPool.release(buffer)
+        if rawWriter is not None:
+            self.stopRawRecording(rawWriter)
@@ -0,0 +1,242 @@
+# This file is part of Pals3D
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import numpy as np
+
+from th260.sortingcore import encodeT2Records
+
+SOURCES = ('Na22', 'Co60')  #: tuple : Sources that can be simulated
+
+
+class PALSGenerator(object):
+    """
+    Synthetic PALS event stream encoded into T2 records
+
+    Positron events are generated at random times (Poisson process).
+    With a 22Na source, each event gives a start photon (1274 keV) on
+    the sync channel and, after the positron lifetime, two annihilation
+    photons (511 keV) on the input channels. The lifetime is drawn
+    from the lifetime components with their intensities. With a 60Co
+    source, the two photons of the cascade are prompt (zero lifetime),
+    giving the time resolution of the setup.
+
+    Each photon is detected with the efficiency of its channel, so
+    that both triple events (start and two stops) and double events
+    (start and one stop) are produced. Its time is delayed by the
+    offset of the channel and smeared by a Gaussian time resolution.
+    Uncorrelated background photons are added on each channel, and all
+    the times are quantized to the tick (25 ps) before being encoded
+    into T2 records, overflow records included, exactly as the TH260
+    FIFO would deliver them.
+
+    The stream is generated chunk by chunk (see generate and chunks),
+    the photons delayed after the end of a chunk being kept for the
+    next one. The whole stream is reproducible for a given seed and
+    chunking.
+
+    Parameters
+    ----------
+    rate : float
+        Number of positron events per second
+    source : str
+        'Na22' or 'Co60'
+    lifetimes : tuple of (float, float)
+        Lifetime (in ps) and intensity of each lifetime component,
+        intensities are normalized (only for 'Na22')
+    resolution : tuple of float
+        Standard deviation of the time resolution of each channel
+        (sync, chn1, chn2) (in ps)
+    offsets : tuple of float
+        Delay of each channel (in ps)
+    efficiency : tuple of float
+        Detection probability of the photons of each channel
+    background : tuple of float
+        Rate of uncorrelated photons of each channel (in counts/s)
+    tick : int
+        Time resolution of the records (in ps)
+    seed : int, optional
+        Seed of the random generator
+
+    Attributes
+    ----------
+    cursor : int
+        Time up to which the stream has been generated (in ticks)
+    """
+
+    def __init__(self, rate=1e5, source='Na22',
+                 lifetimes=((160., 0.3), (400., 0.65), (2000., 0.05)),
+                 resolution=(80., 80., 80.), offsets=(0., 2000., 3000.),
+                 efficiency=(1., 1., 1.), background=(0., 0., 0.),
+                 tick=25, seed=None):
+        """Constructor of the PALSGenerator class"""
+        if source not in SOURCES:
+            raise ValueError("Unknown source %s, expected one of %s"
+                             % (source, SOURCES))
+        self.rate = rate
+        self.source = source
+        taus, intensities = np.array(lifetimes, dtype=float).T
+        self.taus = taus
+        self.cumIntensities = np.cumsum(intensities) / np.sum(intensities)
+        self.resolution = resolution
+        self.offsets = offsets
+        self.efficiency = efficiency
+        self.background = background
+        self.tick = tick
+        self.seed = seed
+        self.reset()
+
+    def reset(self):
+        """Restart the stream at time 0 with the initial seed"""
+        self.rng = np.random.default_rng(self.seed)
+        self.cursor = 0
+        self.oflcorrection = 0
+        self.pendingKeys = np.empty(0, dtype=np.int64)
+
+    def countRates(self):
+        """Return the mean count rate of each channel (in counts/s)"""
+        return [self.rate*eff + bkg
+                for eff, bkg in zip(self.efficiency, self.background)]
+
+    def recordRate(self):
+        """Return the mean number of photon records per second"""
+        return sum(self.countRates())
+
+    def _startTimes(self, nticks):
+        """Times of the positron events in the next nticks (in ticks)"""
+        meanInterval = 1 / (self.rate * self.tick * 1e-12)
+        expected = nticks / meanInterval
+        times = np.empty(0)
+        last = 0.
+        while last < nticks:
+            n = int(expected + 5*np.sqrt(expected) + 10)
+            more = last + np.cumsum(self.rng.exponential(meanInterval, n))
+            times = np.concatenate((times, more))
+            last = more[-1]
+        return times[:np.searchsorted(times, nticks)]
+
+    def _photons(self, channel, times, nticks):
+        """Detected photons of channel, from their ideal times (in ticks)"""
+        if self.efficiency[channel] < 1:
+            isDetected = (self.rng.random(times.size, dtype=np.float32)
+                          < self.efficiency[channel])
+            times = times[isDetected]
+        if self.background[channel] > 0:
+            nbkg = self.rng.poisson(self.background[channel] * nticks
+                                    * self.tick * 1e-12)
+            times = np.concatenate((times,
+                                    self.rng.uniform(0, nticks, nbkg)))
+        # single precision is enough for the delays
+        delays = self.rng.standard_normal(times.size, dtype=np.float32)
+        delays *= self.resolution[channel] / self.tick
+        delays += self.offsets[channel] / self.tick
+        times = times + delays
+        return np.floor(times, out=times).astype(np.int64)
+
+    def generateUntil(self, endTick):
+        """
+        Generate the records of the stream up to a given time
+
+        Parameters
+        ----------
+        endTick : int
+            End of the generated time interval (in ticks)
+
+        Returns
+        -------
+        records : np.ndarray of np.uint32
+            T2 records of the photons detected between the end of the
+            previous chunk and endTick
+        """
+        nticks = endTick - self.cursor
+        start = self._startTimes(nticks)
+        if self.source == 'Na22':
+            # component of each event, faster than searchsorted for the
+            # few lifetime components
+            u = self.rng.random(start.size, dtype=np.float32)
+            component = np.zeros(start.size, dtype=np.intp)
+            for cumIntensity in self.cumIntensities[:-1]:
+                component += u >= cumIntensity
+            lifetime = self.rng.standard_exponential(start.size,
+                                                     dtype=np.float32)
+            lifetime *= self.taus[component] / self.tick
+            stop = start + lifetime
+        else:
+            stop = start
+
+        # photons are sorted at once on a key made of the time (in
+        # ticks from the cursor) and the channel in the lowest 2 bits
+        keys = [self.pendingKeys]
+        for channel, photons in enumerate((start, stop, stop)):
+            channelKeys = self._photons(channel, photons, nticks)
+            channelKeys <<= 2
+            channelKeys |= channel
+            keys.append(channelKeys)
+        # nearly sorted runs, merged quickly by the stable sort
+        keys = np.sort(np.concatenate(keys), kind='stable')
+
+        # photons moved before the start of the chunk by the time
+        # resolution can not be recorded anymore (rare, at boundaries)
+        first = np.searchsorted(keys, 0)
+        last = np.searchsorted(keys, nticks << 2)
+        self.pendingKeys = keys[last:] - (nticks << 2)
+        keys = keys[first:last]
+        records, self.oflcorrection = encodeT2Records(
+                keys & 3, (keys >> 2) + self.cursor, self.oflcorrection)
+        self.cursor = endTick
+        return records
+
+    def generate(self, duration):
+        """
+        Generate the records of the next duration seconds
+
+        Parameters
+        ----------
+        duration : float
+            Duration of the chunk (in s)
+
+        Returns
+        -------
+        records : np.ndarray of np.uint32
+            T2 records of the chunk
+        """
+        return self.generateUntil(self.cursor
+                                  + int(round(duration / (self.tick*1e-12))))
+
+    def chunks(self, duration, chunkDuration=0.01):
+        """
+        Iterate over the records of a measurement chunk by chunk
+
+        Parameters
+        ----------
+        duration : float
+            Duration of the measurement (in s)
+        chunkDuration : float
+            Duration of each chunk (in s)
+
+        Yields
+        ------
+        records : np.ndarray of np.uint32
+            T2 records of each chunk
+        """
+        endTick = self.cursor + int(round(duration / (self.tick*1e-12)))
+        chunkTicks = max(int(round(chunkDuration / (self.tick*1e-12))), 1)
+        while self.cursor < endTick:
+            yield self.generateUntil(min(self.cursor + chunkTicks, endTick))
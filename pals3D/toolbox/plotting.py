@@ -43,19 +43,9 @@ def plotFitHist(data, figname='fig.pdf', bins=161, rmin=2000, rmax=6000):
 
     See Also
     --------
-    plotHist, plotHists, saveHists
+    fitHist, plotHist, plotHists, saveHists
     """
-    histo, bin_edges = np.histogram(data, bins=bins, range=[rmin, rmax])
-    bin_centers = 0.5*(bin_edges[1:] + bin_edges[:-1])
-
-    # Finding the guess parameters for Gaussian fitting
-    x0_guess = bin_edges[np.argmax(histo)]
-    sig_guess = np.std(histo)*4
-    amp_guess = np.max(histo)
-
-    paramL, covL = curve_fit(lorentz, bin_centers, histo)
-    paramG, covG = curve_fit(gaussian, bin_centers, histo,
-                             p0=[x0_guess, sig_guess, amp_guess])
+    bin_centers, histo, paramL, paramG = fitHist(data, bins, rmin, rmax)
     x_plot = np.linspace(rmin, rmax, 20000)
     plt.plot(bin_centers, histo, 'r-')
     plt.plot(x_plot, lorentz(x_plot, *paramL), ':m')
@@ -72,6 +62,50 @@ def plotFitHist(data, figname='fig.pdf', bins=161, rmin=2000, rmax=6000):
     plt.show()
 
 
+def fitHist(data, bins=161, rmin=2000, rmax=6000):
+    """
+    Histogram data and fit it with Gaussian and Lorentzian functions
+
+    Parameters
+    ----------
+    data : np.array
+        Input data
+    bins : int
+        Number of equal-width bins in the given range
+    rmin : int
+        min (most left-end bin edge) of the histogramm
+    rmax : int
+        max (most right-end bin edge) of the histogramm
+
+    Returns
+    -------
+    bin_centers : np.array
+        Center of each bin
+    histo : np.array
+        Number of events in each bin
+    paramL : np.array
+        Parameters (x0, sig, amp) of the Lorentzian fit
+    paramG : np.array
+        Parameters (x0, sig, amp) of the Gaussian fit
+
+    See Also
+    --------
+    plotFitHist
+    """
+    histo, bin_edges = np.histogram(data, bins=bins, range=[rmin, rmax])
+    bin_centers = 0.5*(bin_edges[1:] + bin_edges[:-1])
+
+    # Finding the guess parameters for Gaussian fitting
+    x0_guess = bin_edges[np.argmax(histo)]
+    sig_guess = np.std(histo)*4
+    amp_guess = np.max(histo)
+
+    paramL, covL = curve_fit(lorentz, bin_centers, histo)
+    paramG, covG = curve_fit(gaussian, bin_centers, histo,
+                             p0=[x0_guess, sig_guess, amp_guess])
+    return bin_centers, histo, paramL, paramG
+
+
 def plotHist(data, figname='fig.pdf', bins=161, rmin=2000, rmax=6000,
              logY=False):
     """
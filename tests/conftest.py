@@ -0,0 +1,67 @@
+# This file is part of Pals3D
+#
+# conftest is meant to set up the test suite of Pals3D: the modules are
+# imported as from the pals3D directory (from th260 import ...), as when
+# running the application.
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'pals3D'))
+
+from th260 import sortingcore  # noqa: E402
+from toolbox.generator import PALSGenerator  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def records():
+    """T2 records of 0.2 s of positron events (reproducible)"""
+    return PALSGenerator(rate=2e5, seed=1).generate(0.2)
+
+
+@pytest.fixture
+def newSorter():
+    """Factory of SortingCore objects keeping their results in memory"""
+    def newSorter(sortingType, timeGate=4000, timeRes=1500, **kwargs):
+        sorter = sortingcore.SortingCore(sortingType=sortingType,
+                                         timeGate=timeGate, timeRes=timeRes,
+                                         filename=None, CFDset={}, acqTime=1,
+                                         nftot=1, **kwargs)
+        sorter.newMeasurement(0)
+        return sorter
+    return newSorter
+
+
+def histogramCounts(sorter):
+    """Counts of each histogram of a sorter, by channel pair name"""
+    return dict((chnPair, np.array(histogram.counts))
+                for chnPair, histogram in sorter.histograms.items())
+
+
+@pytest.fixture
+def counts():
+    """Function returning the counts of each histogram of a sorter"""
+    return histogramCounts
@@ -0,0 +1,111 @@
+# This file is part of Pals3D
+#
+# test_coincidences is meant to check the lookup tables compiled from
+# the coincidence definitions and the sorting they drive.
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import numpy as np
+import pytest
+
+from th260.coincidences import CoincidenceSet
+
+
+def testPairLookupTable():
+    """Pairs are found in both orders, the other channel pairs not"""
+    coincidences = CoincidenceSet('0>1 0>2 1-2', '2C', 10000)
+    codes = coincidences.pairCodes(np.array([0, 1, 1, 2, 0, 3]),
+                                   np.array([1, 0, 2, 1, 0, 1]))
+    assert codes.tolist() == [0, 1, 4, 5, -1, -1]
+    assert coincidences.pairSign[codes[:4]].tolist() == [1, -1, 1, -1]
+    assert coincidences.pairHistogram[codes[:4]].tolist() == [0, 0, 2, 2]
+    assert coincidences.histogramNames == ['01', '02', '12']
+
+
+def testTripleLookupTable():
+    """Triplets are found whatever the order of their last two events"""
+    coincidences = CoincidenceSet('0:1-2 0:3-4@8000/500', '3C', 10000,
+                                  1000)
+    codes = coincidences.tripleCodes(np.array([0, 1, 2, 0, 2, 1, 0, 4, 3]))
+    assert codes.tolist() == [0, -1, -1, 1, -1, -1, 3]
+    assert coincidences.tripleGateTicks.tolist() == [400, 320]
+    assert coincidences.tripleResTicks.tolist() == [40, 20]
+    assert coincidences.eventDtype.names == ('01', '02', '12', '03', '04',
+                                             '34', 'triple')
+
+
+@pytest.mark.parametrize('spec, sortingType', [
+        ('0:1-2', '2C'),        # triple in a pair mode
+        ('0>1', '3C'),          # pair in the triple mode
+        ('0>1 1>0', '2C'),      # same pair twice
+        ('0>1 0-1@2000', '2C'),
+        ('0>70', '2C'),         # no such channel
+        ('0:1-2', '3C'),        # no short gate
+        ('0>>1', '2C')])
+def testInvalidDefinitions(spec, sortingType):
+    with pytest.raises(ValueError):
+        CoincidenceSet(spec, sortingType, 10000)
+
+
+@pytest.mark.parametrize('sortingType', ['2C', '2CW'])
+def testPairOrderDoesNotMatter(records, newSorter, counts, sortingType):
+    """The histograms do not depend on the order of the definitions"""
+    preset = newSorter(sortingType)
+    permuted = newSorter(sortingType, coincidences='1-2 0>2 0>1')
+    for sorter in (preset, permuted):
+        sorter.sortBuffer(records, records.size)
+    assert preset.coincidences.spec != permuted.coincidences.spec
+    expected = counts(preset)
+    assert sum(c.sum() for c in expected.values()) > 0
+    for chnPair, values in counts(permuted).items():
+        assert np.array_equal(values, expected[chnPair])
+
+
+def testReversedTriple(records, newSorter, counts):
+    """A triple declared the other way round mirrors the 1-2 histogram"""
+    preset = newSorter('3C')
+    reversed_ = newSorter('3C', coincidences='0:2-1')
+    for sorter in (preset, reversed_):
+        sorter.sortBuffer(records, records.size)
+    expected, values = counts(preset), counts(reversed_)
+    assert expected['12'].sum() > 0
+    assert np.array_equal(values['01'], expected['01'])
+    assert np.array_equal(values['02'], expected['02'])
+    assert np.array_equal(values['21'], expected['12'][::-1])
+    events = reversed_.events.toArray()
+    assert np.array_equal(events['21'], -preset.events.toArray()['12'])
+
+
+def testGateOfADefinition(records, newSorter, counts):
+    """A definition with its own gate sorts the pairs of that gate"""
+    narrow = newSorter('2C', timeGate=10000,
+                       coincidences='0>1@2000 0>2 1-2')
+    wide = newSorter('2C', timeGate=10000)
+    for sorter in (narrow, wide):
+        sorter.sortBuffer(records, records.size)
+    narrowCounts, wideCounts = counts(narrow), counts(wide)
+    n = narrowCounts['01'].size
+    assert n < wideCounts['01'].size
+    # the bins below the narrow gate hold the same pairs, only the last
+    # one is cut by the gate
+    assert np.array_equal(narrowCounts['01'][:n - 1],
+                          wideCounts['01'][:n - 1])
+    assert np.array_equal(narrowCounts['02'], wideCounts['02'])
@@ -0,0 +1,51 @@
+# This file is part of Pals3D
+#
+# test_eventstore is meant to check the .npy files of the triple
+# coincidence events, in the current and in the former format.
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import numpy as np
+
+from th260.eventstore import EventStore, loadEvents
+
+
+def testLoadEventsReadsBothFormats(tmp_path):
+    """loadEvents gives the same events for the former and new files"""
+    dtimes = {'01': np.array([100, 25, 4000]),
+              '02': np.array([200, -50, 3975]),
+              '12': np.array([100, -75, -25])}
+    store = EventStore(str(tmp_path / "new.npy"), blockSize=2)
+    store.append(dtimes)
+    store.close()
+    np.save(tmp_path / "old.npy",
+            np.stack([dtimes[chnPair].astype(float)
+                      for chnPair in ('01', '02', '12')], axis=1))
+
+    for name in ("new.npy", "old.npy"):
+        events = loadEvents(str(tmp_path / name))
+        assert events.dtype.names == ('01', '02', '12')
+        for chnPair, values in dtimes.items():
+            assert np.array_equal(events[chnPair], values)
+        columns = loadEvents(str(tmp_path / name), mmap_mode='r',
+                             columns=True)
+        assert columns.shape == (3, 3)
+        assert np.array_equal(columns[:, 2], dtimes['12'])
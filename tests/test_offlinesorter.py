@@ -0,0 +1,111 @@
+# This file is part of Pals3D
+#
+# test_offlinesorter is meant to check that the offline sorter gives
+# the same output files as the sorting during the acquisition, whether
+# the raw record files are sorted sequentially or in parallel.
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import numpy as np
+import pytest
+
+from th260 import headless, offlinesorter, t2rawfile, th260backend
+from toolbox.generator import PALSGenerator
+
+
+def hstLines(filename):
+    """Lines of an .hst file, without the measurement date"""
+    with open(filename) as file:
+        return [line for line in file
+                if not line.startswith("#Measurement date")]
+
+
+def testContinuousResortMatchesLive(tmp_path):
+    """A continuous run sorted again gives the files sorted live"""
+    config = tmp_path / "run.ini"
+    config.write_text("[acquisition]\n"
+                      "filename = %s\n"
+                      "acqTime = 0.005\n"
+                      "noFiles = 3\n"
+                      "sortingType = 3C\n"
+                      "timeGate = 10000\n"
+                      "timeRes = 1000\n"
+                      "continuous = yes\n"
+                      "saveRaw = yes\n"
+                      "[CFD]\n" % (tmp_path / "run.hst"))
+    lib = th260backend.SimulatedTH260Lib(PALSGenerator(rate=5e4, seed=3))
+    runner = headless.HeadlessAcquisition(headless.readConfig(config), lib,
+                                          output=lambda text: None)
+    runner.initDevice()
+    try:
+        assert runner.run() == 3
+    finally:
+        runner.controller.closeDevices()
+
+    header, records = offlinesorter.openRawFile(tmp_path / "run.t2r")
+    assert header['nftot'] == 3 and 'noFile' not in header
+    offlinesorter.sortRawFile(str(tmp_path / "run.t2r"), '3C', 10000, 1000,
+                              str(tmp_path / "resorted.hst"),
+                              output=lambda text: None)
+    for noFile in range(3):
+        live = tmp_path / ("run_%03d" % noFile)
+        resorted = tmp_path / ("resorted_%03d" % noFile)
+        lines = hstLines(str(live) + ".hst")
+        assert "file #%d out of 3" % (noFile + 1) in "".join(lines)
+        assert lines == hstLines(str(resorted) + ".hst")
+        events = np.load(str(live) + ".npy")
+        assert events.size > 0
+        assert np.array_equal(events, np.load(str(resorted) + ".npy"))
+    assert not (tmp_path / "resorted_003.hst").exists()
+
+
+@pytest.fixture(scope='module')
+def rawFile(records, tmp_path_factory):
+    """Raw record file of the records fixture"""
+    filename = str(tmp_path_factory.mktemp("raw") / "run_000.t2r")
+    with open(filename, 'wb') as file:
+        cfd = dict(("%s%d" % (key, channel), 0) for channel in range(3)
+                   for key in ('lev', 'zero', 'off'))
+        t2rawfile.writeRawHeader(file, {'mode': 'T2', 'version': 2,
+                                        'tacq': 200, 'CFDset': cfd,
+                                        'noFile': 0, 'nftot': 1})
+        records.tofile(file)
+    return filename
+
+
+@pytest.mark.parametrize('sortingType, timeRes', [('2C', None),
+                                                  ('2CW', None),
+                                                  ('3C', 1500)])
+def testParallelSortingMatchesSequential(rawFile, tmp_path, sortingType,
+                                         timeRes):
+    """-j1 and -jN give the same files, whatever the split of the parts"""
+    ncoinc = []
+    for jobs in (1, 3):
+        output = str(tmp_path / ("j%d.hst" % jobs))
+        # 12 parts of 2000-record chunks, most of them split inside a gate
+        ncoinc.append(offlinesorter.sortRawFile(
+                rawFile, sortingType, 4000, timeRes, output, 2000,
+                output=lambda text: None, jobs=jobs))
+    assert ncoinc[0] == ncoinc[1] > 0
+    assert hstLines(tmp_path / "j1_000.hst") == \
+        hstLines(tmp_path / "j3_000.hst")
+    if sortingType == '3C':
+        assert np.array_equal(np.load(tmp_path / "j1_000.npy"),
+                              np.load(tmp_path / "j3_000.npy"))
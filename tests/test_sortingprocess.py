@@ -0,0 +1,78 @@
+# This file is part of Pals3D
+#
+# test_sortingprocess is meant to check that the sorting process can
+# replace the sorting worker of the GUI.
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import pytest
+
+pytest.importorskip('PyQt5')
+
+import pals3D  # noqa: E402
+from th260.sortingprocess import SortingProcess  # noqa: E402
+
+
+class Display(object):
+    """Stand-in of the QLCDNumber widgets of the coincidence counts"""
+
+    def __init__(self):
+        self.count = 0
+
+    def value(self):
+        return self.count
+
+    def display(self, count):
+        self.count = count
+
+
+class Window(object):
+    """MainWindow attributes used by updateCoincRates"""
+
+    def __init__(self, sortingWorker):
+        self.sortingWorker = sortingWorker
+        self.rateDoubleValue = Display()
+        self.rateTripleValue = Display()
+
+
+@pytest.fixture
+def sortingProcess():
+    """SortingProcess stopped at the end of the test"""
+    sortingProcess = SortingProcess(1024, nslots=2)
+    yield sortingProcess
+    sortingProcess.close()
+
+
+@pytest.mark.parametrize('sortingType, double, triple', [('2C', 5, 0),
+                                                         ('2CW', 5, 0),
+                                                         ('3C', 0, 5)])
+def testUpdateCoincRates(sortingProcess, sortingType, double, triple):
+    """The coincidence counts go to the display of the sorting type"""
+    sortingProcess.kwargs.update(sortingType=sortingType, timeGate=4000,
+                                 timeRes=1500, filename=None, CFDset={},
+                                 acqTime=1, nftot=1)
+    sortingProcess.newMeasurement(0)
+    assert sortingProcess.sortingType == sortingType
+    window = Window(sortingProcess)
+    pals3D.MainWindow.updateCoincRates(window, 2)
+    pals3D.MainWindow.updateCoincRates(window, 3)
+    assert window.rateDoubleValue.value() == double
+    assert window.rateTripleValue.value() == triple
@@ -0,0 +1,133 @@
+# This file is part of Pals3D
+#
+# test_streammerger is meant to check the time-ordered merge of the
+# events of several cards.
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import numpy as np
+import pytest
+
+from th260 import sortingcore
+from th260.streammerger import StreamMerger, defaultChannelMap, mergeRecords
+
+DELAY = 48  #: int : Clock offset of the second card (in ticks)
+
+
+@pytest.fixture(scope='module')
+def cards(records):
+    """
+    Records of two cards sharing the sync of records, the first one
+    getting channel 1 and the second one channel 2, DELAY ticks late
+    """
+    channels, timeTags, _ = sortingcore.decodeT2Records(records)
+    first, _ = sortingcore.encodeT2Records(channels[channels != 2],
+                                           timeTags[channels != 2])
+    second, _ = sortingcore.encodeT2Records(
+            channels[channels != 1], timeTags[channels != 1] + DELAY)
+    return channels, timeTags, [first, second]
+
+
+def channelMaps():
+    """Channel maps giving back the channel numbers of records"""
+    maps = [defaultChannelMap(0), np.full(sortingcore.NCHANNELS, -1)]
+    maps[0][2] = -1
+    maps[1][2] = 2
+    return maps
+
+
+def testDefaultChannelMap():
+    assert defaultChannelMap(0)[:3].tolist() == [0, 1, 2]
+    assert defaultChannelMap(1)[:3].tolist() == [-1, 3, 4]
+    assert defaultChannelMap(2, ninputs=4)[:5].tolist() == [-1, 9, 10, 11,
+                                                            12]
+
+
+@pytest.mark.parametrize('maxLookAhead', [None, 10**9])
+def testMergeIsTimeOrdered(cards, maxLookAhead):
+    """All the events come out once, in time order across the cards"""
+    channels, timeTags, streams = cards
+    merger = StreamMerger(2, offsets=[0, -DELAY], channelMaps=channelMaps(),
+                          maxLookAhead=maxLookAhead)
+    batches = list(mergeRecords(merger, streams, chunkSize=7777))
+    assert len(batches) > 2
+    mergedChannels = np.concatenate([c for c, _ in batches])
+    mergedTimes = np.concatenate([t for _, t in batches])
+    assert np.all(np.diff(mergedTimes) >= 0)
+    for (_, first), (_, second) in zip(batches, batches[1:]):
+        assert first[-1] <= second[0]
+    assert merger.lateEvents == 0 and merger.pending() == 0
+    # same events as the records shared by the cards
+    order = np.lexsort((channels, timeTags))
+    mergedOrder = np.lexsort((mergedChannels, mergedTimes))
+    assert np.array_equal(mergedTimes[mergedOrder], timeTags[order])
+    assert np.array_equal(mergedChannels[mergedOrder], channels[order])
+
+
+@pytest.mark.parametrize('sortingType', ['2C', '3C'])
+def testMergedSortingMatchesOneCard(records, cards, newSorter, counts,
+                                    sortingType):
+    """The merged events sort as the records of a single card"""
+    _, _, streams = cards
+    single = newSorter(sortingType)
+    single.sortBuffer(records, records.size)
+    merged = newSorter(sortingType)
+    merger = StreamMerger(2, offsets=[0, -DELAY], channelMaps=channelMaps())
+    for channels, timeTags in mergeRecords(merger, streams, chunkSize=5000):
+        merged.sortEvents(channels, timeTags)
+    expected = counts(single)
+    for chnPair, values in counts(merged).items():
+        assert np.array_equal(values, expected[chnPair])
+    if sortingType == '3C':
+        assert np.array_equal(merged.events.toArray(),
+                              single.events.toArray())
+
+
+def testWatermark():
+    """Events are held back until no card can send older ones"""
+    merger = StreamMerger(2)
+    merger.push(0, np.ones(3, dtype=int), np.array([0, 100, 200]))
+    channels, timeTags = merger.pop()
+    assert timeTags.size == 0 and merger.watermark is None
+    merger.push(1, np.ones(2, dtype=int), np.array([50, 150]))
+    channels, timeTags = merger.pop()
+    assert timeTags.tolist() == [0, 50, 100]
+    assert channels.tolist() == [1, 3, 1]
+    assert merger.watermark == 150 and merger.pending() == 2
+    merger.finish(1)
+    assert merger.pop()[1].tolist() == [150]
+    assert merger.flush()[1].tolist() == [200]
+    with pytest.raises(ValueError):
+        merger.push(1, np.ones(1, dtype=int), np.array([300]))
+
+
+def testMaxLookAheadAndLateEvents():
+    """A silent card does not hold back the others beyond maxLookAhead"""
+    merger = StreamMerger(2, maxLookAhead=100)
+    merger.push(0, np.zeros(5, dtype=int), np.arange(0, 500, 100))
+    assert merger.pop()[1].tolist() == [0, 100, 200]
+    assert merger.pending() == 2
+    # the first event is older than the watermark (300): dropped
+    merger.push(1, np.ones(3, dtype=int), np.array([50, 450, 460]))
+    assert merger.lateEvents == 1
+    assert merger.pop()[1].tolist() == [300]
+    assert merger.flush()[1].tolist() == [400, 450, 460]
+    assert merger.watermark == 461
@@ -0,0 +1,163 @@
+# This file is part of Pals3D
+#
+# test_th260core is meant to check the buffer pool and the hand-off
+# policies of the acquisition loop, on the simulated device.
+#
+# ---------------------------------------------
+#
+# Copyright (c) 2018-2019 Aurelie Vancraeyenest
+# ---------------------------------------------
+#
+# Pals3D is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Pals3D is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pals3D.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import queue
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from th260 import offlinesorter, sortingcore, th260backend
+from th260.th260core import BufferPool, TH260Core
+from toolbox.generator import PALSGenerator
+
+
+def testBufferReferenceCount():
+    """A shared buffer is back in the pool once all its users release it"""
+    pool = BufferPool(1, 16, capacity=2)
+    buffer = pool.acquire()
+    pool.retain(buffer)
+    pool.release(buffer)
+    assert pool.inUse() == 1
+    pool.release(buffer)
+    assert pool.inUse() == 0
+    assert pool.acquire() is buffer
+    assert pool.nallocated == 1
+
+
+def testPoolCapacity():
+    """Buffers are added up to capacity, acquire then waits"""
+    pool = BufferPool(1, 16, capacity=2)
+    first, second = pool.acquire(), pool.acquire()
+    assert first is not second and pool.nallocated == 2
+    assert pool.acquire(block=False) is None
+    assert pool.acquire(timeout=0.01) is None
+    threading.Timer(0.05, pool.release, [second]).start()
+    assert pool.acquire(timeout=5) is second
+
+
+class SlowSorter(threading.Thread):
+    """
+    Sorter thread keeping a copy of the buffers it receives, taking
+    delay seconds per buffer before giving it back to the pool
+    """
+
+    def __init__(self, pool, delay):
+        super(SlowSorter, self).__init__(daemon=True)
+        self.pool = pool
+        self.delay = delay
+        self.buffers = queue.Queue()
+        self.records = []
+
+    def receive(self, buffer, nrecords):
+        self.buffers.put((buffer, nrecords))
+
+    def run(self):
+        while True:
+            item = self.buffers.get()
+            if item is None:
+                break
+            buffer, nrecords = item
+            self.records.append(np.frombuffer(buffer, dtype=np.uint32)
+                                [:nrecords].copy())
+            time.sleep(self.delay)
+            self.pool.release(buffer)
+
+
+def photonKeys(records):
+    """Channel and timetag of the photon events of records, as one key"""
+    channels, timeTags, _ = sortingcore.decodeT2Records(records)
+    return timeTags * sortingcore.NCHANNELS + channels
+
+
+def testRawFileError(tmp_path):
+    """A raw file that can not be created is reported before the card
+    starts, and the measurement runs without raw data"""
+    lib = th260backend.SimulatedTH260Lib(PALSGenerator(rate=2e5, seed=2))
+    core = TH260Core(lib)
+    core.NEW_OUTPUT.disconnect()
+    core.WARNING.disconnect()
+    warnings = []
+    core.WARNING.connect(lambda text: warnings.append((text, lib.running)))
+    core.searchDevices()
+    core.initialization()
+    core.rawFilename = str(tmp_path / "missing" / "raw.t2r")
+    received = []
+    core.DATA.connect(lambda buffer, nrecords: (
+            received.append(nrecords), core.bufferPool.release(buffer)))
+    core.tacq = 200
+    try:
+        core.startAcquisition()
+    finally:
+        core.closeDevices()
+    text, running = warnings[0]
+    assert text.startswith("Raw data recording failed") and not running
+    assert not lib.running and sum(received) > 0
+    assert core.bufferPool.inUse() == 0
+
+
+@pytest.mark.parametrize('policy', ['block', 'spill', 'drop'])
+def testPoolExhaustion(tmp_path, policy):
+    """The records the sorter can not take are waited for, spilled or
+    dropped, and the sorter always gets its records in order"""
+    lib = th260backend.SimulatedTH260Lib(PALSGenerator(rate=2e5, seed=2))
+    core = TH260Core(lib)
+    core.NEW_OUTPUT.disconnect()
+    core.WARNING.disconnect()
+    core.searchDevices()
+    core.initialization()
+    core.setHandOff(policy, 2)
+    core.rawFilename = str(tmp_path / "raw.t2r")
+    sorter = SlowSorter(core.bufferPool, 0.1)
+    sorter.start()
+    core.DATA.connect(sorter.receive)
+    core.tacq = 1000
+    try:
+        core.startAcquisition()
+    finally:
+        sorter.buffers.put(None)
+        sorter.join()
+        core.closeDevices()
+    stats = core.stats.snapshot()
+    assert core.bufferPool.inUse() == 0
+    assert stats['queueHighWater'] == 2
+
+    # the raw record file holds every record read from the FIFO
+    _, raw = offlinesorter.openRawFile(core.rawFilename)
+    assert raw.size == stats['recordsRead'] > 0
+    sorted_ = np.concatenate(sorter.records)
+    if policy == 'drop':
+        assert stats['droppedRecords'] > 0 and stats['spilledRecords'] == 0
+        keys = photonKeys(sorted_)
+        # the overflows of the dropped records are passed on, so that
+        # the records handed over keep their right timetags
+        assert np.all(np.diff(keys // sortingcore.NCHANNELS) >= 0)
+        assert np.all(np.isin(keys, photonKeys(raw)))
+        assert keys.size < photonKeys(raw).size
+    else:
+        assert stats['droppedRecords'] == 0
+        assert (stats['spilledRecords'] > 0) == (policy == 'spill')
+        assert np.array_equal(sorted_, raw)